@@ -1,50 +1,18 @@
 import json
-from faker import Faker
 import pandas as pd
-import random
 import pyarrow
-import hashlib
 import os
 from Hash_1000_Buckets import SSN
-
-# initialize Faker
-fake = Faker()
+from bucket_partition import bucket_ids, partition_frame
+from bucket_writer import build_postings, write_buckets
+from posting_index import PostingIndex
+from data_generator import generate_frame
 
 num_records = 1000000
 
-# generate SSN set first for unique records then conver to list
-ssns = set()
-while len(ssns) < num_records:
-    ssns.add(fake.ssn())
-ssns = list(ssns)
-
-# generate state list
-state = [
-    'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'FL', 'GA', 'HI', 'ID',
-    'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN',
-    'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND',
-    'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT',
-    'VA', 'WA', 'WV', 'WI', 'WY'
-]
-random_state = random.choices(state, k=num_records)
-
-# occupation list
-occupation = [
-    'Accountant', 'Actor', 'Actuary', 'Administrative Assistant',
-    'Aerospace Engineer', 'Agricultural Engineer', 'Air Traffic Controller',
-    'Aircraft Mechanic', 'Airline Pilot', 'Anesthesiologist',
-    'Anthropologist', 'Architect', 'Archivist', 'Art Director',
-    'Astronomer', 'Athletic Trainer', 'Audiologist', 'Author',
-    'Automotive Mechanic', 'Baker', 'Bartender', 'Biochemist',
-    'Biomedical Engineer', 'Brickmason', 'Broadcast Technician'
-]
-random_occupation = random.choices(occupation, k=num_records)
-
-# generate dataframe
-df = pd.DataFrame({'SSN': ssns,
-                   'State': random_state,
-                   'Occupation': random_occupation
-                   })
+# generate unique SSNs with uniform random State and Occupation columns; seeded, so every run
+# builds the same dataset
+df = generate_frame(num_records, seed=0, categorical=False)
 
 # create primary index with SSN
 df.set_index('SSN', inplace=True)
@@ -58,69 +26,31 @@ os.makedirs(BUCKETS_DIR, exist_ok=True)
 df.to_parquet(os.path.join(BUCKETS_DIR, 'primary_data.parquet'), index=True)
 print('DataFrame has been saved to parquet file.')
 
-# create secondary index with State and Occupation and store in JSON
-
-state_index = {}
-occupation_index = {}
-
-for ssn, row in df.iterrows():
-    state = row['State']
-    occupation = row['Occupation']
-    state_index.setdefault(state, set()).add(ssn)
-    occupation_index.setdefault(occupation, set()).add(ssn)
+# Bucket ids are hashed for the whole column at once
+ids = bucket_ids(df.index.to_numpy(), num_buckets=1000)
 
-# Convert sets to lists for JSON serialization
-state_index = {k: list(v) for k, v in state_index.items()}
-occupation_index = {k: list(v) for k, v in occupation_index.items()}
+# create secondary indexes with State and Occupation, global and per bucket, from one sort
+# of the whole frame per column
+bucket_postings, global_postings = build_postings(df, ids)
 
-# Store secondary indexes in JSON files
-with open(os.path.join(BUCKETS_DIR, 'state_index.json'), 'w') as f:
-    json.dump(state_index, f)
-
-with open(os.path.join(BUCKETS_DIR, 'occupation_index.json'), 'w') as f:
-    json.dump(occupation_index, f)
+# Store the global secondary indexes in JSON files
+ssn_values = df.index.to_numpy()
+for index_key, file_name in (('State', 'state_index.json'), ('Occupation', 'occupation_index.json')):
+    values, offsets, rows = global_postings[index_key]
+    index = {value: ssn_values[rows[offsets[i]:offsets[i + 1]]].tolist() for i, value in enumerate(values)}
+    with open(os.path.join(BUCKETS_DIR, file_name), 'w') as f:
+        json.dump(index, f)
 
 print("Primary data and indexes are created.")
 
 
-# hashing function to distribute to 1000 buckets
-def hash_index_to_bucket(ssn, num_buckets=1000):
-    hash_object = hashlib.md5(str(ssn).encode())
-    bucket = int(hash_object.hexdigest(), 16) % num_buckets
-    return bucket
-
-
-# Initialize buckets and secondary indexes
-buckets = {i: [] for i in range(1000)}
-state_index = {i: {} for i in range(1000)}
-occupation_index = {i: {} for i in range(1000)}
-
-# Distribute rows into buckets
-for ssn, row in df.iterrows():
-    bucket = hash_index_to_bucket(ssn)
-    buckets[bucket].append(row)
-
-    state = row['State']
-    occupation = row['Occupation']
-    state_index[bucket].setdefault(state, set()).add(ssn)
-    occupation_index[bucket].setdefault(occupation, set()).add(ssn)
-
-# Save each bucket into a Parquet file and their respective secondary indexes into JSON files
-for bucket, data in buckets.items():
-    if data:
-        bucket_df = pd.DataFrame(data).sort_index()
-        bucket_df.index.name = 'SSN'
-        bucket_df.to_parquet(os.path.join(BUCKETS_DIR, f'bucket_{bucket}.parquet'), index=True)
-
-        # Convert sets to lists for JSON serialization
-        state_index[bucket] = {k: list(v) for k, v in state_index[bucket].items()}
-        occupation_index[bucket] = {k: list(v) for k, v in occupation_index[bucket].items()}
-
-        with open(os.path.join(BUCKETS_DIR, f'state_index_{bucket}.json'), 'w') as f:
-            json.dump(state_index[bucket], f)
+# Distribute rows into buckets; the frame is split with one argsort instead of appending row by row
+bucket_frames = partition_frame(df, ids=ids)
 
-        with open(os.path.join(BUCKETS_DIR, f'occupation_index_{bucket}.json'), 'w') as f:
-            json.dump(occupation_index[bucket], f)
+# Save each bucket into a Parquet file and write its precomputed posting index files, spread
+# over a worker pool; BUCKET_WRITERS=None uses one worker per core
+BUCKET_WRITERS = None
+write_buckets(bucket_frames, BUCKETS_DIR, max_workers=BUCKET_WRITERS, postings=bucket_postings)
 
 print("file and indexes are distributed to 1000 buckets")
 
@@ -134,8 +64,8 @@ BUCKETS_DIR = './buckets_v2'
 # Function to validate a single bucket
 def validate_bucket(bucket_id):
     bucket_file = os.path.join(BUCKETS_DIR, f'bucket_{bucket_id}.parquet')
-    state_index_file = os.path.join(BUCKETS_DIR, f'state_index_{bucket_id}.json')
-    occupation_index_file = os.path.join(BUCKETS_DIR, f'occupation_index_{bucket_id}.json')
+    state_index_prefix = os.path.join(BUCKETS_DIR, f'state_index_{bucket_id}')
+    occupation_index_prefix = os.path.join(BUCKETS_DIR, f'occupation_index_{bucket_id}')
 
     print(f"Validating bucket {bucket_id}...")
 
@@ -148,27 +78,25 @@ def validate_bucket(bucket_id):
     else:
         print(f"Parquet file for bucket {bucket_id} does not exist.")
 
-    # Check if state index JSON file exists
-    if os.path.exists(state_index_file):
+    # Check if state index file exists
+    if os.path.exists(state_index_prefix + '.npz'):
         print(f"State index file for bucket {bucket_id} exists.")
-        # Load and print some of the state index JSON content
-        with open(state_index_file, 'r') as f:
-            state_index = json.load(f)
-            print(f"State index for bucket {bucket_id}:")
-            for state, ssns in list(state_index.items())[:5]:  # Print only first 5 entries
-                print(f"  {state}: {ssns}")
+        # Load and print some of the state index content
+        state_index = PostingIndex.load(state_index_prefix)
+        print(f"State index for bucket {bucket_id}:")
+        for state in list(state_index.keys())[:5]:  # Print only first 5 entries
+            print(f"  {state}: {state_index.ssns(state)}")
     else:
         print(f"State index file for bucket {bucket_id} does not exist.")
 
-    # Check if occupation index JSON file exists
-    if os.path.exists(occupation_index_file):
+    # Check if occupation index file exists
+    if os.path.exists(occupation_index_prefix + '.npz'):
         print(f"Occupation index file for bucket {bucket_id} exists.")
-        # Load and print some of the occupation index JSON content
-        with open(occupation_index_file, 'r') as f:
-            occupation_index = json.load(f)
-            print(f"Occupation index for bucket {bucket_id}:")
-            for occupation, ssns in list(occupation_index.items())[:5]:  # Print only first 5 entries
-                print(f"  {occupation}: {ssns}")
+        # Load and print some of the occupation index content
+        occupation_index = PostingIndex.load(occupation_index_prefix)
+        print(f"Occupation index for bucket {bucket_id}:")
+        for occupation in list(occupation_index.keys())[:5]:  # Print only first 5 entries
+            print(f"  {occupation}: {occupation_index.ssns(occupation)}")
     else:
         print(f"Occupation index file for bucket {bucket_id} does not exist.")
 
@@ -1,51 +1,17 @@
 import os
 
-from faker import Faker
 import pandas as pd
-import random
 import pyarrow
-import hashlib
 import os
 from Hash_1000_Buckets import SSN
-
-# initialize Faker
-fake = Faker()
+from bucket_partition import partition_frame
+from data_generator import generate_frame
 
 num_records = 1000000
 
-# generate SSN set first for unique records then conver to list
-ssns = set()
-while len(ssns) < num_records:
-    ssns.add(fake.ssn())
-ssns = list(ssns)
-
-# generate state list
-state = [
-    'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'FL', 'GA', 'HI', 'ID',
-    'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN',
-    'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND',
-    'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT',
-    'VA', 'WA', 'WV', 'WI', 'WY'
-]
-random_state = random.choices(state, k=num_records)
-
-# occupation list
-occupation = [
-    'Accountant', 'Actor', 'Actuary', 'Administrative Assistant',
-    'Aerospace Engineer', 'Agricultural Engineer', 'Air Traffic Controller',
-    'Aircraft Mechanic', 'Airline Pilot', 'Anesthesiologist',
-    'Anthropologist', 'Architect', 'Archivist', 'Art Director',
-    'Astronomer', 'Athletic Trainer', 'Audiologist', 'Author',
-    'Automotive Mechanic', 'Baker', 'Bartender', 'Biochemist',
-    'Biomedical Engineer', 'Brickmason', 'Broadcast Technician'
-]
-random_occupation = random.choices(occupation, k=num_records)
-
-# generate dataframe
-df = pd.DataFrame({'SSN': ssns,
-                   'State': random_state,
-                   'Occupation': random_occupation
-                   })
+# generate unique SSNs with uniform random State and Occupation columns; seeded, so every run
+# builds the same dataset
+df = generate_frame(num_records, seed=0, categorical=False)
 
 # create primary index with SSN
 df.set_index('SSN', inplace=True)
@@ -74,32 +40,16 @@ print(df)
 # make a directory for the 1000 buckets
 
 
-# bucket using hashing function
-def hash_index_to_bucket(ssn, num_buckets=1000):
-    hash_object = hashlib.md5(str(ssn).encode())
-    bucket = int(hash_object.hexdigest(), 16) % num_buckets
-    return bucket
-
-
-# Create a dictionary to hold data for each bucket
-buckets = {i: [] for i in range(1000)}
-
-# Distribute rows into buckets
-for index, row in df.iterrows():
-    bucket = hash_index_to_bucket(index[0])
-# include index when distribution to each bucket
-    buckets[bucket].append((index, row))
+# Distribute rows into buckets by hashing the SSN level of the index; the whole column is
+# hashed at once and each bucket keeps its MultiIndex
+bucket_frames = partition_frame(df, num_buckets=1000)
 
 
 # Save each bucket to a Parquet file, including the index
 output_dir = 'buckets'
 os.makedirs(output_dir, exist_ok=True)
-for bucket, data in buckets.items():
-    if data:
-        # Create a DataFrame from the list of tuples, preserving the index
-        bucket_df = pd.DataFrame([row for _, row in data], columns=df.columns)
-        bucket_df.index = pd.MultiIndex.from_tuples([index for index, _ in data], names=df.index.names)
-        bucket_df.to_parquet(os.path.join(output_dir, f'bucket-{bucket}.parquet'), index=True)
+for bucket, bucket_df in bucket_frames.items():
+    bucket_df.to_parquet(os.path.join(output_dir, f'bucket-{bucket}.parquet'), index=True)
 
 print("file with index has been distributed to 1000 buckets")
 
@@ -1,19 +1,101 @@
 import json
 import os
 import datetime
+import queue
+import random
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+import numpy as np
 import pandas as pd
-import hashlib
 import json
+from bitmap_index import BitmapIndex
+from bloom_filter import BloomFilter, file_version
+from bucket_cache import BucketCache, CachedBucket
+from bucket_locks import BucketLocks
+from bucket_storage import STORAGE_BACKENDS, make_storage
+from memtable import Memtable
+from bucket_partition import HASH_SCHEMES, bucket_ids, hash_index_to_bucket, jump_bucket, partition_frame
+from bucket_writer import build_postings, write_buckets
+from data_generator import generate_frame
+from posting_index import (COMPACT_MIN_LOG_RECORDS, OP_ADD, PostingIndex, append_log, base_size, int_to_ssn,
+                           ssn_to_int)
+from wal_format import (RECORD_FORMATS, encode_entry, fsync_files, iter_entries, last_lsn, open_segment,
+                        read_checkpoint, segment_files, segment_format, truncate_segments, write_checkpoint)
+
+INDEX_COLUMNS = ('State', 'Occupation')
+INDEX_FILE_PATTERN = re.compile(r'_index_(\d+)\.(?:npz|log|json)$')
+# memtable: single-record writes only go to an in-memory memtable, which is written to the
+# bucket files once it grows past memtable_max_bytes
+WRITE_MODES = ('write-through', 'write-back', 'memtable')
+LAYOUT_FILE = 'layout.json'
+# none: leave entries in the write buffer, flush: hand each entry to the OS,
+# fsync: fsync each entry, fsync_transaction: fsync once per end_transaction
+DURABILITY_LEVELS = ('none', 'flush', 'fsync', 'fsync_transaction')
+# Levels that survive a power failure; only these fsync the WAL and bucket files on checkpoint
+FSYNC_LEVELS = ('fsync', 'fsync_transaction')
+
+
+def _record_matches(record, predicates):
+    # Same rules as BitmapIndex.match: None matches anything, a list is OR-ed together
+    for column, value in predicates.items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, set, frozenset)):
+            if record[column] not in value:
+                return False
+        elif record[column] != value:
+            return False
+    return True
 
 
 class WriteAheadLog:
-    def __init__(self, wal_dir='./wal_v3', max_wal_operations=100):
+    def __init__(self, wal_dir='./wal_v3', max_wal_operations=100, durability='flush', buffer_size=64 * 1024,
+                 record_format='json'):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"Unknown durability level {durability!r}, expected one of {DURABILITY_LEVELS}")
+        if record_format not in RECORD_FORMATS:
+            raise ValueError(f"Unknown record format {record_format!r}, expected one of {RECORD_FORMATS}")
         self.wal_dir = wal_dir
         self.max_wal_operations = max_wal_operations
+        self.durability = durability
+        self.record_format = record_format
+        self.buffer_size = buffer_size
         self.wal_counter = 0
-        self.wal_file_counter = 0
         self.current_transaction = []
+        self.in_transaction = False
+        self.listeners = []
         os.makedirs(wal_dir, exist_ok=True)
+        # Keep appending to the newest segment so entries stay in LSN order across restarts
+        wal_files = segment_files(wal_dir)
+        self.wal_file_counter = wal_files[-1][0] if wal_files else 0
+
+        # Every entry carries a monotonically increasing LSN; the checkpoint records the
+        # highest LSN whose effects are already in the bucket files
+        self.last_lsn = last_lsn(wal_dir, 'operation')
+        self.last_position = None
+        self.transaction_start_lsn = None
+        self.transaction_start_position = None
+        self._segment_last_lsn = {}
+        # Guards the segment handle and LSN counters so several threads can log at once
+        self.lock = threading.RLock()
+        # token -> (first LSN, position before it) for entries whose changes are still being applied
+        self._applying = {}
+        # One checkpoint at a time, from choosing its LSN to truncating the segments it covers
+        self._checkpoint_lock = threading.Lock()
+        self.wal_file = None
+        self._open_wal_file()
+
+    def add_listener(self, callback):
+        # callback(event) is called on 'end_transaction', 'clear' (before files are removed) and 'process'
+        self.listeners.append(callback)
+
+    def _notify(self, event):
+        for callback in self.listeners:
+            callback(event)
 
     def get_current_wal_file(self):
         wal_file_path = os.path.join(self.wal_dir, f'wal_{self.wal_file_counter}.wal')
@@ -21,46 +103,231 @@ class WriteAheadLog:
             open(wal_file_path, 'a').close()  # Create an empty file if it does not exist
         return wal_file_path
 
+    def _open_wal_file(self):
+        # A segment holds one record format, so skip past segments written in the other one
+        while segment_format(os.path.join(self.wal_dir, f'wal_{self.wal_file_counter}.wal')) not in (
+                None, self.record_format):
+            self.wal_file_counter += 1
+        # The handle stays open between entries and is only swapped on rotation
+        self.wal_file = open_segment(self.get_current_wal_file(), self.record_format, self.buffer_size)
+
+    def _close_wal_file(self):
+        if self.wal_file is not None and not self.wal_file.closed:
+            self.sync(fsync=self.durability != 'none')
+            self.wal_file.close()
+
+    def sync(self, fsync=True):
+        """Push buffered entries to the OS and, by default, to disk."""
+        with self.lock:
+            if self.wal_file.closed:
+                return
+            self.wal_file.flush()
+            if fsync:
+                os.fsync(self.wal_file.fileno())
+
+    def close(self):
+        with self.lock:
+            self._close_wal_file()
+
     def rotate_wal_file(self):
-        self.wal_counter = 0
-        self.wal_file_counter += 1
+        with self.lock:
+            self._close_wal_file()
+            self.wal_counter = 0
+            self.wal_file_counter += 1
+            self._open_wal_file()
+
+    def hold(self, lsn=None):
+        """Keep checkpoints before ``lsn`` (default: the next entry) until ``release(token)``."""
+        token = object()
+        with self.lock:
+            if lsn is None:
+                self._applying[token] = (self.last_lsn + 1, self.last_position)
+            else:
+                self._applying[token] = (lsn, None)
+        return token
+
+    def release(self, token):
+        with self.lock:
+            del self._applying[token]
+
+    @contextmanager
+    def applying(self):
+        """Keep checkpoints from covering entries logged inside the block.
+
+        Wrap logging an operation and applying it to the buckets in this, so a checkpoint
+        taken by another thread in between cannot mark the entry as persisted before its
+        change is.
+        """
+        token = self.hold()
+        try:
+            yield
+        finally:
+            self.release(token)
 
     def log_to_wal(self, operation, data, is_rollback=False):
+        self._log_entries([(operation, data, is_rollback)])
+
+    def _log_entries(self, items):
+        with self.lock:
+            self._write_entries(items)
+
+    def _write_entries(self, items):
+        # Writes (operation, data, is_rollback) items with one write per segment and one sync at the end
         timestamp = datetime.datetime.now().isoformat()
-        wal_entry = {'timestamp': timestamp, 'operation': operation, 'data': data, 'is_rollback': is_rollback}
-        wal_file_path = self.get_current_wal_file()
-        with open(wal_file_path, 'a') as wal_file:
-            wal_file.write(json.dumps(wal_entry) + '\n')
-        self.wal_counter += 1
-        if self.wal_counter >= self.max_wal_operations:
-            self.rotate_wal_file()
+        while items:
+            chunk = items[:self.max_wal_operations - self.wal_counter]
+            items = items[len(chunk):]
+            payload = []
+            for operation, data, is_rollback in chunk:
+                self.last_lsn += 1
+                wal_entry = {'timestamp': timestamp, 'operation': operation, 'data': data,
+                             'is_rollback': is_rollback, 'lsn': self.last_lsn}
+                payload.append(encode_entry(wal_entry, 'operation', self.record_format))
+            self.wal_file.write(b''.join(payload))
+            self.last_position = (self.wal_file_counter, self.wal_file.tell())
+            self.wal_counter += len(chunk)
+            if self.wal_counter >= self.max_wal_operations:
+                self.rotate_wal_file()
+        if self.durability == 'flush':
+            self.sync(fsync=False)
+        elif self.durability == 'fsync':
+            self.sync()
+        elif self.durability == 'fsync_transaction' and (operation == 'end_transaction' or not self.in_transaction):
+            self.sync()
 
     def start_transaction(self):
-        self.current_transaction = []
-        self.log_to_wal('start_transaction', {}, is_rollback=False)
+        with self.lock:
+            self.current_transaction = []
+            self.in_transaction = True
+            self.transaction_start_lsn = self.last_lsn + 1
+            self.transaction_start_position = self.last_position
+            self.log_to_wal('start_transaction', {}, is_rollback=False)
 
     def end_transaction(self):
-        self.log_to_wal('end_transaction', {}, is_rollback=False)
-        self.current_transaction = []
+        with self.lock:
+            self.in_transaction = False
+            self.log_to_wal('end_transaction', {}, is_rollback=False)
+            self.current_transaction = []
+        self._notify('end_transaction')
 
     def log_operation(self, operation, data, is_rollback=False):
-        self.log_to_wal(operation, data, is_rollback)
-        if not is_rollback:
-            self.current_transaction.append({'operation': operation, 'data': data})
+        """Log one operation and return its LSN."""
+        with self.lock:
+            self.log_to_wal(operation, data, is_rollback)
+            if not is_rollback:
+                self.current_transaction.append({'operation': operation, 'data': data})
+            return self.last_lsn
+
+    def log_operations(self, operations):
+        """Log a batch of (operation, data) pairs with a single write and at most one sync."""
+        if not operations:
+            return
+        with self.lock:
+            self._log_entries([(operation, data, False) for operation, data in operations])
+            self.current_transaction.extend({'operation': operation, 'data': data}
+                                            for operation, data in operations)
+
+    def log_transaction(self, operations):
+        """Log (operation, data) pairs as one self-contained committed transaction.
+
+        Unlike start_transaction/end_transaction this does not touch the shared transaction
+        state, so threads can commit batches concurrently. Listeners are not notified; the
+        caller flushes once its changes are applied.
+        """
+        self._log_entries([('start_transaction', {}, False)]
+                          + [(operation, data, False) for operation, data in operations]
+                          + [('end_transaction', {}, False)])
+
+    def checkpoint(self, lsn=None, sync_files=None):
+        """Record that every entry up to ``lsn`` is reflected in the bucket files.
+
+        Defaults to the last entry logged, or to just before the open transaction or the
+        oldest entry still inside ``applying()``, so a checkpoint never covers a change that
+        is not in the bucket files yet. Segments the checkpoint fully covers are deleted.
+
+        ``sync_files`` is called after the LSN is chosen and before the checkpoint is written,
+        to make the changes it covers durable. Below the FSYNC_LEVELS the WAL is only flushed.
+        """
+        with self._checkpoint_lock:
+            self._checkpoint(lsn, sync_files)
+
+    def _checkpoint(self, lsn, sync_files):
+        with self.lock:
+            position = None
+            if lsn is None:
+                lsn, position = self.last_lsn, self.last_position
+                held_back = list(self._applying.values())
+                if self.in_transaction:
+                    held_back.append((self.transaction_start_lsn, self.transaction_start_position))
+                if held_back:
+                    first_lsn, position = min(held_back, key=lambda item: item[0])
+                    lsn = first_lsn - 1
+            if self.durability in FSYNC_LEVELS:
+                self.sync()
+            else:
+                self.sync(fsync=False)
+                # A power failure may cut the segment short of this position, and entries logged
+                # after the restart would then sit before it, so recovery finds them by LSN instead
+                position = None
+        if sync_files is not None:
+            sync_files()
+        with self.lock:
+            write_checkpoint(self.wal_dir, lsn, position)
+            for wal_file in truncate_segments(self.wal_dir, 'operation', lsn, self.wal_file_counter,
+                                              self._segment_last_lsn):
+                print(f"Deleted checkpointed WAL file: {wal_file}")
+
+    def read_checkpoint(self):
+        return read_checkpoint(self.wal_dir)
+
+    def iter_entries(self, start_position=None, after_lsn=0):
+        """Yield (position, entry) for every WAL entry, streaming one file at a time.
+
+        ``position`` is (file_index, offset) just past the entry and can be passed back as
+        ``start_position`` to resume after it. Entries with an LSN at or below ``after_lsn``
+        are skipped.
+        """
+        self.sync(fsync=False)
+        start_index, start_offset = start_position if start_position else (-1, 0)
+        for file_index, wal_file in segment_files(self.wal_dir):
+            if file_index < start_index:
+                continue
+            offset = start_offset if file_index == start_index else 0
+            for end_offset, entry in iter_entries(os.path.join(self.wal_dir, wal_file), 'operation', offset):
+                if after_lsn and entry.get('lsn', 0) <= after_lsn:
+                    continue
+                yield (file_index, end_offset), entry
+
+    def iter_transactions(self, start_position=None, after_lsn=0):
+        """Yield (position, operations) for each committed transaction, one at a time."""
+        operations = []
+        for position, entry in self.iter_entries(start_position, after_lsn):
+            if entry['operation'] == 'start_transaction':
+                operations = []
+            elif entry['operation'] == 'end_transaction':
+                yield position, operations
+                operations = []
+            else:
+                operations.append(entry)
 
     def load_wal(self):
-        wal_files = sorted([f for f in os.listdir(self.wal_dir) if f.endswith('.wal')])
-        transactions = []
-        for wal_file in wal_files:
-            with open(os.path.join(self.wal_dir, wal_file), 'r') as file:
-                for line in file:
-                    transactions.append(json.loads(line.strip()))
-        return transactions
+        return [entry for _, entry in self.iter_entries()]
 
     def clear_wal(self):
-        wal_files = [f for f in os.listdir(self.wal_dir) if f.endswith('.wal')]
-        for wal_file in wal_files:
-            os.remove(os.path.join(self.wal_dir, wal_file))
+        self._notify('clear')
+        with self.lock:
+            self._close_wal_file()
+            wal_files = [f for f in os.listdir(self.wal_dir) if f.endswith('.wal')]
+            for wal_file in wal_files:
+                os.remove(os.path.join(self.wal_dir, wal_file))
+            self.in_transaction = False
+            self.current_transaction = []
+            self._segment_last_lsn.clear()
+            # Start a fresh segment number so the checkpoint's file position can never point into it
+            self.wal_counter = 0
+            self.wal_file_counter += 1
+            write_checkpoint(self.wal_dir, self.last_lsn)
+            self._open_wal_file()
 
     def rollback_transaction(self, entry, crud):
         operation = entry['operation']
@@ -73,199 +340,1215 @@ class WriteAheadLog:
         elif operation == 'delete':
             crud.create_record(data, rollback=True)
 
+    def redo_operation(self, entry, crud):
+        operation = entry['operation']
+        data = entry['data']
+        if operation == 'create':
+            crud.create_record(data, rollback=True)
+        elif operation == 'update':
+            crud.update_record(data['SSN'], data['new_data'], rollback=True)
+        elif operation == 'delete':
+            crud.delete_record(data['SSN'], rollback=True)
+        elif operation == 'move':
+            crud.redo_move(data)
+
     def process_wal(self, crud):
-        wal_files = sorted([f for f in os.listdir(self.wal_dir) if f.startswith('wal_')])
-        for wal_file in wal_files:
-            wal_file_path = os.path.join(self.wal_dir, wal_file)
-            with open(wal_file_path, 'r') as file:
-                for line in file:
-                    entry = json.loads(line.strip())
-                    operation = entry['operation']
-                    data = entry['data']
-                    if operation == 'create':
-                        crud.delete_record(data['SSN'], rollback=True)
-                    elif operation == 'update':
-                        crud.update_record(data['SSN'], data['old_data'], rollback=True)
-                    elif operation == 'delete':
-                        crud.create_record(data, rollback=True)
-            os.remove(wal_file_path)
+        """Recover the buckets from the entries logged after the last checkpoint.
+
+        Committed transactions and operations logged outside a transaction are redone,
+        which is a no-op for changes that already reached the bucket files. Transactions
+        that never reached end_transaction are undone.
+        """
+        self._notify('process')
+        checkpoint = self.read_checkpoint()
+        open_transaction = None
+        for _, entry in self.iter_entries(checkpoint['position'], checkpoint['lsn']):
+            operation = entry['operation']
+            if entry.get('is_rollback'):
+                continue
+            if operation == 'move':
+                # Rebalancing logs outside any transaction, so a move is never undone with one
+                self.redo_operation(entry, crud)
+            elif operation == 'start_transaction':
+                for pending in reversed(open_transaction or []):
+                    self.rollback_transaction(pending, crud)
+                open_transaction = []
+            elif operation == 'end_transaction':
+                for pending in open_transaction or []:
+                    self.redo_operation(pending, crud)
+                open_transaction = None
+            elif open_transaction is not None:
+                open_transaction.append(entry)
+            else:
+                self.redo_operation(entry, crud)
+        for pending in reversed(open_transaction or []):
+            self.rollback_transaction(pending, crud)
+        # Writes back any buckets recovery touched and checkpoints past the replayed tail
+        crud.flush()
 
 
 class CRUDOperations:
-    def __init__(self, buckets_dir='./buckets_v5', wal=None):
+    def __init__(self, buckets_dir='./buckets_v5', wal=None, cache_max_bytes=256 * 1024 * 1024,
+                 write_mode='write-through', max_delta_files=16, max_delta_bytes=4 * 1024 * 1024,
+                 background_compaction=True, hash_scheme=None, num_buckets=None,
+                 memtable_max_bytes=64 * 1024 * 1024, bloom_filters=False, storage=None):
+        if write_mode not in WRITE_MODES:
+            raise ValueError(f"Unknown write mode {write_mode!r}, expected one of {WRITE_MODES}")
+        if hash_scheme is not None and hash_scheme not in HASH_SCHEMES:
+            raise ValueError(f"Unknown hash scheme {hash_scheme!r}, expected one of {HASH_SCHEMES}")
+        if isinstance(storage, str) and storage not in STORAGE_BACKENDS:
+            raise ValueError(f"Unknown storage {storage!r}, expected one of {STORAGE_BACKENDS}")
         self.buckets_dir = buckets_dir
         self.wal = wal
+        self.write_mode = write_mode
         os.makedirs(buckets_dir, exist_ok=True)
+        # Bucket files written or removed since the last checkpoint; flush() fsyncs them first
+        self._unsynced_paths = set()
+        self._unsynced_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
 
-    def hash_index_to_bucket(self, ssn, num_buckets=1000):
-        hash_object = hashlib.md5(str(ssn).encode())
-        bucket = int(hash_object.hexdigest(), 16) % num_buckets
-        return bucket
+        # The hash scheme, bucket count and storage format live in layout.json, together with the
+        # progress of an unfinished rebalance; directories written before it existed default to
+        # md5 over 1000 parquet buckets
+        storage_name = getattr(storage, 'name', storage)
+        layout = self._read_layout()
+        for key, value in (('hash_scheme', hash_scheme), ('num_buckets', num_buckets), ('storage', storage_name)):
+            if value is not None and layout is not None and layout.get(key, 'parquet') != value:
+                raise ValueError(f"{buckets_dir} was written with {key}={layout.get(key, 'parquet')!r}, not {value!r}")
+        if layout is None:
+            layout = {'hash_scheme': hash_scheme or 'md5', 'num_buckets': num_buckets or 1000}
+        self.hash_scheme = layout['hash_scheme']
+        self.num_buckets = layout['num_buckets']
+        # Reads and writes of the bucket base and delta files; see bucket_storage
+        self.storage = make_storage(storage or layout.get('storage', 'parquet'), bloom_filter=bloom_filters)
+        # {'num_buckets': target, 'done': old buckets already moved} while a rebalance is running
+        self._migration = None
+        if layout.get('rebalance'):
+            self._migration = {'num_buckets': layout['rebalance']['num_buckets'],
+                               'done': set(layout['rebalance']['done'])}
+        # Bumped whenever a bucket finishes moving, so writers can tell their routing went stale
+        self._routing_version = 0
+        self._rebalance_lock = threading.Lock()
+        self._write_layout()
 
-    def update_secondary_index(self, index_file_path, record, index_key, old_value=None, remove=False):
-        if os.path.exists(index_file_path):
-            with open(index_file_path, 'r') as f:
-                index_data = json.load(f)
+        # Decoded buckets and their indexes; write-back mode defers disk writes until eviction,
+        # flush() or the end of the current WAL transaction
+        self.cache = BucketCache(cache_max_bytes, flush_callback=self._flush_bucket)
+        # In memtable mode single-record writes land here after being logged; reads check it
+        # first, and it is written to the buckets as deltas once it passes memtable_max_bytes.
+        # _memtable_hold keeps WAL checkpoints from passing its oldest entry
+        self.memtable = Memtable() if write_mode == 'memtable' else None
+        self.memtable_max_bytes = memtable_max_bytes
+        self._memtable_hold = None
+        self._memtable_lock = threading.Lock()
+        self._memtable_flush_lock = threading.Lock()
+        if wal is not None:
+            wal.add_listener(self._on_wal_event)
+
+        # Writes append small delta/tombstone files next to each bucket; compaction folds them
+        # into the base file once a bucket has more than max_delta_files or max_delta_bytes
+        self.max_delta_files = max_delta_files
+        self.max_delta_bytes = max_delta_bytes
+        # Write a parquet bloom filter on SSN into compacted base files (parquet storage only)
+        self.bloom_filters = bloom_filters
+        self._files_lock = threading.Lock()
+        # Writers take a bucket's write lock for the whole log-modify-store sequence; readers
+        # only need it while loading a bucket from disk and otherwise read immutable snapshots
+        self.bucket_locks = BucketLocks()
+        # bucket -> (mtime, BitmapIndex) for bitmap files already read by count()
+        self._bitmap_files = {}
+        # bucket -> BloomFilter of every SSN in the bucket's files, so lookups of absent SSNs in
+        # buckets that are not cached skip the files. Saved as bloom_{n}.npz on compaction
+        self._blooms = {}
+        # index file prefix -> (length, records) of its log, as last appended to by _append_postings
+        self._index_logs = {}
+        self._compaction_queue = None
+        if background_compaction:
+            self._compaction_queue = queue.Queue()
+            self._queued_compactions = set()
+            threading.Thread(target=self._compaction_loop, daemon=True, name='bucket-compaction').start()
+
+    def hash_index_to_bucket(self, ssn, num_buckets=None):
+        if num_buckets is None:
+            # During a rebalance keys of buckets already moved route with the new bucket count
+            migration = self._migration
+            bucket = self.hash_index_to_bucket(ssn, self.num_buckets)
+            if migration is not None and bucket in migration['done']:
+                bucket = self.hash_index_to_bucket(ssn, migration['num_buckets'])
+            return bucket
+        if self.hash_scheme == 'md5':
+            return hash_index_to_bucket(ssn, num_buckets)
+        if self.hash_scheme == 'jump':
+            return jump_bucket(ssn, num_buckets)
+        return int(bucket_ids([ssn], num_buckets, self.hash_scheme)[0])
+
+    def _layout_file_path(self):
+        return os.path.join(self.buckets_dir, LAYOUT_FILE)
+
+    def _read_layout(self):
+        if not os.path.exists(self._layout_file_path()):
+            return None
+        with open(self._layout_file_path()) as f:
+            return json.load(f)
+
+    def _write_layout(self):
+        layout = {'hash_scheme': self.hash_scheme, 'num_buckets': self.num_buckets, 'storage': self.storage.name}
+        migration = self._migration
+        if migration is not None:
+            layout['rebalance'] = {'num_buckets': migration['num_buckets'], 'done': sorted(migration['done'])}
+        tmp_path = self._layout_file_path() + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(layout, f)
+        os.replace(tmp_path, self._layout_file_path())
+        self._written(self._layout_file_path())
+
+    def _bucket_file_path(self, bucket):
+        return os.path.join(self.buckets_dir, f'bucket_{bucket}{self.storage.extension}')
+
+    def _index_file_path(self, bucket, index_key):
+        # Prefix of the .npz base and .log files of a PostingIndex
+        return os.path.join(self.buckets_dir, f'{index_key.lower()}_index_{bucket}')
+
+    def _bitmap_file_path(self, bucket):
+        return os.path.join(self.buckets_dir, f'bitmap_{bucket}.npz')
+
+    def _bloom_file_path(self, bucket):
+        return os.path.join(self.buckets_dir, f'bloom_{bucket}.npz')
+
+    def _delta_dir_path(self, bucket):
+        return os.path.join(self.buckets_dir, f'bucket_{bucket}_deltas')
+
+    def _written(self, *paths):
+        with self._unsynced_lock:
+            self._unsynced_paths.update(paths)
+
+    def _sync_files(self):
+        # Everything written before the checkpoint's LSN was chosen has to be on disk before the
+        # WAL stops covering it; below the FSYNC_LEVELS the OS is trusted with them instead
+        with self._sync_lock:
+            with self._unsynced_lock:
+                paths, self._unsynced_paths = self._unsynced_paths, set()
+            if self.wal is None or self.wal.durability not in FSYNC_LEVELS:
+                return
+            try:
+                fsync_files(paths)
+            except OSError:
+                # Kept for the next checkpoint, which must not pass them until they are synced
+                with self._unsynced_lock:
+                    self._unsynced_paths |= paths
+                raise
+
+    def _delta_files(self, bucket):
+        # [(sequence, path)] for the bucket's delta files, oldest first
+        delta_dir_path = self._delta_dir_path(bucket)
+        if not os.path.isdir(delta_dir_path):
+            return []
+        return sorted((int(f.split('.')[0]), os.path.join(delta_dir_path, f))
+                      for f in os.listdir(delta_dir_path) if f.endswith(self.storage.extension))
+
+    def _read_bucket_files(self, bucket):
+        # Base file merged with its deltas; returns (DataFrame or None, delta files read)
+        bucket_file_path = self._bucket_file_path(bucket)
+        bucket_df = self.storage.read(bucket_file_path) if os.path.exists(bucket_file_path) else None
+        delta_files = self._delta_files(bucket)
+        if delta_files:
+            deltas = pd.concat([self.storage.read(path) for _, path in delta_files])
+            # Only the newest change to each SSN matters
+            deltas = deltas[~deltas.index.duplicated(keep='last')]
+            upserts = deltas[~deltas['_deleted']].drop(columns='_deleted')
+            if bucket_df is None:
+                bucket_df = upserts
+            else:
+                bucket_df = pd.concat([bucket_df.drop(index=bucket_df.index.intersection(deltas.index)), upserts])
+            bucket_df = bucket_df.sort_index()
+        return bucket_df, delta_files
+
+    def _write_delta(self, bucket, changes):
+        rows = [dict(record, _deleted=False) if record is not None else {'SSN': ssn, '_deleted': True}
+                for ssn, record in changes.items()]
+        delta_df = pd.DataFrame(rows).set_index('SSN', drop=False)
+        with self._files_lock:
+            delta_files = self._delta_files(bucket)
+            sequence = delta_files[-1][0] + 1 if delta_files else 0
+            bloom = self._blooms.get(bucket)
+            if bloom is not None:
+                # Before the file is written, so the filter never misses a key that is on disk
+                bloom.add_many(ssn for ssn, record in changes.items() if record is not None)
+                bloom.meta['sequence'] = sequence
+            os.makedirs(self._delta_dir_path(bucket), exist_ok=True)
+            delta_file_path = os.path.join(self._delta_dir_path(bucket), f'{sequence:08d}{self.storage.extension}')
+            self.storage.write_delta(delta_df, delta_file_path)
+            self._written(delta_file_path)
+            delta_files.append((sequence, None))
+            needs_compaction = len(delta_files) > self.max_delta_files or sum(
+                os.path.getsize(path) for _, path in delta_files if path) > self.max_delta_bytes
+        if needs_compaction:
+            if self._compaction_queue is None:
+                self.compact_bucket(bucket)
+            elif bucket not in self._queued_compactions:
+                self._queued_compactions.add(bucket)
+                self._compaction_queue.put(bucket)
+
+    def compact_bucket(self, bucket):
+        """Fold a bucket's delta files into its base file."""
+        with self._files_lock:
+            bucket_df, delta_files = self._read_bucket_files(bucket)
+        if not delta_files:
+            return
+        # Encode outside the lock so writers can keep appending newer deltas meanwhile
+        bucket_file_path = self._bucket_file_path(bucket)
+        tmp_path = bucket_file_path + '.tmp'
+        self.storage.write(bucket_df, tmp_path)
+        with self._files_lock:
+            os.replace(tmp_path, bucket_file_path)
+            for _, path in delta_files:
+                os.remove(path)
+            # Written after the base so its newer mtime marks it as matching the base
+            BitmapIndex.from_frame(bucket_df, INDEX_COLUMNS).save(self._bitmap_file_path(bucket))
+            self._written(bucket_file_path, self._bitmap_file_path(bucket), *(path for _, path in delta_files))
+            # Rebuilt rather than carried over, which also drops the SSNs deleted since the last one
+            self._blooms[bucket] = self._open_bloom(bucket, bucket_df.index)
+        print(f"Compacted {len(delta_files)} delta files into bucket {bucket}")
+
+    def _bloom(self, bucket):
+        bloom = self._blooms.get(bucket)
+        if bloom is None:
+            with self._files_lock:
+                bloom = self._blooms.get(bucket)
+                if bloom is None:
+                    bloom = self._blooms[bucket] = self._open_bloom(bucket)
+        return bloom
+
+    def _open_bloom(self, bucket, base_ssns=None):
+        # Called with _files_lock held. The saved filter records the base file it was built from
+        # and the last delta file it covers; newer delta files are added to it on load
+        bloom_file_path = self._bloom_file_path(bucket)
+        bucket_file_path = self._bucket_file_path(bucket)
+        base_version = file_version(bucket_file_path)
+        bloom = None
+        if base_ssns is None and os.path.exists(bloom_file_path):
+            bloom = BloomFilter.load(bloom_file_path)
+            if bloom.meta.get('base') != base_version:
+                bloom = None
+        if bloom is None:
+            if base_ssns is None:
+                base_ssns = self.storage.read_ssns(bucket_file_path) if base_version is not None else []
+            bloom = BloomFilter.from_keys(base_ssns, meta={'base': base_version, 'sequence': -1})
+            if base_version is not None:
+                bloom.save(bloom_file_path)
+                self._written(bloom_file_path)
+        for sequence, path in self._delta_files(bucket):
+            if sequence > bloom.meta['sequence']:
+                bloom.add_many(self.storage.read_ssns(path))
+                bloom.meta['sequence'] = sequence
+        return bloom
+
+    def _compaction_loop(self):
+        while True:
+            bucket = self._compaction_queue.get()
+            self._queued_compactions.discard(bucket)
+            try:
+                self.compact_bucket(bucket)
+            except Exception as e:
+                print(f"Compaction of bucket {bucket} failed: {e}")
+            finally:
+                self._compaction_queue.task_done()
+
+    def wait_for_compactions(self):
+        if self._compaction_queue is not None:
+            self._compaction_queue.join()
+
+    def _load_bucket(self, bucket):
+        cached = self.cache.get(bucket)
+        if cached is None:
+            # The read lock keeps writers out while the files are read; another reader may have
+            # loaded the bucket in the meantime, in which case its copy is used
+            with self.bucket_locks.read(bucket):
+                cached = self.cache.peek(bucket)
+                if cached is None:
+                    with self._files_lock:
+                        bucket_df, _ = self._read_bucket_files(bucket)
+                    indexes = {index_key: PostingIndex.load(self._index_file_path(bucket, index_key))
+                               for index_key in INDEX_COLUMNS}
+                    cached = self.cache.setdefault(bucket, CachedBucket(bucket_df, indexes))
+        return cached
+
+    def _applying(self):
+        return self.wal.applying() if self.wal is not None else nullcontext()
+
+    @contextmanager
+    def _writing(self, route):
+        # Write-locks the buckets route() returns and holds back checkpoints until their changes
+        # are stored. Yields route()'s result. A rebalance may move keys while we wait for the
+        # locks, in which case the route is worked out again and the locks retaken
+        while True:
+            routing_version = self._routing_version
+            routed = route()
+            buckets = sorted(set(int(bucket) for bucket in routed))
+            with self.bucket_locks.write_many(buckets):
+                if routing_version != self._routing_version:
+                    rerouted = route()
+                    if sorted(set(int(bucket) for bucket in rerouted)) != buckets:
+                        continue
+                    routed = rerouted
+                states = {bucket: self._cached_state(bucket) for bucket in buckets}
+                with self._applying():
+                    try:
+                        yield routed
+                    except Exception:
+                        # Undo half-updated cached copies while other writers are still locked out
+                        for bucket in buckets:
+                            self._restore_cached(bucket, states[bucket])
+                        raise
+                return
+
+    def _cached_state(self, bucket):
+        # What _restore_cached needs to undo a write to a cached bucket holding unflushed changes
+        cached = self.cache.peek(bucket)
+        if cached is None or not cached.dirty:
+            return None
+        with cached.lock:
+            return (cached, cached.df, cached.pending, dict(cached.pending), set(cached.dirty),
+                    {index_key: index_data.mark() for index_key, index_data in cached.indexes.items()})
+
+    def _restore_cached(self, bucket, state):
+        # A write-back bucket can hold earlier changes that only the WAL has, so a failed write is
+        # undone on the cached copy instead of dropping it. Without such changes, or once the copy
+        # has been flushed or evicted since, it is dropped and read again from the files
+        cached = self.cache.peek(bucket)
+        if state is not None and cached is state[0]:
+            _, df, pending, pending_items, dirty, marks = state
+            with cached.lock:
+                if cached.pending is pending and all(cached.indexes[index_key].mark()[0] is mark[0]
+                                                     for index_key, mark in marks.items()):
+                    for index_key, mark in marks.items():
+                        cached.indexes[index_key].undo(mark)
+                    cached.df = df
+                    pending.clear()
+                    pending.update(pending_items)
+                    cached.dirty = dirty
+                    return
+        self.cache.invalidate(bucket)
+
+    def _store_bucket(self, bucket, cached, parts):
+        with cached.lock:
+            cached.dirty.update(parts)
+            # In memtable mode buckets are only written when the memtable drains, so write through
+            if self.write_mode != 'write-back':
+                self._flush_bucket(bucket, cached)
+        # Never put while holding cached.lock: eviction flushes other buckets under the cache lock
+        self.cache.put(bucket, cached)
+
+    def _flush_bucket(self, bucket, cached):
+        with cached.lock:
+            if 'data' in cached.dirty and cached.pending:
+                self._write_delta(bucket, cached.pending)
+                cached.pending = {}
+            for index_key in INDEX_COLUMNS:
+                if index_key in cached.dirty:
+                    index_file_path = self._index_file_path(bucket, index_key)
+                    cached.indexes[index_key].save(index_file_path)
+                    self._written(index_file_path + '.npz', index_file_path + '.log')
+            cached.dirty.clear()
+
+    def flush(self):
+        """Write the memtable and every dirty cached bucket back to disk and checkpoint the WAL."""
+        self.flush_memtable()
+        self._flush_cache()
+
+    def _flush_cache(self):
+        # The memtable's hold keeps the checkpoint from passing entries it still has
+        for bucket, cached in self.cache.dirty_entries():
+            self._flush_bucket(bucket, cached)
+        if self.wal is not None:
+            self.wal.checkpoint(sync_files=self._sync_files)
         else:
-            index_data = {}
+            self._sync_files()
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def _on_wal_event(self, event):
+        if event == 'end_transaction' and self.memtable is not None:
+            # The memtable's hold keeps the WAL covering it, so commits do not have to flush
+            return
+        if event in ('end_transaction', 'clear'):
+            # Anything the WAL is about to stop covering has to be on disk first
+            self.flush()
+        elif event == 'process':
+            # Recovery rewrites buckets from the log, so cached copies may be stale; the
+            # memtable's entries are all after the checkpoint and get replayed into it again
+            self.cache.invalidate()
+            if self.memtable is not None:
+                with self._memtable_lock:
+                    self.memtable.clear()
+                    self._release_memtable_hold()
+
+    def _current_record(self, bucket, ssn):
+        # The record as writers see it: the memtable first, then the bucket
+        found, record = self.memtable.get(ssn)
+        if found:
+            return record
+        if self.cache.peek(bucket) is None and not self._bloom(bucket).might_contain(ssn):
+            return None
+        bucket_df = self._load_bucket(bucket).df
+        if bucket_df is not None and ssn in bucket_df.index:
+            return {'SSN': ssn, **bucket_df.loc[ssn].to_dict()}
+        return None
+
+    def _memtable_put(self, bucket, ssn, record, lsn, base=None):
+        with self._memtable_lock:
+            self.memtable.put(bucket, ssn, record, lsn, base)
+            if self._memtable_hold is None and self.wal is not None:
+                self._memtable_hold = self.wal.hold(lsn)
+
+    def _release_memtable_hold(self):
+        if self._memtable_hold is not None:
+            self.wal.release(self._memtable_hold)
+            self._memtable_hold = None
 
+    def _maybe_flush_memtable(self):
+        if self.memtable is not None and self.memtable.nbytes >= self.memtable_max_bytes:
+            # One thread drains at a time; the others carry on writing into the memtable
+            if self._memtable_flush_lock.acquire(blocking=False):
+                try:
+                    self.flush_memtable()
+                finally:
+                    self._memtable_flush_lock.release()
+
+    def _drain_memtable_bucket(self, bucket):
+        with self._writing(lambda: [bucket]):
+            entries = self.memtable.bucket_entries(bucket)
+            if not entries:
+                return
+            cached = self._load_bucket(bucket)
+            bucket_df = cached.df if cached.df is not None else pd.DataFrame(columns=['SSN', 'State', 'Occupation'])
+            present = bucket_df.index.intersection(list(entries))
+            records = [record for record in entries.values() if record is not None]
+            removed = {index_key: {} for index_key in INDEX_COLUMNS}
+            added = {index_key: {} for index_key in INDEX_COLUMNS}
+            for old_record in bucket_df.loc[present].to_dict('records'):
+                for index_key in INDEX_COLUMNS:
+                    removed[index_key].setdefault(old_record[index_key], []).append(old_record['SSN'])
+            for record in records:
+                for index_key in INDEX_COLUMNS:
+                    added[index_key].setdefault(record[index_key], []).append(record['SSN'])
+            new_bucket_df = bucket_df.drop(index=present)
+            if records:
+                new_bucket_df = pd.concat([new_bucket_df, pd.DataFrame(records).set_index('SSN', drop=False)]).sort_index()
+            with cached.lock:
+                cached.df = new_bucket_df
+                cached.pending.update(entries)
+                for index_key in INDEX_COLUMNS:
+                    self._apply_index_batch(cached.indexes[index_key], removed[index_key], added[index_key])
+            self._store_bucket(bucket, cached, ('data',) + INDEX_COLUMNS)
+            # Only dropped once the bucket has them, so lock-free readers always find them somewhere
+            self.memtable.remove(entries)
+
+    def flush_memtable(self, buckets=None):
+        """Write the memtable's entries (all, or those of ``buckets``) to the bucket files."""
+        if self.memtable is None:
+            return
+        for bucket in self.memtable.buckets() if buckets is None else buckets:
+            self._drain_memtable_bucket(bucket)
+        # Move the checkpoint hold up to the oldest entry still in the memtable
+        with self._memtable_lock:
+            self._release_memtable_hold()
+            if len(self.memtable) and self.wal is not None:
+                self._memtable_hold = self.wal.hold(self.memtable.min_lsn())
+
+    def apply_index_change(self, index_data, record, index_key, old_value=None, remove=False):
         key_value = record[index_key]
         ssn = record['SSN']
 
         if remove:
-            if old_value in index_data and ssn in index_data[old_value]:
-                index_data[old_value].remove(ssn)
-                if not index_data[old_value]:
-                    del index_data[old_value]
+            index_data.remove(old_value, ssn)
         else:
             if old_value and old_value != key_value:
-                if old_value in index_data and ssn in index_data[old_value]:
-                    index_data[old_value].remove(ssn)
-                    if not index_data[old_value]:
-                        del index_data[old_value]
+                index_data.remove(old_value, ssn)
+            index_data.add(key_value, ssn)
 
-            if key_value not in index_data:
-                index_data[key_value] = []
-            index_data[key_value].append(ssn)
+    def update_secondary_index(self, index_file_path, record, index_key, old_value=None, remove=False):
+        index_data = PostingIndex.load(index_file_path)
+        self.apply_index_change(index_data, record, index_key, old_value=old_value, remove=remove)
+        index_data.save(index_file_path)
+        self._written(index_file_path + '.npz', index_file_path + '.log')
 
-        with open(index_file_path, 'w') as f:
-            json.dump(index_data, f)
+    def _append_postings(self, bucket, record):
+        # Called with the bucket write-locked and not cached. The postings of a new SSN are
+        # appended to the index logs without loading the indexes; a log is folded into its base
+        # once it holds more records than the base, as PostingIndex.save does
+        for index_key in INDEX_COLUMNS:
+            prefix = self._index_file_path(bucket, index_key)
+            log_state = append_log(prefix, [(OP_ADD, record[index_key], ssn_to_int(record['SSN']))],
+                                   self._index_logs.get(prefix))
+            if log_state[1] > COMPACT_MIN_LOG_RECORDS and log_state[1] > base_size(prefix):
+                PostingIndex.load(prefix).compact(prefix)
+                log_state = (0, 0)
+            self._index_logs[prefix] = log_state
+            self._written(prefix + '.npz', prefix + '.log')
 
     def create_record(self, record, rollback=False):
         ssn = record['SSN']
-        bucket = self.hash_index_to_bucket(ssn)
-        bucket_file_path = os.path.join(self.buckets_dir, f'bucket_{bucket}.parquet')
-        state_index_file_path = os.path.join(self.buckets_dir, f'state_index_{bucket}.json')
-        occupation_index_file_path = os.path.join(self.buckets_dir, f'occupation_index_{bucket}.json')
-
-        if not rollback:
-            self.wal.log_operation('create', record)
 
         try:
-            # Load existing data if the file exists
-            if os.path.exists(bucket_file_path):
-                bucket_df = pd.read_parquet(bucket_file_path)
-                print(f"Loaded existing data from {bucket_file_path}:\n{bucket_df}")
-            else:
-                bucket_df = pd.DataFrame(columns=['SSN', 'State', 'Occupation'])
-                print(f"No existing data found, creating new DataFrame")
+            with self._writing(lambda: [self.hash_index_to_bucket(ssn)]) as (bucket,):
+                if self.memtable is not None:
+                    if self._current_record(bucket, ssn) is not None:
+                        print(f"Record with SSN {ssn} already exists.")
+                        return
+                    lsn = None if rollback else self.wal.log_operation('create', record)
+                    self._memtable_put(bucket, ssn, dict(record), lsn)
+                    return
 
-            # Check if the record already exists
-            if ssn in bucket_df.index:
-                print(f"Record with SSN {ssn} already exists.")
-                return
+                if not rollback:
+                    self.wal.log_operation('create', record)
+
+                # A new SSN for a bucket that is not cached is appended without reading the bucket
+                if self.cache.peek(bucket) is None and not self._bloom(bucket).might_contain(ssn):
+                    self._append_postings(bucket, record)
+                    self._write_delta(bucket, {ssn: record})
+                    print(f"Appended record {ssn} to bucket {bucket} without loading it")
+                    return
 
-            # Ensure the new record is in the correct format
-            new_record_df = pd.DataFrame([record])
-            new_record_df.set_index('SSN', inplace=True, drop=False)
-            print(f"New record DataFrame:\n{new_record_df}")
+                # Load existing data if the bucket exists
+                cached = self._load_bucket(bucket)
+                if cached.df is not None:
+                    bucket_df = cached.df
+                    print(f"Loaded existing data for bucket {bucket}:\n{bucket_df}")
+                else:
+                    bucket_df = pd.DataFrame(columns=['SSN', 'State', 'Occupation'])
+                    print(f"No existing data found, creating new DataFrame")
+
+                # Check if the record already exists
+                if ssn in bucket_df.index:
+                    print(f"Record with SSN {ssn} already exists.")
+                    return
 
-            # Concatenate with proper alignment
-            bucket_df = pd.concat([bucket_df, new_record_df])
-            print(f"Concatenated DataFrame:\n{bucket_df}")
+                # Ensure the new record is in the correct format
+                new_record_df = pd.DataFrame([record])
+                new_record_df.set_index('SSN', inplace=True, drop=False)
+                print(f"New record DataFrame:\n{new_record_df}")
 
-            # Save the updated DataFrame back to the Parquet file
-            bucket_df.sort_index(inplace=True)
-            bucket_df.to_parquet(bucket_file_path, index=True)
-            print(f"Saved updated DataFrame to {bucket_file_path}")
+                # Concatenate with proper alignment
+                bucket_df = pd.concat([bucket_df, new_record_df])
+                print(f"Concatenated DataFrame:\n{bucket_df}")
 
-            # Update secondary indexes
-            self.update_secondary_index(state_index_file_path, record, 'State')
-            self.update_secondary_index(occupation_index_file_path, record, 'Occupation')
+                # Store the updated DataFrame and secondary indexes
+                bucket_df.sort_index(inplace=True)
+                with cached.lock:
+                    cached.df = bucket_df
+                    cached.pending[ssn] = record
+                    for index_key in INDEX_COLUMNS:
+                        self.apply_index_change(cached.indexes[index_key], record, index_key)
+                self._store_bucket(bucket, cached, ('data',) + INDEX_COLUMNS)
+                print(f"Stored updated DataFrame for bucket {bucket} ({self.write_mode})")
         except Exception as e:
             print(f"Create operation failed: {e}")
             if not rollback:
                 for entry in reversed(self.wal.current_transaction):
                     self.wal.rollback_transaction(entry, self)
                 self.wal.clear_wal()
+        finally:
+            self._maybe_flush_memtable()
+
+    def read_record(self, ssn, columns=None):
+        """Return the record for ``ssn``, or only SSN plus ``columns``, or None if it does not exist.
+
+        A bucket that is not cached is not loaded: the lookup reads just the row group of the
+        base file that can hold the SSN, and the bucket's small delta files. SSNs the bucket's
+        Bloom filter has never seen are answered without touching the files at all.
+        """
+        if self.memtable is not None:
+            found, record = self.memtable.get(ssn)
+            if found:
+                if record is None:
+                    print(f"Record with SSN {ssn} not found.")
+                    return None
+                return self._project(record, columns)
 
-    def read_record(self, ssn):
+        routing_version = self._routing_version
         bucket = self.hash_index_to_bucket(ssn)
-        bucket_file_path = os.path.join(self.buckets_dir, f'bucket_{bucket}.parquet')
 
-        if os.path.exists(bucket_file_path):
-            bucket_df = pd.read_parquet(bucket_file_path)
-            if ssn in bucket_df.index:
+        # Writers publish a new DataFrame instead of changing the cached one, so this
+        # reference is a consistent snapshot and needs no lock
+        cached = self.cache.get(bucket)
+        if cached is not None:
+            bucket_df = cached.df
+            if bucket_df is not None and ssn in bucket_df.index:
                 record = bucket_df.loc[ssn].to_dict()
                 record = {'SSN': ssn, **record}  # Ensure SSN is included in the returned record
-                return record
+                return self._project(record, columns)
+        elif self._bloom(bucket).might_contain(ssn):
+            record = self._read_record_files(bucket, ssn, columns)
+            if record is not None:
+                return self._project(record, columns)
+
+        # A rebalance publishes moved records in their new bucket before dropping them from the
+        # old one, so a miss caused by a move shows up as a changed route
+        if routing_version != self._routing_version and self.hash_index_to_bucket(ssn) != bucket:
+            return self.read_record(ssn, columns)
 
         print(f"Record with SSN {ssn} not found.")
         return None
 
-    def update_record(self, ssn, updates, rollback=False):
-        bucket = self.hash_index_to_bucket(ssn)
-        bucket_file_path = os.path.join(self.buckets_dir, f'bucket_{bucket}.parquet')
-        state_index_file_path = os.path.join(self.buckets_dir, f'state_index_{bucket}.json')
-        occupation_index_file_path = os.path.join(self.buckets_dir, f'occupation_index_{bucket}.json')
+    def _project(self, record, columns):
+        if columns is None:
+            return dict(record)
+        return {'SSN': record['SSN'], **{column: record[column] for column in columns}}
 
-        try:
+    def _read_record_files(self, bucket, ssn, columns=None):
+        # Writers hold the bucket's write lock while they change its files; the files lock keeps
+        # compaction from removing the deltas while they are read
+        with self.bucket_locks.read(bucket):
+            with self._files_lock:
+                for _, path in reversed(self._delta_files(bucket)):
+                    record = self.storage.read_row(path, ssn, columns)
+                    if record is not None:
+                        return None if record.pop('_deleted') else record
+            # A base replaced since the deltas were read already contains them
+            bucket_file_path = self._bucket_file_path(bucket)
             if os.path.exists(bucket_file_path):
-                bucket_df = pd.read_parquet(bucket_file_path)
-                print(f"Bucket DataFrame before update:\n{bucket_df}")
-                if ssn in bucket_df.index:
-                    old_record = bucket_df.loc[ssn].to_dict()
+                return self.storage.read_row(bucket_file_path, ssn, columns)
+        return None
+
+    def update_record(self, ssn, updates, rollback=False):
+        try:
+            with self._writing(lambda: [self.hash_index_to_bucket(ssn)]) as (bucket,):
+                if self.memtable is not None:
+                    old_record = self._current_record(bucket, ssn)
+                    if old_record is None:
+                        print(f"Record with SSN {ssn} not found.")
+                        return
                     new_record = {**old_record, **updates}
+                    lsn = None
                     if not rollback:
-                        self.wal.log_operation('update', {'SSN': ssn, 'old_data': old_record, 'new_data': new_record})
+                        lsn = self.wal.log_operation('update', {'SSN': ssn, 'old_data': old_record,
+                                                                'new_data': new_record})
+                    self._memtable_put(bucket, ssn, new_record, lsn, base=old_record)
+                    return
 
-                    # Update the record in the DataFrame
-                    for key, value in updates.items():
-                        bucket_df.at[ssn, key] = value
+                cached = self._load_bucket(bucket)
+                if cached.df is not None:
+                    # Work on a copy; the cached frame may be in use by lock-free readers
+                    bucket_df = cached.df.copy()
+                    print(f"Bucket DataFrame before update:\n{bucket_df}")
+                    if ssn in bucket_df.index:
+                        old_record = bucket_df.loc[ssn].to_dict()
+                        new_record = {**old_record, **updates}
+                        if not rollback:
+                            self.wal.log_operation('update', {'SSN': ssn, 'old_data': old_record,
+                                                              'new_data': new_record})
 
-                    print(f"Bucket DataFrame after update:\n{bucket_df}")
+                        # Update the record in the DataFrame
+                        for key, value in updates.items():
+                            bucket_df.at[ssn, key] = value
 
-                    bucket_df = bucket_df.sort_index()
-                    bucket_df.to_parquet(bucket_file_path, index=True)
+                        print(f"Bucket DataFrame after update:\n{bucket_df}")
 
-                    # Update secondary indexes if necessary
-                    if 'State' in updates:
-                        self.update_secondary_index(state_index_file_path, new_record, 'State',
-                                                    old_value=old_record['State'])
-                    if 'Occupation' in updates:
-                        self.update_secondary_index(occupation_index_file_path, new_record, 'Occupation',
-                                                    old_value=old_record['Occupation'])
+                        # Update secondary indexes if necessary
+                        changed_indexes = tuple(index_key for index_key in INDEX_COLUMNS if index_key in updates)
+                        with cached.lock:
+                            cached.df = bucket_df.sort_index()
+                            cached.pending[ssn] = new_record
+                            for index_key in changed_indexes:
+                                self.apply_index_change(cached.indexes[index_key], new_record, index_key,
+                                                        old_value=old_record[index_key])
+                        self._store_bucket(bucket, cached, ('data',) + changed_indexes)
+                    else:
+                        print(f"Record with SSN {ssn} not found.")
                 else:
-                    print(f"Record with SSN {ssn} not found.")
-            else:
-                print(f"Bucket file for SSN {ssn} not found.")
+                    print(f"Bucket file for SSN {ssn} not found.")
         except Exception as e:
             print(f"Update operation failed: {e}")
             if not rollback:
                 for entry in reversed(self.wal.current_transaction):
                     self.wal.rollback_transaction(entry, self)
                 self.wal.clear_wal()
+        finally:
+            self._maybe_flush_memtable()
 
     def delete_record(self, ssn, rollback=False):
-        bucket = self.hash_index_to_bucket(ssn)
-        bucket_file_path = os.path.join(self.buckets_dir, f'bucket_{bucket}.parquet')
-        state_index_file_path = os.path.join(self.buckets_dir, f'state_index_{bucket}.json')
-        occupation_index_file_path = os.path.join(self.buckets_dir, f'occupation_index_{bucket}.json')
-
         try:
-            if os.path.exists(bucket_file_path):
-                bucket_df = pd.read_parquet(bucket_file_path)
-                if ssn in bucket_df.index:
-                    old_record = bucket_df.loc[ssn].to_dict()
+            with self._writing(lambda: [self.hash_index_to_bucket(ssn)]) as (bucket,):
+                if self.memtable is not None:
+                    old_record = self._current_record(bucket, ssn)
+                    if old_record is None:
+                        print(f"Record with SSN {ssn} not found.")
+                        return
+                    lsn = self.wal.log_operation('delete', old_record, is_rollback=rollback)
+                    self._memtable_put(bucket, ssn, None, lsn, base=old_record)
+                    return
 
-                    self.wal.log_operation('delete', old_record, is_rollback=rollback)
+                cached = self._load_bucket(bucket)
+                if cached.df is not None:
+                    bucket_df = cached.df
+                    if ssn in bucket_df.index:
+                        old_record = bucket_df.loc[ssn].to_dict()
 
-                    bucket_df = bucket_df.drop(index=ssn)
-                    bucket_df.to_parquet(bucket_file_path, index=True)
+                        self.wal.log_operation('delete', old_record, is_rollback=rollback)
 
-                    self.update_secondary_index(state_index_file_path, old_record, 'State', remove=True)
-                    self.update_secondary_index(occupation_index_file_path, old_record, 'Occupation', remove=True)
+                        with cached.lock:
+                            cached.df = bucket_df.drop(index=ssn)
+                            cached.pending[ssn] = None
+                            for index_key in INDEX_COLUMNS:
+                                self.apply_index_change(cached.indexes[index_key], old_record, index_key,
+                                                        old_value=old_record[index_key], remove=True)
+                        self._store_bucket(bucket, cached, ('data',) + INDEX_COLUMNS)
+                    else:
+                        print(f"Record with SSN {ssn} not found.")
                 else:
-                    print(f"Record with SSN {ssn} not found.")
-            else:
-                print(f"Bucket file for SSN {ssn} not found.")
+                    print(f"Bucket file for SSN {ssn} not found.")
         except Exception as e:
             print(f"Delete operation failed: {e}")
             if not rollback:
                 for entry in reversed(self.wal.current_transaction):
                     self.wal.rollback_transaction(entry, self)
                 self.wal.clear_wal()
+        finally:
+            self._maybe_flush_memtable()
+
+
+    def _records_frame(self, records, keep):
+        # Normalise a DataFrame or an iterable of record dicts to one row per SSN, indexed by SSN
+        if isinstance(records, pd.DataFrame):
+            records_df = records if 'SSN' in records.columns else records.reset_index()
+        else:
+            records_df = pd.DataFrame(list(records))
+        if records_df.empty:
+            return records_df
+        records_df = records_df.drop_duplicates('SSN', keep=keep)
+        return records_df.set_index('SSN', drop=False)
+
+    def _bucket_ids(self, ssns):
+        migration = self._migration
+        buckets = bucket_ids(ssns, self.num_buckets, self.hash_scheme)
+        if migration is not None and migration['done']:
+            moved = np.isin(buckets, list(migration['done']))
+            if moved.any():
+                buckets[moved] = bucket_ids(np.asarray(ssns, dtype=object)[moved], migration['num_buckets'],
+                                            self.hash_scheme)
+        return buckets
+
+    def create_records(self, records):
+        """Insert many records at once, skipping SSNs that already exist. Returns the number inserted."""
+        return self._bulk_write(self._records_frame(records, keep='first'), 'create')
+
+    def upsert_records(self, records):
+        """Insert new records and update existing ones in bulk. Returns the number of rows written."""
+        return self._bulk_write(self._records_frame(records, keep='last'), 'upsert')
+
+    def delete_records(self, ssns):
+        """Delete many records at once. Accepts SSNs, record dicts or a DataFrame. Returns the number deleted."""
+        if isinstance(ssns, pd.DataFrame):
+            records_df = self._records_frame(ssns, keep='last')
+        else:
+            ssns = [ssn['SSN'] if isinstance(ssn, dict) else ssn for ssn in ssns]
+            records_df = self._records_frame([{'SSN': ssn} for ssn in ssns], keep='last')
+        return self._bulk_write(records_df, 'delete')
+
+    def _plan_bucket_batch(self, bucket, batch_df, mode):
+        # Work out one bucket's changes without touching the cache; returns (plan, WAL operations)
+        cached = self._load_bucket(bucket)
+        bucket_df = cached.df if cached.df is not None else pd.DataFrame(columns=['SSN', 'State', 'Occupation'])
+        exists = batch_df.index.isin(bucket_df.index)
+        operations = []
+        pending = {}
+        removed = {index_key: {} for index_key in INDEX_COLUMNS}
+        added = {index_key: {} for index_key in INDEX_COLUMNS}
+
+        if mode == 'delete':
+            deleted_df = bucket_df.loc[batch_df.index[exists]]
+            for old_record in deleted_df.to_dict('records'):
+                operations.append(('delete', old_record))
+                pending[old_record['SSN']] = None
+                for index_key in INDEX_COLUMNS:
+                    removed[index_key].setdefault(old_record[index_key], []).append(old_record['SSN'])
+            new_bucket_df = bucket_df.drop(index=deleted_df.index)
+        else:
+            created_df = batch_df[~exists]
+            changed_records = []
+            for record in created_df.to_dict('records'):
+                operations.append(('create', record))
+                changed_records.append(record)
+                for index_key in INDEX_COLUMNS:
+                    added[index_key].setdefault(record[index_key], []).append(record['SSN'])
+            updated_index = batch_df.index[exists] if mode == 'upsert' else batch_df.index[:0]
+            old_records = bucket_df.loc[updated_index].to_dict('records') if len(updated_index) else []
+            updates_list = batch_df.loc[updated_index].to_dict('records') if len(updated_index) else []
+            for old_record, updates in zip(old_records, updates_list):
+                new_record = {**old_record, **updates}
+                operations.append(('update', {'SSN': new_record['SSN'], 'old_data': old_record, 'new_data': new_record}))
+                changed_records.append(new_record)
+                for index_key in INDEX_COLUMNS:
+                    if old_record[index_key] != new_record[index_key]:
+                        removed[index_key].setdefault(old_record[index_key], []).append(new_record['SSN'])
+                        added[index_key].setdefault(new_record[index_key], []).append(new_record['SSN'])
+            for record in changed_records:
+                pending[record['SSN']] = record
+            new_bucket_df = bucket_df.drop(index=updated_index)
+            if changed_records:
+                changed_df = pd.DataFrame(changed_records).set_index('SSN', drop=False)
+                new_bucket_df = pd.concat([new_bucket_df, changed_df]).sort_index()
+
+        return (bucket, cached, new_bucket_df, pending, removed, added), operations
+
+    def _apply_index_batch(self, index_data, removed, added):
+        for key_value, ssns in removed.items():
+            for ssn in ssns:
+                index_data.remove(key_value, ssn)
+        for key_value, ssns in added.items():
+            for ssn in ssns:
+                index_data.add(key_value, ssn)
+
+    def _bulk_write(self, records_df, mode):
+        if records_df.empty:
+            return 0
+        # Outside a caller's transaction the batch is logged as its own committed transaction,
+        # so concurrent bulk writes never share the WAL's transaction state
+        own_transaction = not self.wal.in_transaction
+        operations = []
+        logged = False
+        try:
+            with self._writing(lambda: self._bucket_ids(records_df.index)) as row_buckets:
+                batches = [(int(bucket), batch_df) for bucket, batch_df in records_df.groupby(row_buckets)]
+                if self.memtable is not None:
+                    # Bulk writes go straight to the buckets, so fold in what the memtable holds first
+                    for bucket, _ in batches:
+                        self._drain_memtable_bucket(bucket)
+                # Plan every bucket first so the whole batch is logged before any bucket changes
+                plans = []
+                for bucket, batch_df in batches:
+                    plan, bucket_operations = self._plan_bucket_batch(bucket, batch_df, mode)
+                    if bucket_operations:
+                        plans.append(plan)
+                        operations.extend(bucket_operations)
+                if not operations:
+                    return 0
+
+                if own_transaction:
+                    self.wal.log_transaction(operations)
+                else:
+                    self.wal.log_operations(operations)
+                logged = True
+                for bucket, cached, new_bucket_df, pending, removed, added in plans:
+                    with cached.lock:
+                        cached.df = new_bucket_df
+                        cached.pending.update(pending)
+                        for index_key in INDEX_COLUMNS:
+                            self._apply_index_batch(cached.indexes[index_key], removed[index_key],
+                                                    added[index_key])
+                    self._store_bucket(bucket, cached, ('data',) + INDEX_COLUMNS)
+        except Exception as e:
+            if not logged:
+                raise
+            # Roll back outside the bucket locks; undoing takes the locks again one bucket at a time
+            print(f"Bulk {mode} failed: {e}")
+            if own_transaction:
+                entries = [{'operation': operation, 'data': data} for operation, data in operations]
+            else:
+                entries = self.wal.current_transaction
+            for entry in reversed(entries):
+                self.wal.rollback_transaction(entry, self)
+            self.wal.clear_wal()
+            return 0
+        if own_transaction:
+            # Same as the end_transaction listener: write back dirty buckets and checkpoint. The
+            # memtable is left alone; only the buckets this batch touched were drained above
+            self._flush_cache()
+        print(f"Bulk {mode} wrote {len(operations)} records across {len(plans)} buckets")
+        return len(operations)
+
+    def _indexed_buckets(self):
+        buckets = {int(match.group(1)) for match in map(INDEX_FILE_PATTERN.search, os.listdir(self.buckets_dir))
+                   if match}
+        buckets.update(bucket for bucket, _ in self.cache.dirty_entries())
+        return sorted(buckets)
+
+    def _memtable_buckets(self):
+        return set(self.memtable.buckets()) if self.memtable is not None else set()
+
+    def _query_bucket(self, bucket, criteria, in_memtable=False):
+        # Returns (bucket, int SSNs matching in the indexes, {ssn: record} matching in the memtable)
+        if not in_memtable:
+            return bucket, self._query_indexes(bucket, criteria), {}
+        # Write-locked so a drain cannot move entries from the memtable into the indexes between
+        # reading one and the other
+        with self.bucket_locks.write(bucket):
+            matches = self._query_indexes(bucket, criteria)
+            changes = self.memtable.bucket_changes(bucket)
+        matches = set(matches) - {ssn_to_int(ssn) for ssn in changes}
+        records = {ssn: record for ssn, (_, record) in changes.items()
+                   if record is not None and _record_matches(record, criteria)}
+        return bucket, matches, records
+
+    def _query_indexes(self, bucket, criteria):
+        # Cached indexes may hold changes not flushed yet, so they win over the files
+        cached = self.cache.peek(bucket)
+        if cached is not None:
+            indexes, lock = cached.indexes, cached.lock
+        else:
+            with self.bucket_locks.read(bucket):
+                indexes = {index_key: PostingIndex.load(self._index_file_path(bucket, index_key))
+                           for index_key in criteria}
+            lock = nullcontext()
+        matches = None
+        with lock:
+            for index_key, value in sorted(criteria.items(), key=lambda item: item[0] != 'State'):
+                postings = indexes[index_key].get(value)
+                matches = set(postings) if matches is None else matches & postings
+                if not matches:
+                    return set()
+        return matches
+
+    def query(self, state=None, occupation=None, fetch_records=False, max_workers=8):
+        """Find records by State and/or Occupation across every bucket.
 
+        Each bucket's posting lists are intersected in parallel and the per-bucket results
+        gathered. Returns the sorted matching SSNs, or a DataFrame of the full records when
+        ``fetch_records`` is set.
+        """
+        criteria = {index_key: value for index_key, value in zip(INDEX_COLUMNS, (state, occupation))
+                    if value is not None}
+        if not criteria:
+            raise ValueError("query needs at least one of state or occupation")
+        # The indexes only cover what is in the buckets; the memtable's entries are merged in
+        memtable_buckets = self._memtable_buckets()
+        buckets = sorted(set(self._indexed_buckets()) | memtable_buckets)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(lambda bucket: self._query_bucket(bucket, criteria, bucket in memtable_buckets),
+                                    buckets))
+        memtable_records = {ssn: record for _, _, records in results for ssn, record in records.items()}
+
+        if not fetch_records:
+            return sorted({int_to_ssn(ssn) for _, matches, _ in results for ssn in matches} | set(memtable_records))
+        frames = []
+        if memtable_records:
+            # First, so they win over a copy a drain has since written to the bucket
+            frames.append(pd.DataFrame(list(memtable_records.values())).set_index('SSN', drop=False))
+        for bucket, matches, _ in results:
+            bucket_df = self._load_bucket(bucket).df if matches else None
+            if bucket_df is not None:
+                ssns = [int_to_ssn(ssn) for ssn in matches]
+                frames.append(bucket_df.loc[bucket_df.index.intersection(ssns)])
+        if not frames:
+            return pd.DataFrame(columns=['SSN', 'State', 'Occupation'])
+        records_df = pd.concat(frames)
+        return records_df[~records_df.index.duplicated()].sort_index()
+
+    def _bucket_bitmaps(self, bucket):
+        cached = self.cache.peek(bucket)
+        if cached is None:
+            # A saved bitmap is only usable while the base has no deltas and has not been rewritten since
+            bitmap_file_path = self._bitmap_file_path(bucket)
+            bucket_file_path = self._bucket_file_path(bucket)
+            with self._files_lock:
+                if (not self._delta_files(bucket) and os.path.exists(bitmap_file_path)
+                        and os.path.exists(bucket_file_path)
+                        and os.path.getmtime(bitmap_file_path) >= os.path.getmtime(bucket_file_path)):
+                    mtime = os.path.getmtime(bitmap_file_path)
+                    loaded = self._bitmap_files.get(bucket)
+                    if loaded is None or loaded[0] != mtime:
+                        loaded = self._bitmap_files[bucket] = (mtime, BitmapIndex.load(bitmap_file_path))
+                    return loaded[1]
+            cached = self._load_bucket(bucket)
+        if cached.df is None:
+            return None
+        if cached.bitmaps is None or cached.bitmaps[0] is not cached.df:
+            cached.bitmaps = (cached.df, BitmapIndex.from_frame(cached.df, INDEX_COLUMNS))
+        return cached.bitmaps[1]
+
+    def _count_bucket(self, bucket, predicates, group_by, in_memtable=False):
+        if in_memtable:
+            # Count the bucket files, then take back what the memtable has replaced and add what
+            # it holds instead; write-locked so a drain cannot move entries in between
+            with self.bucket_locks.write(bucket):
+                counts = self._count_bucket(bucket, predicates, group_by)
+                changes = self.memtable.bucket_changes(bucket)
+            for base, record in changes.values():
+                for change, delta in ((base, -1), (record, 1)):
+                    if change is None or not _record_matches(change, predicates):
+                        continue
+                    if group_by:
+                        counts[change[group_by]] = counts.get(change[group_by], 0) + delta
+                    else:
+                        counts += delta
+            return {value: count for value, count in counts.items() if count} if group_by else counts
+        bitmaps = self._bucket_bitmaps(bucket)
+        if bitmaps is None:
+            return {} if group_by else 0
+        mask = bitmaps.match(**predicates)
+        return bitmaps.group_count(group_by, mask) if group_by else bitmaps.count(mask)
+
+    def count(self, state=None, occupation=None, group_by=None, max_workers=8):
+        """Count records matching State and/or Occupation using per-bucket bitmap indexes.
+
+        A predicate may be a single value or a list of values to OR together. With
+        ``group_by='State'`` or ``'Occupation'`` returns {value: count} instead of a total,
+        e.g. ``count(group_by='State')`` is COUNT(*) GROUP BY State.
+        """
+        if group_by is not None and group_by not in INDEX_COLUMNS:
+            raise ValueError(f"Can only group by one of {INDEX_COLUMNS}")
+        predicates = {'State': state, 'Occupation': occupation}
+        memtable_buckets = self._memtable_buckets()
+        buckets = sorted(set(self._indexed_buckets()) | memtable_buckets)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(
+                lambda bucket: self._count_bucket(bucket, predicates, group_by, bucket in memtable_buckets),
+                buckets))
+        if not group_by:
+            return sum(results)
+        totals = {}
+        for counts in results:
+            for value, count in counts.items():
+                totals[value] = totals.get(value, 0) + count
+        return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+    def rebalance(self, num_buckets, background=False, progress_every=100):
+        """Grow (or shrink) the bucket count without taking the store offline.
+
+        Old buckets are moved one at a time. Each takes the write locks of the bucket and the
+        buckets its records go to, logs a 'move' entry with the moving records and then moves
+        only the records whose bucket changes; reads and writes to every other bucket carry on,
+        and keys of buckets already moved are routed with the new count. Progress is kept in
+        layout.json, so an interrupted rebalance resumes when called again with the same count.
+
+        With the 'jump' hash scheme growing from n to m buckets moves about (m - n) / m of the
+        records; md5 and fnv1a use modulo and move nearly all of them. With ``background=True``
+        the job runs on a thread, which is returned. Returns the number of records moved.
+        """
+        if background:
+            thread = threading.Thread(target=self.rebalance, args=(num_buckets, False, progress_every),
+                                      daemon=True, name='bucket-rebalance')
+            thread.start()
+            return thread
+
+        with self._rebalance_lock:
+            if self._migration is None:
+                if num_buckets == self.num_buckets:
+                    return 0
+                self._migration = {'num_buckets': num_buckets, 'done': set()}
+                self._write_layout()
+            elif self._migration['num_buckets'] != num_buckets:
+                raise ValueError(f"A rebalance to {self._migration['num_buckets']} buckets is still in progress")
+
+            start_time = time.time()
+            moved = 0
+            old_buckets = [bucket for bucket in range(self.num_buckets) if bucket not in self._migration['done']]
+            for i, bucket in enumerate(old_buckets, start=1):
+                bucket_moved = self._rebalance_bucket(bucket)
+                if bucket_moved:
+                    self.flush()
+                self._write_layout()
+                moved += bucket_moved
+                if i % progress_every == 0 or i == len(old_buckets):
+                    print(f"Rebalanced {i}/{len(old_buckets)} buckets ({moved} records moved) "
+                          f"in {time.time() - start_time:.1f}s")
+
+            # Everything moved must be on disk before the layout stops mentioning the rebalance
+            self.flush()
+            self.num_buckets = num_buckets
+            self._migration = None
+            self._routing_version += 1
+            self._write_layout()
+            return moved
+
+    def _move_targets(self, bucket):
+        # The buckets this bucket's records route to under the new count, including itself
+        bucket_df = self._load_bucket(bucket).df
+        if bucket_df is None or bucket_df.empty:
+            return [bucket]
+        targets = bucket_ids(bucket_df.index, self._migration['num_buckets'], self.hash_scheme)
+        return [bucket] + np.unique(targets).tolist()
+
+    def _rebalance_bucket(self, bucket):
+        migration = self._migration
+        while True:
+            with self._writing(lambda: self._move_targets(bucket)) as locked:
+                if self.memtable is not None:
+                    self._drain_memtable_bucket(bucket)
+                bucket_df = self._load_bucket(bucket).df
+                if bucket_df is None or bucket_df.empty:
+                    moving_df = pd.DataFrame(columns=['SSN', 'State', 'Occupation'])
+                else:
+                    targets = bucket_ids(bucket_df.index, migration['num_buckets'], self.hash_scheme)
+                    # A write that landed while we waited for the locks may go to a bucket not locked yet
+                    if not set(np.unique(targets).tolist()) <= set(locked):
+                        continue
+                    moving_df = bucket_df[targets != bucket]
+                # Logged even when nothing moves: recovery has to route this bucket's keys the new
+                # way before it redoes any write that came after
+                if self.wal is not None:
+                    self.wal.log_to_wal('move', {'bucket': bucket, 'num_buckets': migration['num_buckets'],
+                                                 'records': moving_df.to_dict('records')})
+                # Readers route without locks: the records have to be in their new buckets before
+                # the route flips, and stay in this one until after it
+                self._add_moved_records(moving_df)
+                migration['done'].add(bucket)
+                self._routing_version += 1
+                self._drop_moved_records(bucket, moving_df)
+                return len(moving_df)
+
+    def _add_moved_records(self, moving_df):
+        # Adds moving_df's records to the buckets they route to under the new count, skipping
+        # ones already there so a logged move can be redone
+        if moving_df.empty:
+            return
+        targets = bucket_ids(moving_df.index, self._migration['num_buckets'], self.hash_scheme)
+        for target, target_df in moving_df.groupby(targets):
+            cached = self._load_bucket(int(target))
+            target_bucket_df = cached.df if cached.df is not None else pd.DataFrame(columns=['SSN', 'State', 'Occupation'])
+            added_df = target_df[~target_df.index.isin(target_bucket_df.index)]
+            if added_df.empty:
+                continue
+            records = added_df.to_dict('records')
+            added = {index_key: {} for index_key in INDEX_COLUMNS}
+            for record in records:
+                for index_key in INDEX_COLUMNS:
+                    added[index_key].setdefault(record[index_key], []).append(record['SSN'])
+            with cached.lock:
+                cached.df = pd.concat([target_bucket_df, added_df]).sort_index()
+                cached.pending.update((record['SSN'], record) for record in records)
+                for index_key in INDEX_COLUMNS:
+                    self._apply_index_batch(cached.indexes[index_key], {}, added[index_key])
+            self._store_bucket(int(target), cached, ('data',) + INDEX_COLUMNS)
+
+    def _drop_moved_records(self, bucket, moving_df):
+        cached = self._load_bucket(bucket)
+        if cached.df is None or moving_df.empty:
+            return
+        removed_df = cached.df.loc[moving_df.index.intersection(cached.df.index)]
+        if removed_df.empty:
+            return
+        removed = {index_key: {} for index_key in INDEX_COLUMNS}
+        for record in removed_df.to_dict('records'):
+            for index_key in INDEX_COLUMNS:
+                removed[index_key].setdefault(record[index_key], []).append(record['SSN'])
+        with cached.lock:
+            cached.df = cached.df.drop(index=removed_df.index)
+            cached.pending.update((ssn, None) for ssn in removed_df.index)
+            for index_key in INDEX_COLUMNS:
+                self._apply_index_batch(cached.indexes[index_key], removed[index_key], {})
+        self._store_bucket(bucket, cached, ('data',) + INDEX_COLUMNS)
+
+    def redo_move(self, data):
+        """Replay a logged move during recovery."""
+        migration = self._migration
+        if migration is None or migration['num_buckets'] != data['num_buckets']:
+            # The rebalance finished, and it only does so once every move is on disk
+            return
+        bucket = data['bucket']
+        migration['done'].add(bucket)
+        self._routing_version += 1
+        if data['records']:
+            moving_df = pd.DataFrame(data['records']).set_index('SSN', drop=False)
+            with self._writing(lambda: [bucket] + np.unique(
+                    bucket_ids(moving_df.index, migration['num_buckets'], self.hash_scheme)).tolist()):
+                self._add_moved_records(moving_df)
+                self._drop_moved_records(bucket, moving_df)
+        self._write_layout()
 
 def test_crud_operations():
     # Initialize WAL and CRUD operations
@@ -291,7 +1574,296 @@ def test_crud_operations():
 
     # Verify the record was updated
     print(crud.read_record('111-00-0000'))
+    print(crud.cache_stats())
+    wal.close()
+
+
+def _check_records(crud, expected, absent=()):
+    # Every expected record reads back as it was written, and the indexes agree with them
+    wrong = [ssn for ssn, record in expected.items() if crud.read_record(ssn) != record]
+    assert not wrong, f"{len(wrong)} records read back wrong, e.g. {wrong[:3]}"
+    assert all(crud.read_record(ssn) is None for ssn in absent), "A deleted or unwritten SSN was found"
+    assert crud.count() == len(expected), f"count() is {crud.count()}, expected {len(expected)}"
+    state_counts = {}
+    for record in expected.values():
+        state_counts[record['State']] = state_counts.get(record['State'], 0) + 1
+    assert crud.count(group_by='State') == dict(sorted(state_counts.items(), key=lambda item: -item[1]))
+    assert crud.query(state='WA') == sorted(ssn for ssn, record in expected.items() if record['State'] == 'WA')
+
+
+# Testing bulk writes, bloom filters and bitmap counts on each storage backend
+def test_bulk_operations(storage='parquet'):
+    buckets_dir, wal_dir = 'test_bulk_buckets', 'test_bulk_wal'
+    records = generate_frame(1500, seed=1, categorical=False).to_dict('records')
+    crud = CRUDOperations(buckets_dir, wal=WriteAheadLog(wal_dir), num_buckets=20, storage=storage,
+                          max_delta_files=4, background_compaction=False)
+    assert crud.create_records(records[:1000]) == 1000
+    # Existing SSNs are skipped by create and overwritten by upsert
+    assert crud.create_records(records[750:1250]) == 250
+    upserts = [dict(record, State='WA') for record in records[:250]]
+    assert crud.upsert_records(upserts) == 250
+    assert crud.delete_records([record['SSN'] for record in records[1200:1250]]) == 50
+    expected = {record['SSN']: record for record in records[:1200]}
+    expected.update((record['SSN'], record) for record in upserts)
+    absent = [record['SSN'] for record in records[1200:]]
+    _check_records(crud, expected, absent)
+    crud.flush()
+    crud.wal.close()
+
+    # A fresh instance starts with nothing cached, so reads go through the bloom filters,
+    # point lookups and saved bitmaps
+    crud = CRUDOperations(buckets_dir, wal=WriteAheadLog(wal_dir), storage=storage)
+    _check_records(crud, expected, absent)
+    # At a 1% false positive rate nearly every SSN never written is ruled out without reading
+    # files; deleted ones stay in the filters until their bucket is compacted
+    unwritten = [record['SSN'] for record in records[1250:]]
+    passed = sum(crud._bloom(crud.hash_index_to_bucket(ssn)).might_contain(ssn) for ssn in unwritten)
+    assert passed <= len(unwritten) // 20, f"Bloom filters let {passed} of {len(unwritten)} unwritten SSNs through"
+    print(f"Bulk operations on {storage} buckets: {len(expected)} records, cache {crud.cache_stats()}")
+    crud.wal.close()
+    shutil.rmtree(buckets_dir)
+    shutil.rmtree(wal_dir)
+
+
+# Testing concurrent writers and readers while the buckets are rebalanced online
+def test_concurrent_rebalance(write_mode='write-through', storage='parquet'):
+    buckets_dir, wal_dir = 'test_rebalance_buckets', 'test_rebalance_wal'
+    records = generate_frame(1200, seed=2, categorical=False).to_dict('records')
+    # A small cache and memtable make writes evict buckets and drain the memtable while moving
+    crud = CRUDOperations(buckets_dir, wal=WriteAheadLog(wal_dir), hash_scheme='jump', num_buckets=12,
+                          write_mode=write_mode, storage=storage, cache_max_bytes=96 * 1024,
+                          memtable_max_bytes=20_000)
+    crud.create_records(records[:800])
+    expected = {record['SSN']: record for record in records[:800]}
+    # ssn -> times deleted, so a reader can tell a record that was deleted under it from a lost one
+    deletions = {}
+    lock = threading.Lock()
+    done = threading.Event()
+    missing = []
+
+    def writer(seed):
+        rng = random.Random(seed)
+        for _ in range(100):
+            record = rng.choice(records)
+            ssn = record['SSN']
+            choice = rng.random()
+            with lock:
+                if ssn not in expected and choice < 0.4:
+                    if choice < 0.2:
+                        crud.create_record(dict(record))
+                    else:
+                        crud.create_records([dict(record)])
+                    expected[ssn] = record
+                elif ssn in expected and choice < 0.8:
+                    crud.update_record(ssn, {'State': 'WA'})
+                    expected[ssn] = dict(expected[ssn], State='WA')
+                elif ssn in expected:
+                    crud.delete_record(ssn)
+                    del expected[ssn]
+                    deletions[ssn] = deletions.get(ssn, 0) + 1
+
+    def reader(seed):
+        rng = random.Random(seed)
+        while not done.is_set():
+            ssn = rng.choice(records)['SSN']
+            with lock:
+                present, deleted = ssn in expected, deletions.get(ssn, 0)
+            record = crud.read_record(ssn)
+            with lock:
+                still_present = ssn in expected and deletions.get(ssn, 0) == deleted
+            if present and still_present and record is None:
+                missing.append(ssn)
+
+    writers = [threading.Thread(target=writer, args=(seed,)) for seed in range(3)]
+    readers = [threading.Thread(target=reader, args=(seed,)) for seed in range(10, 13)]
+    for thread in writers + readers:
+        thread.start()
+    crud.rebalance(18, background=True).join()
+    for thread in writers:
+        thread.join()
+    done.set()
+    for thread in readers:
+        thread.join()
+
+    assert not missing, f"Readers missed {len(missing)} existing records, e.g. {missing[:3]}"
+    assert crud.num_buckets == 18
+    absent = [record['SSN'] for record in records if record['SSN'] not in expected]
+    _check_records(crud, expected, absent)
+    crud.flush()
+    crud.wal.close()
+
+    crud = CRUDOperations(buckets_dir, wal=WriteAheadLog(wal_dir), write_mode=write_mode, storage=storage)
+    _check_records(crud, expected, absent)
+    print(f"Rebalanced {write_mode} {storage} buckets under load: {len(expected)} records")
+    crud.wal.close()
+    shutil.rmtree(buckets_dir)
+    shutil.rmtree(wal_dir)
+
+
+# Testing recovery from the WAL after a crash that skips every flush
+def test_crash_recovery(write_mode='memtable'):
+    buckets_dir, wal_dir = 'test_recovery_buckets', 'test_recovery_wal'
+    records = generate_frame(600, seed=3, categorical=False).to_dict('records')
+    crud = CRUDOperations(buckets_dir, wal=WriteAheadLog(wal_dir), num_buckets=10, write_mode=write_mode,
+                          memtable_max_bytes=20_000, background_compaction=False)
+    crud.create_records(records[:200])
+    # Single-record writes outside a transaction, partly drained from the memtable on the way
+    for record in records[200:400]:
+        crud.create_record(dict(record))
+    for record in records[:80]:
+        crud.update_record(record['SSN'], {'State': 'WA'})
+    for record in records[360:400]:
+        crud.delete_record(record['SSN'])
+    # A committed transaction, and one that never reaches end_transaction
+    crud.wal.start_transaction()
+    for record in records[400:440]:
+        crud.create_record(dict(record))
+    crud.wal.end_transaction()
+    crud.wal.start_transaction()
+    for record in records[440:480]:
+        crud.create_record(dict(record))
+    crud.update_record(records[100]['SSN'], {'State': 'WA'})
+    expected = {record['SSN']: record for record in records[:360] + records[400:440]}
+    expected.update((record['SSN'], dict(record, State='WA')) for record in records[:80])
+    absent = [record['SSN'] for record in records[360:400] + records[440:]]
+    # Crash: the WAL buffer reaches the OS, but the memtable and dirty cached buckets are lost
+    crud.wal.sync(fsync=False)
+
+    wal = WriteAheadLog(wal_dir)
+    crud = CRUDOperations(buckets_dir, wal=wal, write_mode=write_mode, background_compaction=False)
+    wal.process_wal(crud)
+    _check_records(crud, expected, absent)
+    wal.close()
+
+    # Recovery flushed what it replayed, so nothing is left to redo
+    wal = WriteAheadLog(wal_dir)
+    crud = CRUDOperations(buckets_dir, wal=wal, write_mode=write_mode, background_compaction=False)
+    _check_records(crud, expected, absent)
+    print(f"Recovered {len(expected)} {write_mode} records from the WAL")
+    wal.close()
+    shutil.rmtree(buckets_dir)
+    shutil.rmtree(wal_dir)
+
+
+# query and count see the memtable's writes without draining it
+def test_memtable_reads():
+    buckets_dir, wal_dir = 'test_memtable_buckets', 'test_memtable_wal'
+    records = generate_frame(400, seed=4, categorical=False).to_dict('records')
+    crud = CRUDOperations(buckets_dir, wal=WriteAheadLog(wal_dir), num_buckets=10, write_mode='memtable',
+                          background_compaction=False)
+    crud.create_records(records[:300])
+    for record in records[300:]:
+        crud.create_record(dict(record))
+    for record in records[:50]:
+        crud.update_record(record['SSN'], {'State': 'WA'})
+    for record in records[250:330]:
+        crud.delete_record(record['SSN'])
+    # Deleted, then created again: the bucket files still hold the old copy
+    crud.create_record(dict(records[260], Occupation='Pilot'))
+    expected = {record['SSN']: record for record in records[:250] + records[330:]}
+    expected.update((record['SSN'], dict(record, State='WA')) for record in records[:50])
+    expected[records[260]['SSN']] = dict(records[260], Occupation='Pilot')
+    buffered = len(crud.memtable)
+    _check_records(crud, expected, [record['SSN'] for record in records[250:330] if record is not records[260]])
+    assert crud.count(occupation='Pilot') == sum(record['Occupation'] == 'Pilot' for record in expected.values())
+    wa_df = crud.query(state='WA', fetch_records=True)
+    assert {ssn: wa_df.loc[ssn].to_dict() for ssn in wa_df.index} == {
+        ssn: record for ssn, record in expected.items() if record['State'] == 'WA'}
+    assert len(crud.memtable) == buffered, "query or count drained the memtable"
+    print(f"Read {len(expected)} records with {buffered} still in the memtable")
+    crud.wal.close()
+    shutil.rmtree(buckets_dir)
+    shutil.rmtree(wal_dir)
+
+
+# Buckets written by the bulk loader can be updated and deleted from like CRUD-written ones
+def test_loaded_buckets(storage='parquet'):
+    buckets_dir, wal_dir = 'test_loaded_buckets', 'test_loaded_wal'
+    df = generate_frame(500, seed=5, categorical=False).set_index('SSN')
+    ids = bucket_ids(df.index.to_numpy(), num_buckets=10)
+    write_buckets(partition_frame(df, ids=ids), buckets_dir, storage=storage, postings=build_postings(df, ids)[0])
+    crud = CRUDOperations(buckets_dir, wal=WriteAheadLog(wal_dir), num_buckets=10, storage=storage,
+                          background_compaction=False)
+    expected = {ssn: {'SSN': ssn, **record} for ssn, record in df.to_dict('index').items()}
+    ssns = list(expected)
+    for ssn in ssns[:40]:
+        crud.update_record(ssn, {'State': 'WA'})
+        expected[ssn] = dict(expected[ssn], State='WA')
+    for ssn in ssns[40:60]:
+        crud.delete_record(ssn)
+        del expected[ssn]
+    assert crud.delete_records(ssns[60:80]) == 20
+    for ssn in ssns[60:80]:
+        del expected[ssn]
+    assert crud.upsert_records([dict(expected[ssn], Occupation='Pilot') for ssn in ssns[80:100]]) == 20
+    expected.update((ssn, dict(expected[ssn], Occupation='Pilot')) for ssn in ssns[80:100])
+    _check_records(crud, expected, ssns[40:80])
+    crud.wal.close()
+    shutil.rmtree(buckets_dir)
+    shutil.rmtree(wal_dir)
+
+
+# A failed write in write-back mode keeps the bucket's earlier unflushed changes
+def test_failed_write_back():
+    buckets_dir, wal_dir = 'test_failed_buckets', 'test_failed_wal'
+    records = generate_frame(200, seed=6, categorical=False).to_dict('records')
+    crud = CRUDOperations(buckets_dir, wal=WriteAheadLog(wal_dir), num_buckets=4, write_mode='write-back',
+                          background_compaction=False)
+    crud.create_records(records)
+    first = records[0]
+    second = next(record for record in records[1:]
+                  if crud.hash_index_to_bucket(record['SSN']) == crud.hash_index_to_bucket(first['SSN'])
+                  and record['State'] != 'WA')
+    crud.update_record(first['SSN'], {'State': 'WA'})
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("index update failed")
+    crud.apply_index_change = fail
+    crud.update_record(second['SSN'], {'State': 'WA'})
+    del crud.apply_index_change
+    expected = {record['SSN']: record for record in records}
+    expected[first['SSN']] = dict(first, State='WA')
+    _check_records(crud, expected)
+    crud.wal.close()
+
+    crud = CRUDOperations(buckets_dir, wal=WriteAheadLog(wal_dir), background_compaction=False)
+    _check_records(crud, expected)
+    print("Kept the unflushed update next to a failed one")
+    crud.wal.close()
+    shutil.rmtree(buckets_dir)
+    shutil.rmtree(wal_dir)
+
+
+def _fnv1a(ssn):
+    hash_value = 0xcbf29ce484222325
+    for byte in str(ssn).encode():
+        hash_value = ((hash_value ^ byte) * 0x100000001b3) & 0xFFFFFFFFFFFFFFFF
+    return hash_value
+
+
+# The vectorized bucket_ids gives every SSN the bucket the one-key-at-a-time functions give it
+def test_bucket_assignment():
+    ssns = generate_frame(5000, seed=7, categorical=False)['SSN'].tolist() + ['000-00-0000', '999-99-9999']
+    for num_buckets in (1, 7, 1000, 1024, 65537, 2 ** 31 - 1):
+        assert bucket_ids(ssns, num_buckets, 'md5').tolist() == [
+            hash_index_to_bucket(ssn, num_buckets) for ssn in ssns], f"md5 differs for {num_buckets} buckets"
+        assert bucket_ids(ssns, num_buckets, 'jump').tolist() == [
+            jump_bucket(ssn, num_buckets) for ssn in ssns], f"jump differs for {num_buckets} buckets"
+        assert bucket_ids(ssns, num_buckets, 'fnv1a').tolist() == [
+            _fnv1a(ssn) % num_buckets for ssn in ssns], f"fnv1a differs for {num_buckets} buckets"
+    assert len(bucket_ids([], 10)) == 0
+    print(f"Vectorized bucket ids match for {len(ssns)} SSNs")
 
 
 if __name__ == "__main__":
+    test_bucket_assignment()
     test_crud_operations()
+    for storage in STORAGE_BACKENDS:
+        test_bulk_operations(storage)
+        test_loaded_buckets(storage)
+    for write_mode in WRITE_MODES:
+        test_concurrent_rebalance(write_mode)
+        test_crash_recovery(write_mode)
+    test_concurrent_rebalance('memtable', storage='arrow')
+    test_memtable_reads()
+    test_failed_write_back()
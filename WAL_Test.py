@@ -1,89 +1,303 @@
+import asyncio
 import os
-import json
+import re
+import hashlib
+import shutil
+import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
 import pyarrow.parquet as pq
 import fastparquet
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from async_api import AsyncKVShard
+from wal_format import (RECORD_FORMATS, encode_entry, fsync_files, iter_entries, last_lsn, open_segment,
+                        read_checkpoint, segment_files, truncate_segments, valid_length, write_checkpoint)
 
 
 # Build Write Ahead Log Function
 class WriteAheadLog:
-    def __init__(self, wal_dir, max_wal_entries=100, max_wal_files=5):
+    def __init__(self, wal_dir, max_wal_entries=100, max_wal_files=5, group_commit=False,
+                 max_batch_entries=64, max_batch_delay=0.001, record_format='json'):
+        if record_format not in RECORD_FORMATS:
+            raise ValueError(f"Unknown record format {record_format!r}, expected one of {RECORD_FORMATS}")
         self.wal_dir = wal_dir
+        self.record_format = record_format
         self.max_wal_entries = max_wal_entries
         self.max_wal_files = max_wal_files
         self.current_wal_file = None
         self.wal_counter = 0
         self.current_file_index = 0
+        # Rotation, segment cleanup and checkpoints run on the flusher and caller threads alike,
+        # so everything that opens, truncates or deletes segment files holds this lock
+        self._segment_lock = threading.RLock()
         self._ensure_wal_dir_exists()
+
+        # Every entry carries a monotonically increasing LSN; the checkpoint records the
+        # highest LSN whose effects are persisted outside the log
+        self.last_lsn = last_lsn(wal_dir, 'action')
+        self.checkpoint_lsn = read_checkpoint(wal_dir)['lsn']
+        self.written_lsn = self.last_lsn
+        self.last_position = None
+        self._segment_last_lsn = {}
         self._initialize_current_wal_file()
 
+        # Group commit: callers append to a shared buffer and a background thread
+        # writes and fsyncs each batch once, waking every caller whose entry it covered
+        self.group_commit = group_commit
+        self.max_batch_entries = max_batch_entries
+        self.max_batch_delay = max_batch_delay
+        self._commit_cond = threading.Condition()
+        self._pending = []
+        self._appended_seq = 0
+        self._durable_seq = 0
+        self._flush_error = None
+        # (seq, callback) pairs waiting for their entry to become durable, see add_durable_callback
+        self._durable_callbacks = []
+        self._closing = False
+        self._flusher = None
+        if group_commit:
+            self._flusher = threading.Thread(target=self._group_commit_loop, daemon=True,
+                                             name=f"wal-group-commit-{wal_dir}")
+            self._flusher.start()
+
     def _ensure_wal_dir_exists(self):
         os.makedirs(self.wal_dir, exist_ok=True)
         print(f"Ensured WAL directory exists: {self.wal_dir}")
 
     def _initialize_current_wal_file(self):
-        wal_files = sorted([f for f in os.listdir(self.wal_dir) if f.endswith('.wal')])
-        self.current_file_index = len(wal_files)
+        wal_files = segment_files(self.wal_dir)
+        # Continue after the newest segment so new entries always sort after old ones
+        self.current_file_index = wal_files[-1][0] + 1 if wal_files else 0
         self.current_wal_file_path = os.path.join(self.wal_dir, f"{self.current_file_index}.wal")
-        self.current_wal_file = open(self.current_wal_file_path, 'a')
+        self.current_wal_file = open_segment(self.current_wal_file_path, self.record_format)
         print(f"Initialized WAL file: {self.current_wal_file_path}")
 
     def _rotate_wal_file(self):
-        self.current_wal_file.close()
-        self.current_file_index += 1
-        self.current_wal_file_path = os.path.join(self.wal_dir, f"{self.current_file_index}.wal")
-        self.current_wal_file = open(self.current_wal_file_path, 'a')
-        self.wal_counter = 0
-        print(f"Rotated WAL file: {self.current_wal_file_path}")
-        self._cleanup_old_wal_files()
+        with self._segment_lock:
+            self.current_wal_file.flush()
+            os.fsync(self.current_wal_file.fileno())
+            self.current_wal_file.close()
+            self.current_file_index += 1
+            self.current_wal_file_path = os.path.join(self.wal_dir, f"{self.current_file_index}.wal")
+            self.current_wal_file = open_segment(self.current_wal_file_path, self.record_format)
+            self.wal_counter = 0
+            print(f"Rotated WAL file: {self.current_wal_file_path}")
+            self._cleanup_old_wal_files()
 
     def _cleanup_old_wal_files(self):
-        wal_files = sorted([f for f in os.listdir(self.wal_dir) if f.endswith('.wal')])
-        while len(wal_files) > self.max_wal_files:
-            oldest_file = wal_files.pop(0)
-            os.remove(os.path.join(self.wal_dir, oldest_file))
-            print(f"Deleted old WAL file: {oldest_file}")
-
-    def log(self, entry):
-        if self.wal_counter >= self.max_wal_entries:
-            self._rotate_wal_file()
-        self.current_wal_file.write(json.dumps(entry) + '\n')
-        self.current_wal_file.flush()
-        os.fsync(self.current_wal_file.fileno())
-        self.wal_counter += 1
+        # Only segments fully covered by the last checkpoint can go; anything newer is still
+        # needed for recovery, so max_wal_files is a warning threshold rather than a hard cap
+        with self._segment_lock:
+            deleted = truncate_segments(self.wal_dir, 'action', self.checkpoint_lsn, self.current_file_index,
+                                        self._segment_last_lsn)
+        for wal_file in deleted:
+            print(f"Deleted checkpointed WAL file: {wal_file}")
+        remaining = len(segment_files(self.wal_dir))
+        if remaining > self.max_wal_files:
+            print(f"WAL has {remaining} files, more than max_wal_files={self.max_wal_files}; checkpoint more often")
+
+    def checkpoint(self, lsn=None):
+        """Record that every entry up to ``lsn`` (default: the last one logged) is persisted.
+
+        Segments the checkpoint fully covers are deleted, and recovery replays only the
+        entries after it.
+        """
+        with self._commit_cond:
+            if lsn is None:
+                lsn = self.last_lsn
+            position = self.last_position if lsn == self.written_lsn else None
+        with self._segment_lock:
+            # Checkpoints taken concurrently may finish out of order; never move back
+            if lsn < self.checkpoint_lsn:
+                return
+            write_checkpoint(self.wal_dir, lsn, position)
+            self.checkpoint_lsn = lsn
+            self._cleanup_old_wal_files()
+        print(f"Checkpointed WAL at LSN {lsn}")
+
+    def read_checkpoint(self):
+        return read_checkpoint(self.wal_dir)
+
+    def log(self, entry, wait=True):
+        """Append an entry and return its sequence number.
+
+        With group commit and ``wait=False`` the entry is only queued; pass the
+        returned sequence number to ``wait_durable`` before acknowledging it.
+        """
+        if self.group_commit:
+            with self._commit_cond:
+                if self._closing:
+                    raise RuntimeError(f"WAL {self.wal_dir} is closed")
+                self.last_lsn += 1
+                entry['lsn'] = self.last_lsn
+                self._pending.append(entry)
+                self._appended_seq += 1
+                seq = self._appended_seq
+                self._commit_cond.notify_all()
+            if wait:
+                self.wait_durable(seq)
+            return seq
+
+        # Appends from different threads must not interleave or reuse an LSN
+        with self._commit_cond:
+            self.last_lsn += 1
+            entry['lsn'] = self.last_lsn
+            if self.wal_counter >= self.max_wal_entries:
+                self._rotate_wal_file()
+            self.current_wal_file.write(encode_entry(entry, 'action', self.record_format))
+            self.current_wal_file.flush()
+            os.fsync(self.current_wal_file.fileno())
+            self.wal_counter += 1
+            self.written_lsn = entry['lsn']
+            self.last_position = (self.current_file_index, self.current_wal_file.tell())
+            self._appended_seq += 1
+            self._durable_seq = self._appended_seq
+            seq = self._appended_seq
         print(f"Logged entry: {entry}")
+        return seq
 
-    def start_transaction(self):
-        self.log({'action': 'start'})
+    def wait_durable(self, seq):
+        """Block until the entry with sequence number ``seq`` has been fsynced."""
+        with self._commit_cond:
+            while self._durable_seq < seq:
+                if self._flush_error is not None:
+                    raise RuntimeError(f"WAL group commit failed: {self._flush_error}")
+                self._commit_cond.wait()
 
-    def end_transaction(self):
-        self.log({'action': 'end'})
+    def add_durable_callback(self, seq, callback):
+        """Call ``callback(error)`` once entry ``seq`` is durable, with error None on success.
+
+        The callback runs on the group commit thread (or right away if the entry is already
+        durable), so it should only hand the result off, e.g. with call_soon_threadsafe.
+        """
+        with self._commit_cond:
+            if self._durable_seq < seq and self._flush_error is None:
+                self._durable_callbacks.append((seq, callback))
+                return
+            error = self._flush_error if self._durable_seq < seq else None
+        callback(error)
+
+    def _run_durable_callbacks(self, error=None):
+        ready, waiting = [], []
+        with self._commit_cond:
+            for item in self._durable_callbacks:
+                (ready if error is not None or item[0] <= self._durable_seq else waiting).append(item)
+            self._durable_callbacks = waiting
+        for _, callback in ready:
+            callback(error)
+
+    def _group_commit_loop(self):
+        while True:
+            with self._commit_cond:
+                while not self._pending and not self._closing:
+                    self._commit_cond.wait()
+                if not self._pending:
+                    return
+                # Give concurrent callers up to max_batch_delay to join this batch
+                deadline = time.monotonic() + self.max_batch_delay
+                while len(self._pending) < self.max_batch_entries and not self._closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._commit_cond.wait(remaining)
+                batch = self._pending[:self.max_batch_entries]
+                del self._pending[:self.max_batch_entries]
+                batch_seq = self._appended_seq - len(self._pending)
+
+            try:
+                for entry in batch:
+                    if self.wal_counter >= self.max_wal_entries:
+                        self._rotate_wal_file()
+                    self.current_wal_file.write(encode_entry(entry, 'action', self.record_format))
+                    self.wal_counter += 1
+                self.current_wal_file.flush()
+                os.fsync(self.current_wal_file.fileno())
+                with self._commit_cond:
+                    self.written_lsn = batch[-1]['lsn']
+                    self.last_position = (self.current_file_index, self.current_wal_file.tell())
+            except OSError as e:
+                with self._commit_cond:
+                    self._flush_error = e
+                    self._commit_cond.notify_all()
+                self._run_durable_callbacks(e)
+                return
 
-    def log_insert(self, key, value):
-        self.log({'action': 'insert', 'key': key, 'value': value, 'old_value': None})
+            with self._commit_cond:
+                self._durable_seq = batch_seq
+                self._commit_cond.notify_all()
+            self._run_durable_callbacks()
+            print(f"Group-committed {len(batch)} entries")
 
-    def log_update(self, key, old_value, new_value):
-        self.log({'action': 'update', 'key': key, 'value': new_value, 'old_value': old_value})
+    def close(self):
+        """Flush any queued entries and close the current WAL file."""
+        if self._flusher is not None:
+            with self._commit_cond:
+                self._closing = True
+                self._commit_cond.notify_all()
+            self._flusher.join()
+            self._flusher = None
+        if not self.current_wal_file.closed:
+            self.current_wal_file.close()
 
-    def log_delete(self, key, old_value):
-        self.log({'action': 'delete', 'key': key, 'value': None, 'old_value': old_value})
+    def start_transaction(self, wait=True):
+        return self.log({'action': 'start'}, wait=wait)
+
+    def end_transaction(self, wait=True):
+        return self.log({'action': 'end'}, wait=wait)
+
+    def _log_change(self, entry, wait, autocommit):
+        # A change logged outside start/end is a transaction of its own
+        if autocommit:
+            entry['autocommit'] = True
+        return self.log(entry, wait=wait)
+
+    def log_insert(self, key, value, wait=True, autocommit=False):
+        return self._log_change({'action': 'insert', 'key': key, 'value': value, 'old_value': None},
+                                wait, autocommit)
+
+    def log_update(self, key, old_value, new_value, wait=True, autocommit=False):
+        return self._log_change({'action': 'update', 'key': key, 'value': new_value, 'old_value': old_value},
+                                wait, autocommit)
+
+    def log_delete(self, key, old_value, wait=True, autocommit=False):
+        return self._log_change({'action': 'delete', 'key': key, 'value': None, 'old_value': old_value},
+                                wait, autocommit)
+
+    def iter_transactions(self, start_position=None, after_lsn=0):
+        """Yield (position, transaction) for each committed transaction, one at a time.
+
+        ``position`` is (file_index, offset) just past the transaction's end entry; passing
+        it back as ``start_position`` resumes replay right after that transaction. Entries
+        with an LSN at or below ``after_lsn`` are skipped. Entries logged with ``autocommit``
+        are yielded as single-entry transactions. Only the transaction being assembled is
+        held in memory, however large the log is.
+        """
+        start_index, start_offset = start_position if start_position else (-1, 0)
+        transaction = []
+        for file_index, wal_file in segment_files(self.wal_dir):
+            if file_index < start_index:
+                continue
+            offset = start_offset if file_index == start_index else 0
+            # Transactions may span a rotation, so keep assembling across files
+            for end_offset, log_entry in iter_entries(os.path.join(self.wal_dir, wal_file), 'action', offset):
+                if after_lsn and log_entry.get('lsn', 0) <= after_lsn:
+                    continue
+                if log_entry.get('autocommit'):
+                    yield (file_index, end_offset), [log_entry]
+                elif log_entry['action'] == 'start':
+                    transaction = []
+                elif log_entry['action'] == 'end':
+                    yield (file_index, end_offset), transaction
+                    transaction = []
+                else:
+                    transaction.append(log_entry)
 
     def load_wal(self):
-        wal_files = sorted([f for f in os.listdir(self.wal_dir) if f.endswith('.wal')])
-        transactions = []
-        for wal_file in wal_files:
-            with open(os.path.join(self.wal_dir, wal_file), 'r') as file:
-                transaction = []
-                for line in file:
-                    log_entry = json.loads(line.strip())
-                    if log_entry['action'] == 'start':
-                        transaction = []
-                    elif log_entry['action'] == 'end':
-                        transactions.append(transaction)
-                    else:
-                        transaction.append(log_entry)
+        transactions = [transaction for _, transaction in self.iter_transactions()]
         print(f"Loaded WAL transactions: {transactions}")
         return transactions
 
@@ -123,38 +337,258 @@ def test_wal():
     os.rmdir(wal_dir)
 
 
+# Testing group commit with concurrent writers
+def test_group_commit():
+    wal_dir = 'test_group_commit_dir'
+    wal = WriteAheadLog(wal_dir, max_wal_entries=50, max_wal_files=10, group_commit=True,
+                        max_batch_entries=16, max_batch_delay=0.002)
+
+    def writer(worker_id):
+        for i in range(20):
+            wal.log_insert(f'key{worker_id}_{i}', f'value{i}')
+
+    threads = [threading.Thread(target=writer, args=(worker_id,)) for worker_id in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wal.close()
+    print(f"Durable entries: {wal._durable_seq}")
+
+    # Every entry made it to a segment, with LSNs in log order and each writer's entries in
+    # the order it logged them
+    entries = _wal_entries(wal_dir)
+    assert [entry['lsn'] for entry in entries] == list(range(1, 161))
+    for worker_id in range(8):
+        keys = [entry['key'] for entry in entries if entry['key'].startswith(f'key{worker_id}_')]
+        assert keys == [f'key{worker_id}_{i}' for i in range(20)], keys
+
+    for file in os.listdir(wal_dir):
+        os.remove(os.path.join(wal_dir, file))
+    os.rmdir(wal_dir)
+
+
+def _wal_entries(wal_dir):
+    return [entry for _, wal_file in segment_files(wal_dir)
+            for _, entry in iter_entries(os.path.join(wal_dir, wal_file), 'action')]
+
+
+def _recovered_transactions(wal_dir, record_format):
+    wal = WriteAheadLog(wal_dir, record_format=record_format)
+    transactions = [transaction for _, transaction in wal.iter_transactions()]
+    wal.close()
+    return transactions
+
+
+# Testing both record formats, and recovery from a corrupt record and from a torn tail
+def test_record_formats():
+    value = {'name': 'välue ✓', 'scores': [1, 2.5, None, True], 'long': 'x' * 300}
+    for record_format in RECORD_FORMATS:
+        wal_dir = f'test_{record_format}_format_dir'
+        wal = WriteAheadLog(wal_dir, record_format=record_format)
+        wal.start_transaction()
+        wal.log_insert('key1', value)
+        wal.log_update('key1', value, 'value2')
+        wal.end_transaction()
+        wal.log_delete('key1', 'value2', autocommit=True)
+        wal.close()
+
+        transactions = _recovered_transactions(wal_dir, record_format)
+        assert [[(entry['action'], entry['key'], entry['value'], entry['old_value']) for entry in transaction]
+                for transaction in transactions] == [
+            [('insert', 'key1', value, None), ('update', 'key1', 'value2', value)],
+            [('delete', 'key1', None, 'value2')]]
+        assert [entry['lsn'] for transaction in transactions for entry in transaction] == [2, 3, 5]
+
+        # A corrupted byte in the last record fails its CRC (or its JSON), so recovery stops before it
+        segment_path = os.path.join(wal_dir, segment_files(wal_dir)[0][1])
+        ends = [end_offset for end_offset, _ in iter_entries(segment_path, 'action')]
+        with open(segment_path, 'r+b') as f:
+            f.seek(ends[-1] - 3)
+            f.write(b'\xff')
+        assert valid_length(segment_path) == ends[-2]
+        assert [len(transaction) for transaction in _recovered_transactions(wal_dir, record_format)] == [2]
+
+        # A torn tail inside the end entry leaves no committed transaction, and opening the
+        # segment for appending cuts it off so new records follow the last complete one
+        with open(segment_path, 'r+b') as f:
+            f.truncate(ends[-2] - 2)
+        assert _recovered_transactions(wal_dir, record_format) == []
+        with open_segment(segment_path, record_format) as f:
+            assert f.tell() == ends[-3]
+            f.write(encode_entry({'action': 'end', 'lsn': 4}, 'action', record_format))
+        assert [entry['action'] for entry in _wal_entries(wal_dir)] == ['start', 'insert', 'update', 'end']
+        shutil.rmtree(wal_dir)
+
+
+# Testing checkpoints taken while the group commit thread rotates segments
+def test_checkpoint_during_group_commit():
+    wal_dir = 'test_checkpoint_group_commit_dir'
+    wal = WriteAheadLog(wal_dir, max_wal_entries=5, group_commit=True, max_batch_entries=4, max_batch_delay=0)
+    done = threading.Event()
+    errors = []
+
+    def checkpointer():
+        while not done.is_set():
+            try:
+                wal.checkpoint()
+            except Exception as e:
+                errors.append(e)
+
+    def writer(worker_id):
+        for i in range(200):
+            wal.log_insert(f'key{worker_id}_{i}', f'value{i}')
+
+    checkpointers = [threading.Thread(target=checkpointer) for _ in range(2)]
+    writers = [threading.Thread(target=writer, args=(worker_id,)) for worker_id in range(4)]
+    for thread in checkpointers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    done.set()
+    for thread in checkpointers:
+        thread.join()
+    wal.close()
+    assert not errors, f"checkpoint failed: {errors[0]!r}"
+    assert wal._flush_error is None, f"group commit failed: {wal._flush_error}"
+    assert wal._durable_seq == 800
+    shutil.rmtree(wal_dir)
+
+
 test_wal()
+test_group_commit()
+test_record_formats()
+test_checkpoint_during_group_commit()
+
+
+SEGMENT_FILE_PATTERN = re.compile(r'^segment_(\d+)\.parquet$')
+# feather: uncompressed Arrow IPC file that loads memory-mapped; parquet: data + index files
+SNAPSHOT_FORMATS = ('feather', 'parquet')
+
+
+def group_keys_by_value(keys, codes, uniques):
+    """Build the {value: [keys]} index from an object array of keys and their value codes."""
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes, minlength=len(uniques)))[:-1]
+    return dict(zip(uniques, [part.tolist() for part in np.split(keys[order], bounds)]))
 
 
 # Build KVShard Class for single shard
 
 class KVShard:
-    def __init__(self, shard_id, wal_dir, data_file, index_file):
+    """One shard: an in-memory dict and value index, persisted as snapshots plus a WAL.
+
+    Committing a transaction only writes the WAL. The keys changed since the last snapshot
+    are tracked, and once ``snapshot_every`` of them are dirty or ``snapshot_interval``
+    seconds have passed their current values are appended as a new parquet segment and the
+    WAL is checkpointed. Once there are more than ``max_segments`` segments the next
+    snapshot rewrites the full data and index files instead and drops the segments.
+    """
+
+    def __init__(self, shard_id, wal_dir, data_file, index_file, group_commit=False, record_format='json',
+                 snapshot_every=10000, snapshot_interval=60.0, max_segments=16, snapshot_format='feather'):
+        if snapshot_format not in SNAPSHOT_FORMATS:
+            raise ValueError(f"Unknown snapshot format {snapshot_format!r}, expected one of {SNAPSHOT_FORMATS}")
         self.shard_id = shard_id
         self.data = {}
         self.index = {}
-        self.wal = WriteAheadLog(wal_dir)
+        self.wal = WriteAheadLog(wal_dir, group_commit=group_commit, record_format=record_format)
         self.data_file = data_file
         self.index_file = index_file
+        self.segment_dir = os.path.splitext(data_file)[0] + '_segments'
+        self.snapshot_format = snapshot_format
+        self.feather_file = os.path.splitext(data_file)[0] + '.arrow'
+        self.snapshot_every = snapshot_every
+        self.snapshot_interval = snapshot_interval
+        self.max_segments = max_segments
+        # Keys changed since the last snapshot; the WAL covers them until the next one
+        self.dirty = set()
+        self.last_snapshot = time.monotonic()
+        self.segment_counter = 0
         self.lock = threading.Lock()
-        self.load_wal()
+        # A shard has one WAL, so its transactions must not interleave
+        self.transaction_lock = threading.RLock()
+        # Set between start_transaction and end_transaction; single-key writes outside one autocommit
+        self.in_transaction = False
+        self.snapshot_lock = threading.Lock()
         self.load_data()
+        self.load_wal()
 
     def load_wal(self):
-        """Load and process WAL files to restore the state."""
-        transactions = self.wal.load_wal()
-        for transaction in transactions:
+        """Replay the transactions committed after the last checkpoint on top of the loaded snapshot."""
+        checkpoint = self.wal.read_checkpoint()
+        for _, transaction in self.wal.iter_transactions(checkpoint['position'], checkpoint['lsn']):
             for log_entry in transaction:
-                self.apply_change(log_entry, apply_to_data=False)
+                self.replay_change(log_entry)
+
+    def replay_change(self, log_entry):
+        """Re-apply a logged change, taking the old value from the current state rather than the log."""
+        key = log_entry['key']
+        action = log_entry['action']
+        current_value = self.data.get(key)
+        if action == 'insert' or action == 'update':
+            self.apply_change({'action': action, 'key': key, 'value': log_entry['value'],
+                               'old_value': current_value})
+        elif action == 'delete' and key in self.data:
+            self.apply_change({'action': 'delete', 'key': key, 'value': current_value, 'old_value': None})
+
+    def _read_snapshot(self):
+        # Only one of the two files exists after a compaction; the configured format wins otherwise
+        files = [(self.feather_file, 'feather'), (self.data_file, 'parquet')]
+        if self.snapshot_format == 'parquet':
+            files.reverse()
+        for path, snapshot_format in files:
+            if os.path.exists(path):
+                if snapshot_format == 'feather':
+                    return feather.read_table(path, memory_map=True)
+                return pq.read_table(path)
+        return None
 
     def load_data(self):
-        """Load data and index from Parquet files."""
-        if os.path.exists(self.data_file):
-            df = pd.read_parquet(self.data_file)
-            self.data = df.set_index('key').to_dict()['value']
-        if os.path.exists(self.index_file):
-            df = pd.read_parquet(self.index_file)
-            self.index = df.set_index('value').groupby(level=0).agg(list).to_dict()['key']
+        """Load the latest snapshot, then apply the segments written since.
+
+        The key dict and value index are built column-wise: values are dictionary-encoded so
+        repeated values share one Python object, and the index comes from one stable sort of
+        the value codes rather than a pandas groupby.
+        """
+        base_segment = 0
+        table = self._read_snapshot()
+        if table is not None:
+            base_segment = int((table.schema.metadata or {}).get(b'last_segment', 0))
+        if table is not None and table.num_rows:
+            keys = np.asarray(table.column('key').to_pylist(), dtype=object)
+            encoded = pc.dictionary_encode(table.column('value'), null_encoding='encode').combine_chunks()
+            uniques = encoded.dictionary.to_pylist()
+            codes = encoded.indices.to_numpy(zero_copy_only=False)
+            self.data = dict(zip(keys.tolist(), np.asarray(uniques, dtype=object)[codes].tolist()))
+            self.index = group_keys_by_value(keys, codes, uniques)
+
+        applied = False
+        for segment, segment_path in self._segment_files():
+            self.segment_counter = max(self.segment_counter, segment)
+            if segment <= base_segment:
+                # Already folded into the data file by a compaction that stopped before removing it
+                os.remove(segment_path)
+                continue
+            df = pd.read_parquet(segment_path)
+            deleted = df['deleted']
+            self.data.update(zip(df.loc[~deleted, 'key'], df.loc[~deleted, 'value']))
+            for key in df.loc[deleted, 'key']:
+                self.data.pop(key, None)
+            applied = True
+        self.segment_counter = max(self.segment_counter, base_segment)
+        if applied:
+            # The snapshot's index no longer matches, so rebuild it from the data
+            codes, uniques = pd.factorize(pd.Series(list(self.data.values()), dtype=object), use_na_sentinel=False)
+            self.index = group_keys_by_value(np.asarray(list(self.data.keys()), dtype=object), codes,
+                                             uniques.tolist())
+
+    def _segment_files(self):
+        if not os.path.isdir(self.segment_dir):
+            return []
+        segments = [(int(match.group(1)), os.path.join(self.segment_dir, match.group(0)))
+                    for match in map(SEGMENT_FILE_PATTERN.match, os.listdir(self.segment_dir)) if match]
+        return sorted(segments)
 
     def apply_change(self, log_entry, apply_to_data=True):
         """Apply a logged change to the data structure and secondary index."""
@@ -163,6 +597,7 @@ class KVShard:
         old_value = log_entry['old_value']
         action = log_entry['action']
         if apply_to_data:
+            self.dirty.add(key)
             if action == 'insert' or action == 'update':
                 self.data[key] = value
                 if old_value:
@@ -178,47 +613,423 @@ class KVShard:
                 if not self.index[value]:
                     del self.index[value]
 
-    def save_to_parquet(self):
-        """Save the data and index to Parquet files."""
-        data_df = pd.DataFrame(list(self.data.items()), columns=['key', 'value'])
-        data_df.to_parquet(self.data_file, index=False)
-        index_df = pd.DataFrame([(k, v) for k, keys in self.index.items() for v in keys], columns=['value', 'key'])
-        index_df.to_parquet(self.index_file, index=False)
+    def save_to_parquet(self, items=None, last_segment=0):
+        """Save the data and index to Parquet files.
+
+        ``items`` defaults to the current data. ``last_segment`` is stored in the data file's
+        metadata so segments it already contains are skipped on load.
+        """
+        if items is None:
+            items = list(self.data.items())
+        data_df = pd.DataFrame(items, columns=['key', 'value'])
+        table = pa.Table.from_pandas(data_df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'last_segment': str(last_segment)})
+        pq.write_table(table, self.data_file + '.tmp')
+        os.replace(self.data_file + '.tmp', self.data_file)
+        # The index is the data grouped by value, so it is written from the same rows
+        data_df[['value', 'key']].to_parquet(self.index_file + '.tmp', index=False)
+        os.replace(self.index_file + '.tmp', self.index_file)
+        if os.path.exists(self.feather_file):
+            os.remove(self.feather_file)
+
+    def save_to_feather(self, items=None, last_segment=0):
+        """Save the data as an uncompressed Arrow IPC file so it loads memory-mapped."""
+        if items is None:
+            items = list(self.data.items())
+        data_df = pd.DataFrame(items, columns=['key', 'value'])
+        table = pa.Table.from_pandas(data_df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'last_segment': str(last_segment)})
+        feather.write_feather(table, self.feather_file + '.tmp', compression='uncompressed')
+        os.replace(self.feather_file + '.tmp', self.feather_file)
+        # The parquet files are older than this snapshot now
+        for path in (self.data_file, self.index_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _write_segment(self, rows):
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self.segment_counter += 1
+        segment_path = os.path.join(self.segment_dir, f'segment_{self.segment_counter:06d}.parquet')
+        segment_df = pd.DataFrame(rows, columns=['key', 'value', 'deleted'])
+        segment_df.to_parquet(segment_path + '.tmp', index=False)
+        os.replace(segment_path + '.tmp', segment_path)
+        return segment_path
+
+    def snapshot(self):
+        """Persist the keys changed since the last snapshot and checkpoint the WAL past them."""
+        # Writers log before they apply, so transaction_lock keeps a logged change from being
+        # missing from self.data below; taken first, as end_transaction already holds it
+        with self.transaction_lock, self.snapshot_lock:
+            compact = len(self._segment_files()) >= self.max_segments
+            with self.lock:
+                # Every change logged up to this LSN has already been applied to self.data
+                lsn = self.wal.last_lsn
+                dirty, self.dirty = self.dirty, set()
+                if compact:
+                    rows = list(self.data.items())
+                else:
+                    rows = [(key, self.data.get(key), key not in self.data) for key in dirty]
+                self.last_snapshot = time.monotonic()
+            try:
+                if compact:
+                    if self.snapshot_format == 'feather':
+                        self.save_to_feather(rows, last_segment=self.segment_counter)
+                    else:
+                        self.save_to_parquet(rows, last_segment=self.segment_counter)
+                    # The new snapshot file, the one it replaces and the segments it folded in
+                    written = [self.feather_file, self.data_file, self.index_file, self.segment_dir]
+                    for _, segment_path in self._segment_files():
+                        os.remove(segment_path)
+                        written.append(segment_path)
+                elif rows:
+                    written = [self._write_segment(rows), self.segment_dir]
+                else:
+                    written = []
+                # The WAL stops covering these changes at the checkpoint, so they have to be on disk first
+                fsync_files(written)
+            except Exception:
+                with self.lock:
+                    self.dirty |= dirty
+                raise
+            self.wal.checkpoint(lsn)
 
     def start_transaction(self):
-        """Start a new transaction."""
+        """Start a new transaction; callers hold transaction_lock until end_transaction."""
         self.wal.start_transaction()
+        self.in_transaction = True
 
     def end_transaction(self):
-        """End the current transaction."""
+        """End the current transaction; snapshot the shard if enough has changed since the last one."""
+        self.in_transaction = False
         self.wal.end_transaction()
-        self.save_to_parquet()
+        self._maybe_snapshot()
 
-    def insert(self, key, value):
-        """Insert a new key-value pair."""
-        with self.lock:
-            old_value = self.data.get(key)
-            self.wal.log_insert(key, value)
-            self.apply_change({'action': 'insert', 'key': key, 'value': value, 'old_value': old_value})
+    def _maybe_snapshot(self):
+        # Run after every commit, autocommit writes included, so the WAL cannot grow unbounded
+        if (len(self.dirty) >= self.snapshot_every
+                or time.monotonic() - self.last_snapshot >= self.snapshot_interval):
+            self.snapshot()
 
-    def update(self, key, value):
+    def insert(self, key, value, wait=True):
+        """Insert a new key-value pair.
+
+        Returns the WAL sequence number; with ``wait=False`` the caller must wait for it to
+        become durable (``wal.wait_durable`` or ``wal.add_durable_callback``) before
+        acknowledging the write. Outside a transaction the write is logged as its own
+        autocommit transaction, after any transaction in progress on another thread.
+        """
+        # transaction_lock serializes writers; self.lock is only held for the in-memory reads
+        # and updates, never across the WAL write, which fsyncs without group commit
+        with self.transaction_lock:
+            old_value = self.get(key)
+            autocommit = not self.in_transaction
+            seq = self.wal.log_insert(key, value, wait=False, autocommit=autocommit)
+            with self.lock:
+                self.apply_change({'action': 'insert', 'key': key, 'value': value, 'old_value': old_value})
+        if autocommit:
+            self._maybe_snapshot()
+        # Wait for durability outside the lock so concurrent writers share one fsync
+        if wait:
+            self.wal.wait_durable(seq)
+        return seq
+
+    def update(self, key, value, wait=True):
         """Update an existing key-value pair."""
-        with self.lock:
-            old_value = self.data.get(key)
-            self.wal.log_update(key, old_value, value)
-            self.apply_change({'action': 'update', 'key': key, 'value': value, 'old_value': old_value})
+        with self.transaction_lock:
+            old_value = self.get(key)
+            autocommit = not self.in_transaction
+            seq = self.wal.log_update(key, old_value, value, wait=False, autocommit=autocommit)
+            with self.lock:
+                self.apply_change({'action': 'update', 'key': key, 'value': value, 'old_value': old_value})
+        if autocommit:
+            self._maybe_snapshot()
+        if wait:
+            self.wal.wait_durable(seq)
+        return seq
 
-    def delete(self, key):
+    def delete(self, key, wait=True):
         """Delete a key-value pair."""
-        with self.lock:
-            value = self.data.get(key)
-            self.wal.log_delete(key, value)
-            self.apply_change({'action': 'delete', 'key': key, 'value': value, 'old_value': None})
+        with self.transaction_lock:
+            value = self.get(key)
+            autocommit = not self.in_transaction
+            seq = self.wal.log_delete(key, value, wait=False, autocommit=autocommit)
+            with self.lock:
+                self.apply_change({'action': 'delete', 'key': key, 'value': value, 'old_value': None})
+        if autocommit:
+            self._maybe_snapshot()
+        if wait:
+            self.wal.wait_durable(seq)
+        return seq
 
     def get(self, key):
         """Retrieve a value by key."""
         with self.lock:
             return self.data.get(key)
 
+    def get_many(self, keys):
+        """Retrieve several keys under one lock acquisition; missing keys map to None."""
+        with self.lock:
+            return {key: self.data.get(key) for key in keys}
+
+    def put_many(self, items):
+        """Insert or update (key, value) pairs in one transaction."""
+        with self.transaction_lock:
+            self.start_transaction()
+            for key, value in items:
+                if self.get(key) is None:
+                    self.insert(key, value)
+                else:
+                    self.update(key, value)
+            self.end_transaction()
+
+    def delete_many(self, keys):
+        """Delete the given keys that exist in one transaction."""
+        with self.transaction_lock:
+            self.start_transaction()
+            for key in keys:
+                if self.get(key) is not None:
+                    self.delete(key)
+            self.end_transaction()
+
+    def close(self):
+        if self.dirty:
+            self.snapshot()
+        self.wal.close()
+
+
+# Route keys to shards with md5 so the layout is stable across processes (hash() is salted)
+def hash_key_to_shard(key, num_shards):
+    return int(hashlib.md5(str(key).encode()).hexdigest(), 16) % num_shards
+
+
+class ShardedKVStore:
+    """Routes keys over ``num_shards`` KVShards, each with its own WAL, data file and index file.
+
+    ``hash_function(key, num_shards)`` picks the shard; multi-key calls fan out to the
+    shards involved on a thread pool and gather the results.
+    """
+
+    def __init__(self, base_dir, num_shards=4, hash_function=hash_key_to_shard, max_workers=None,
+                 group_commit=False, record_format='json'):
+        self.base_dir = base_dir
+        self.num_shards = num_shards
+        self.hash_function = hash_function
+        self.pool = ThreadPoolExecutor(max_workers=max_workers or num_shards)
+        os.makedirs(base_dir, exist_ok=True)
+        # Shards load their snapshot and replay their WAL independently, so open them in parallel
+        self.shards = list(self.pool.map(
+            lambda shard_id: self._open_shard(shard_id, group_commit, record_format), range(num_shards)))
+
+    def _open_shard(self, shard_id, group_commit, record_format):
+        shard_dir = os.path.join(self.base_dir, f'shard_{shard_id}')
+        os.makedirs(shard_dir, exist_ok=True)
+        return KVShard(shard_id, os.path.join(shard_dir, 'wal'), os.path.join(shard_dir, 'data.parquet'),
+                       os.path.join(shard_dir, 'index.parquet'), group_commit=group_commit,
+                       record_format=record_format)
+
+    def shard_for(self, key):
+        return self.shards[self.hash_function(key, self.num_shards)]
+
+    def _group_by_shard(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.hash_function(key, self.num_shards), []).append(key)
+        return groups
+
+    def _fan_out(self, groups, call):
+        # Runs call(shard, shard_keys) for every shard involved and returns the results in shard order
+        futures = [self.pool.submit(call, self.shards[shard_id], shard_keys)
+                   for shard_id, shard_keys in sorted(groups.items())]
+        return [future.result() for future in futures]
+
+    def insert(self, key, value):
+        self.shard_for(key).insert(key, value)
+
+    def update(self, key, value):
+        self.shard_for(key).update(key, value)
+
+    def delete(self, key):
+        self.shard_for(key).delete(key)
+
+    def get(self, key):
+        return self.shard_for(key).get(key)
+
+    def multi_get(self, keys):
+        """Return {key: value} for ``keys``, reading each shard once; missing keys map to None."""
+        results = {}
+        for shard_results in self._fan_out(self._group_by_shard(keys),
+                                           lambda shard, shard_keys: shard.get_many(shard_keys)):
+            results.update(shard_results)
+        return results
+
+    def multi_put(self, items):
+        """Insert or update a dict or iterable of (key, value) pairs, one transaction per shard."""
+        items = dict(items)
+        groups = {}
+        for key, value in items.items():
+            groups.setdefault(self.hash_function(key, self.num_shards), []).append((key, value))
+        self._fan_out(groups, lambda shard, shard_items: shard.put_many(shard_items))
+
+    def multi_delete(self, keys):
+        self._fan_out(self._group_by_shard(keys), lambda shard, shard_keys: shard.delete_many(shard_keys))
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.pool.shutdown()
+
+
+# Testing the ShardedKVStore with parallel multi-key operations
+def test_sharded_kv_store():
+    base_dir = 'test_sharded_kv_dir'
+    store = ShardedKVStore(base_dir, num_shards=4)
+    store.multi_put({f'key{i}': f'value{i % 5}' for i in range(40)})
+    store.multi_put([('key1', 'value9')])
+    store.multi_delete(['key2', 'key3'])
+    print(store.multi_get(['key0', 'key1', 'key2']))
+    print(f"Keys per shard: {[len(shard.data) for shard in store.shards]}")
+    store.close()
+
+    # Reopening replays nothing new and reads each shard's snapshot back
+    store = ShardedKVStore(base_dir, num_shards=4)
+    print(store.multi_get(['key0', 'key1', 'key2']))
+    store.close()
+    shutil.rmtree(base_dir)
+
+
+# Testing that single-key writes outside put_many survive a crash
+def test_single_key_recovery():
+    base_dir = 'test_single_key_recovery_dir'
+    store = ShardedKVStore(base_dir, num_shards=2)
+    # Single-key writes race a multi-key transaction on the same shards
+    writer = threading.Thread(target=lambda: [store.insert(f'single{i}', f'value{i}') for i in range(20)])
+    writer.start()
+    store.multi_put({f'multi{i}': f'value{i}' for i in range(20)})
+    writer.join()
+    store.update('single0', 'updated')
+    store.delete('single1')
+    expected = {key: value for shard in store.shards for key, value in shard.data.items()}
+    # Crash: nothing was snapshotted, so reopening must rebuild every write from the WAL
+    for shard in store.shards:
+        shard.wal.close()
+    store.pool.shutdown()
+
+    store = ShardedKVStore(base_dir, num_shards=2)
+    recovered = {key: value for shard in store.shards for key, value in shard.data.items()}
+    assert recovered == expected, f"Recovered {len(recovered)} of {len(expected)} keys"
+    print(f"Recovered {len(recovered)} keys from the WAL")
+    store.close()
+    shutil.rmtree(base_dir)
+
+
+# Testing that writes acknowledged by AsyncKVShard survive a crash
+def test_async_kv_recovery():
+    base_dir = 'test_async_kv_recovery_dir'
+    os.makedirs(base_dir, exist_ok=True)
+
+    def open_shard():
+        return KVShard(0, os.path.join(base_dir, 'wal'), os.path.join(base_dir, 'data.parquet'),
+                       os.path.join(base_dir, 'index.parquet'), group_commit=True)
+
+    async def write(async_shard):
+        await asyncio.gather(*[async_shard.insert(f'key{i}', f'value{i}') for i in range(50)])
+        await async_shard.update('key0', 'updated')
+        await async_shard.delete('key1')
+        await async_shard.put_many([('key2', 'value9'), ('key50', 'value50')])
+        return await async_shard.get_many([f'key{i}' for i in range(51)])
+
+    shard = open_shard()
+    async_shard = AsyncKVShard(shard)
+    acknowledged = asyncio.run(write(async_shard))
+    async_shard.close()
+    # Crash: the WAL is closed without a snapshot, so only acknowledged WAL entries remain
+    shard.wal.close()
+
+    shard = open_shard()
+    recovered = shard.get_many(acknowledged)
+    assert recovered == acknowledged, f"Recovered {recovered}, expected {acknowledged}"
+    print(f"Recovered {len(shard.data)} acknowledged async writes")
+    shard.close()
+    shutil.rmtree(base_dir)
+
+
+# Testing that single-key writes outside a transaction also trigger snapshots
+def test_autocommit_snapshot():
+    base_dir = 'test_autocommit_snapshot_dir'
+    os.makedirs(base_dir, exist_ok=True)
+    wal_dir = os.path.join(base_dir, 'wal')
+    shard = KVShard(0, wal_dir, os.path.join(base_dir, 'data.parquet'), os.path.join(base_dir, 'index.parquet'),
+                    snapshot_every=5)
+    for i in range(500):
+        shard.insert(f'key{i}', f'value{i}')
+    assert len(shard.dirty) < 5, f"{len(shard.dirty)} keys still dirty"
+    assert shard._segment_files() or os.path.exists(shard.feather_file), "No snapshot was written"
+    # 500 entries fill five segments of 100; checkpoints must have truncated the older ones
+    assert len(segment_files(wal_dir)) <= 2, f"WAL has {len(segment_files(wal_dir))} segments"
+    assert shard.wal.read_checkpoint()['lsn'] >= 495
+    shard.close()
+    shutil.rmtree(base_dir)
+
+
+# Testing that a shard starts cold from a compacted snapshot, later segments and the WAL
+def test_snapshot_compaction():
+    for snapshot_format in SNAPSHOT_FORMATS:
+        base_dir = f'test_{snapshot_format}_compaction_dir'
+        os.makedirs(base_dir, exist_ok=True)
+
+        def open_shard(snapshot_format=snapshot_format):
+            return KVShard(0, os.path.join(base_dir, 'wal'), os.path.join(base_dir, 'data.parquet'),
+                           os.path.join(base_dir, 'index.parquet'), snapshot_every=10 ** 6, max_segments=3,
+                           snapshot_format=snapshot_format)
+
+        shard = open_shard()
+        expected = {}
+        for round_number in range(4):
+            for i in range(20):
+                shard.insert(f'key{round_number}_{i}', f'value{i % 3}')
+                expected[f'key{round_number}_{i}'] = f'value{i % 3}'
+            shard.update('key0_0', f'round{round_number}')
+            expected['key0_0'] = f'round{round_number}'
+            if round_number:
+                shard.delete(f'key{round_number - 1}_1')
+                del expected[f'key{round_number - 1}_1']
+            shard.snapshot()
+        # Three snapshots wrote segments and the fourth folded them into one snapshot file
+        snapshot_file = shard.feather_file if snapshot_format == 'feather' else shard.data_file
+        other_file = shard.data_file if snapshot_format == 'feather' else shard.feather_file
+        assert os.path.exists(snapshot_file) and not os.path.exists(other_file)
+        assert shard._segment_files() == []
+
+        # One more segment, then writes only the WAL has when the shard crashes
+        shard.insert('after_compaction', 'value0')
+        shard.delete('key3_5')
+        shard.snapshot()
+        shard.update('key0_0', 'unsnapshotted')
+        shard.delete('key2_2')
+        expected.update(after_compaction='value0', key0_0='unsnapshotted')
+        del expected['key3_5'], expected['key2_2']
+        assert len(shard._segment_files()) == 1
+        shard.wal.close()
+
+        # Opening with the other format still finds the only snapshot file there is
+        for reopen_format in (snapshot_format, 'parquet' if snapshot_format == 'feather' else 'feather'):
+            shard = open_shard(reopen_format)
+            assert shard.data == expected, f"{reopen_format} reopen of {snapshot_format} snapshot differs"
+            index = {}
+            for key, value in expected.items():
+                index.setdefault(value, []).append(key)
+            assert {value: sorted(keys) for value, keys in shard.index.items()} == {
+                value: sorted(keys) for value, keys in index.items()}
+            shard.wal.close()
+        print(f"Reopened {len(expected)} keys from a compacted {snapshot_format} snapshot")
+        shutil.rmtree(base_dir)
+
+
+test_sharded_kv_store()
+test_autocommit_snapshot()
+test_snapshot_compaction()
+test_single_key_recovery()
+test_async_kv_recovery()
+
 # 
 
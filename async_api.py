@@ -0,0 +1,140 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+class _AsyncFacade:
+    """Runs blocking calls of a wrapped object on its own bounded thread pool."""
+
+    def __init__(self, max_workers, thread_name_prefix):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class AsyncCRUDOperations(_AsyncFacade):
+    """asyncio front-end for a CRUDOperations instance.
+
+    Parquet and WAL work runs on a pool of ``max_workers`` threads. Reads of a bucket that is
+    not cached do not load it; they read the key's row from the files, and concurrent reads of
+    the same key and columns share that one lookup. A write made through this object keeps
+    reads issued after it from sharing a lookup that started before it finished.
+    """
+
+    def __init__(self, crud, max_workers=8):
+        super().__init__(max_workers, 'async-crud')
+        self.crud = crud
+        # (ssn, columns) -> task reading the record, while the read is running
+        self._reads = {}
+
+    async def read_record(self, ssn, columns=None):
+        key = (ssn, tuple(columns) if columns is not None else None)
+        task = self._reads.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(self.crud.read_record, ssn, columns))
+            self._reads[key] = task
+            task.add_done_callback(lambda _: self._reads.pop(key) if self._reads.get(key) is task else None)
+        record = await asyncio.shield(task)
+        # Every reader sharing the lookup gets its own copy
+        return dict(record) if record is not None else None
+
+    def _forget_reads(self, ssns=None):
+        # Bulk writes take frames as well as records, so they forget every read in flight
+        if ssns is None:
+            self._reads.clear()
+            return
+        for key in [key for key in self._reads if key[0] in ssns]:
+            del self._reads[key]
+
+    async def _write(self, ssns, func, *args):
+        try:
+            return await self._run(func, *args)
+        finally:
+            self._forget_reads(ssns)
+
+    async def create_record(self, record):
+        return await self._write([record['SSN']], self.crud.create_record, record)
+
+    async def update_record(self, ssn, updates):
+        return await self._write([ssn], self.crud.update_record, ssn, updates)
+
+    async def delete_record(self, ssn):
+        return await self._write([ssn], self.crud.delete_record, ssn)
+
+    async def create_records(self, records):
+        return await self._write(None, self.crud.create_records, records)
+
+    async def upsert_records(self, records):
+        return await self._write(None, self.crud.upsert_records, records)
+
+    async def delete_records(self, ssns):
+        return await self._write(None, self.crud.delete_records, ssns)
+
+    async def query(self, state=None, occupation=None, fetch_records=False):
+        return await self._run(self.crud.query, state=state, occupation=occupation, fetch_records=fetch_records)
+
+    async def count(self, state=None, occupation=None, group_by=None):
+        return await self._run(self.crud.count, state=state, occupation=occupation, group_by=group_by)
+
+    async def flush(self):
+        return await self._run(self.crud.flush)
+
+
+class AsyncKVShard(_AsyncFacade):
+    """asyncio front-end for a KVShard.
+
+    Reads come from the shard's in-memory dict and are answered on the event loop; the shard
+    never holds its lock across WAL I/O, so they don't wait on a writer's fsync. Single-key
+    writes are applied on the pool without waiting for the WAL; the coroutine then awaits a
+    future the WAL completes once the entry is durable, so with group commit many pending
+    writes share one fsync without holding a thread each.
+    """
+
+    def __init__(self, shard, max_workers=4):
+        super().__init__(max_workers, f'async-kv-{shard.shard_id}')
+        self.shard = shard
+
+    def _durable(self, seq):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def done(error):
+            loop.call_soon_threadsafe(_set_future, future, error)
+
+        self.shard.wal.add_durable_callback(seq, done)
+        return future
+
+    async def get(self, key):
+        return self.shard.get(key)
+
+    async def get_many(self, keys):
+        return self.shard.get_many(keys)
+
+    async def insert(self, key, value):
+        await self._durable(await self._run(self.shard.insert, key, value, wait=False))
+
+    async def update(self, key, value):
+        await self._durable(await self._run(self.shard.update, key, value, wait=False))
+
+    async def delete(self, key):
+        await self._durable(await self._run(self.shard.delete, key, wait=False))
+
+    async def put_many(self, items):
+        return await self._run(self.shard.put_many, list(items))
+
+    async def delete_many(self, keys):
+        return await self._run(self.shard.delete_many, list(keys))
+
+
+def _set_future(future, error):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(RuntimeError(f"WAL group commit failed: {error}"))
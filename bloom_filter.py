@@ -0,0 +1,102 @@
+import hashlib
+import json
+import math
+import os
+
+import numpy as np
+
+# Buckets start small, so a filter never gets fewer slots than this
+MIN_CAPACITY = 1024
+
+
+def _key_hashes(keys):
+    # Two independent 64-bit hashes per key from one blake2b digest; md5 is already used to
+    # pick the bucket, so reusing it would correlate the bits set by keys of the same bucket
+    blake2b = hashlib.blake2b
+    digests = b''.join([blake2b(str(key).encode(), digest_size=16).digest() for key in keys])
+    return np.frombuffer(digests, dtype='<u8').reshape(-1, 2)
+
+
+def file_version(path):
+    """(inode, size, mtime_ns) of a file, or None if it does not exist; any rewrite changes it."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+class BloomFilter:
+    """Bit-packed Bloom filter over string keys.
+
+    ``might_contain`` never answers False for a key that was added, and answers True for an
+    absent key with probability about ``fpp`` while no more than ``capacity`` keys are in it.
+    Keys cannot be removed; a filter with many stale keys is rebuilt from scratch instead.
+    ``meta`` is a free-form JSON-serializable dict saved along with the bits.
+    """
+
+    def __init__(self, num_bits, num_hashes, bits=None, count=0, meta=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else np.zeros((num_bits + 7) // 8, dtype=np.uint8)
+        self.count = count
+        self.meta = meta if meta is not None else {}
+
+    @classmethod
+    def for_capacity(cls, capacity, fpp=0.01, meta=None):
+        capacity = max(capacity, MIN_CAPACITY)
+        num_bits = math.ceil(-capacity * math.log(fpp) / math.log(2) ** 2)
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes, meta=meta)
+
+    @classmethod
+    def from_keys(cls, keys, fpp=0.01, meta=None):
+        """Filter holding ``keys``, sized for twice as many so later adds keep it accurate."""
+        keys = list(keys)
+        bloom = cls.for_capacity(2 * len(keys), fpp, meta)
+        bloom.add_many(keys)
+        return bloom
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(int(data['num_bits']), int(data['num_hashes']), data['bits'].copy(),
+                       int(data['count']), json.loads(str(data['meta'])))
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, num_bits=np.int64(self.num_bits), num_hashes=np.int64(self.num_hashes), bits=self.bits,
+                     count=np.int64(self.count), meta=np.array(json.dumps(self.meta)))
+        os.replace(tmp_path, path)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def _positions(self, keys):
+        # Double hashing: bit i of a key is (h1 + i * h2) mod num_bits
+        hashes = _key_hashes(keys)
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+        return (hashes[:, :1] + steps * (hashes[:, 1:] | np.uint64(1))) % np.uint64(self.num_bits)
+
+    def add_many(self, keys):
+        positions = self._positions(keys).ravel()
+        if positions.size:
+            np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                             np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+            self.count += positions.size // self.num_hashes
+
+    def add(self, key):
+        self.add_many([key])
+
+    def might_contain_many(self, keys):
+        positions = self._positions(keys)
+        set_bits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return set_bits.all(axis=1)
+
+    def might_contain(self, key):
+        return bool(self.might_contain_many([key])[0])
+
+    def __contains__(self, key):
+        return self.might_contain(key)
@@ -0,0 +1,111 @@
+import sys
+import threading
+from collections import OrderedDict
+
+# Rough in-memory cost of one SSN posting held in a secondary index
+POSTING_BYTES = 64
+
+
+class CachedBucket:
+    """Decoded bucket DataFrame plus its secondary indexes."""
+
+    def __init__(self, df, indexes):
+        self.df = df
+        self.indexes = indexes
+        self.dirty = set()
+        # SSN -> full record, or None for a delete, not yet written to a delta file
+        self.pending = {}
+        # (df, BitmapIndex) built lazily for count queries; stale once df is replaced
+        self.bitmaps = None
+        self.nbytes = 0
+        # Held while pending, dirty and the indexes change or are written out
+        self.lock = threading.RLock()
+
+    def estimate_size(self):
+        size = 0
+        if self.df is not None:
+            size += int(self.df.memory_usage(index=True, deep=True).sum())
+        for index_data in self.indexes.values():
+            for key, ssns in index_data.items():
+                size += sys.getsizeof(key) + len(ssns) * POSTING_BYTES
+        return size
+
+
+class BucketCache:
+    """Byte-size-bounded LRU cache of decoded buckets.
+
+    Dirty entries are handed to ``flush_callback`` before they are evicted so
+    write-back callers never lose changes that have not reached disk yet.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, flush_callback=None):
+        self.max_bytes = max_bytes
+        self.flush_callback = flush_callback
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, bucket):
+        with self.lock:
+            entry = self.entries.get(bucket)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(bucket)
+            self.hits += 1
+            return entry
+
+    def peek(self, bucket):
+        """Return a cached bucket without counting a hit or refreshing its LRU position."""
+        with self.lock:
+            return self.entries.get(bucket)
+
+    def setdefault(self, bucket, entry):
+        """Insert ``entry`` unless the bucket is already cached; returns the cached entry."""
+        with self.lock:
+            existing = self.entries.get(bucket)
+            if existing is not None:
+                return existing
+            self.put(bucket, entry)
+            return entry
+
+    def put(self, bucket, entry):
+        with self.lock:
+            old_entry = self.entries.pop(bucket, None)
+            if old_entry is not None:
+                self.current_bytes -= old_entry.nbytes
+            entry.nbytes = entry.estimate_size()
+            self.entries[bucket] = entry
+            self.current_bytes += entry.nbytes
+            self._evict()
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self.entries:
+            bucket, entry = self.entries.popitem(last=False)
+            self.current_bytes -= entry.nbytes
+            self.evictions += 1
+            if entry.dirty and self.flush_callback is not None:
+                self.flush_callback(bucket, entry)
+
+    def invalidate(self, bucket=None):
+        """Drop one bucket, or every bucket when ``bucket`` is None, without flushing."""
+        with self.lock:
+            if bucket is None:
+                self.entries.clear()
+                self.current_bytes = 0
+            else:
+                entry = self.entries.pop(bucket, None)
+                if entry is not None:
+                    self.current_bytes -= entry.nbytes
+
+    def dirty_entries(self):
+        with self.lock:
+            return [(bucket, entry) for bucket, entry in self.entries.items() if entry.dirty]
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.current_bytes}
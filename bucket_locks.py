@@ -0,0 +1,105 @@
+import threading
+from contextlib import contextmanager
+
+
+class RWLock:
+    """Reader/writer lock that lets many readers or one writer in, and favours waiting writers.
+
+    The thread holding the write lock may also take the read lock, so code running under a
+    writer can call helpers that only ask for read access.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._cond:
+            if self._writer is threading.current_thread():
+                self._writer_depth += 1
+                return
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            if self._writer is threading.current_thread():
+                self._writer_depth -= 1
+                return
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            if self._writer is threading.current_thread():
+                self._writer_depth += 1
+                return
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = threading.current_thread()
+            self._writer_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class BucketLocks:
+    """One RWLock per bucket, created on first use."""
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, bucket):
+        with self._lock:
+            lock = self._locks.get(bucket)
+            if lock is None:
+                lock = self._locks[bucket] = RWLock()
+            return lock
+
+    def read(self, bucket):
+        return self.get(bucket).read()
+
+    def write(self, bucket):
+        return self.get(bucket).write()
+
+    @contextmanager
+    def write_many(self, buckets):
+        """Write-lock several buckets, always in ascending order so two batches cannot deadlock."""
+        locks = [self.get(bucket) for bucket in sorted(set(buckets))]
+        acquired = []
+        try:
+            for lock in locks:
+                lock.acquire_write()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release_write()
@@ -0,0 +1,129 @@
+"""Bucket assignment for SSN-keyed records.
+
+Two hash schemes are supported:
+
+* ``md5`` - the original layout, ``int(md5(str(ssn)).hexdigest(), 16) % num_buckets``.
+  Digests still come from hashlib one key at a time, but the 128-bit modulo is done in
+  NumPy, so it is several times faster than converting every hex digest to a Python int.
+* ``fnv1a`` - 64-bit FNV-1a computed column-wise over a fixed-width byte array, fully
+  vectorized. It produces a different layout from ``md5``.
+* ``jump`` - jump consistent hash (Lamping & Veach) of the low 64 bits of the md5 digest.
+  Growing from n to m buckets only moves about (m - n) / m of the keys, all into the new
+  buckets, which is what ``CRUDOperations.rebalance`` relies on. Unlike a hash ring it needs
+  no virtual nodes, since buckets are numbered 0..n-1 rather than arbitrary names.
+
+Migrating a bucket directory from ``md5`` to ``fnv1a`` means rebuilding it: load every
+bucket, re-partition with ``partition_frame(df, scheme='fnv1a')``, write the new buckets
+into a fresh directory, then point ``CRUDOperations(hash_scheme='fnv1a')`` at it.
+"""
+import hashlib
+
+import numpy as np
+
+HASH_SCHEMES = ('md5', 'fnv1a', 'jump')
+
+FNV_OFFSET_BASIS = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+JUMP_MULTIPLIER = 2862933555777941757
+
+
+def hash_index_to_bucket(ssn, num_buckets=1000):
+    hash_object = hashlib.md5(str(ssn).encode())
+    bucket = int(hash_object.hexdigest(), 16) % num_buckets
+    return bucket
+
+
+def _md5_words(ssns):
+    # (high, low) 64-bit halves of each SSN's md5 digest
+    md5 = hashlib.md5
+    digests = b''.join([md5(str(ssn).encode()).digest() for ssn in ssns])
+    return np.frombuffer(digests, dtype='>u8').reshape(-1, 2).astype(np.uint64)
+
+
+def md5_bucket_ids(ssns, num_buckets=1000):
+    """Vectorized equivalent of ``hash_index_to_bucket`` for a sequence of SSNs."""
+    words = _md5_words(ssns)
+    n = np.uint64(num_buckets)
+    # digest = high * 2**64 + low, and every product below stays under 2**64 for num_buckets < 2**32
+    two_64_mod_n = np.uint64((1 << 64) % num_buckets)
+    return (((words[:, 0] % n) * two_64_mod_n + words[:, 1] % n) % n).astype(np.int64)
+
+
+def fnv1a_hashes(ssns):
+    """64-bit FNV-1a hash of each SSN's UTF-8 bytes, computed one byte column at a time."""
+    encoded = np.asarray([str(ssn).encode() for ssn in ssns], dtype=bytes)
+    if encoded.size == 0:
+        return np.zeros(0, dtype=np.uint64)
+    width = encoded.dtype.itemsize
+    byte_matrix = encoded.view(np.uint8).reshape(-1, width)
+    lengths = np.char.str_len(encoded)
+    hashes = np.full(len(encoded), FNV_OFFSET_BASIS, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for position in range(width):
+            active = position < lengths
+            mixed = (hashes ^ byte_matrix[:, position].astype(np.uint64)) * FNV_PRIME
+            hashes = np.where(active, mixed, hashes)
+    return hashes
+
+
+def jump_hash(key, num_buckets):
+    """Jump consistent hash of a 64-bit integer key."""
+    bucket, candidate = -1, 0
+    while candidate < num_buckets:
+        bucket = candidate
+        key = (key * JUMP_MULTIPLIER + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def jump_bucket(ssn, num_buckets=1000):
+    key = int.from_bytes(hashlib.md5(str(ssn).encode()).digest()[8:], 'big')
+    return jump_hash(key, num_buckets)
+
+
+def jump_bucket_ids(ssns, num_buckets=1000):
+    """Vectorized ``jump_bucket``; every key takes O(log num_buckets) jumps."""
+    keys = _md5_words(ssns)[:, 1].copy()
+    buckets = np.full(len(keys), -1, dtype=np.int64)
+    candidates = np.zeros(len(keys), dtype=np.int64)
+    active = candidates < num_buckets
+    with np.errstate(over='ignore'):
+        while active.any():
+            buckets[active] = candidates[active]
+            keys[active] = keys[active] * np.uint64(JUMP_MULTIPLIER) + np.uint64(1)
+            candidates[active] = ((buckets[active] + 1)
+                                  * (float(1 << 31) / ((keys[active] >> np.uint64(33)) + 1).astype(np.float64))
+                                  ).astype(np.int64)
+            active = candidates < num_buckets
+    return buckets
+
+
+def bucket_ids(ssns, num_buckets=1000, scheme='md5'):
+    """Bucket id of every SSN in ``ssns`` as an int64 array."""
+    if scheme == 'md5':
+        return md5_bucket_ids(ssns, num_buckets)
+    if scheme == 'fnv1a':
+        return (fnv1a_hashes(ssns) % np.uint64(num_buckets)).astype(np.int64)
+    if scheme == 'jump':
+        return jump_bucket_ids(ssns, num_buckets)
+    raise ValueError(f"Unknown hash scheme {scheme!r}, expected one of {HASH_SCHEMES}")
+
+
+def partition_frame(df, num_buckets=1000, scheme='md5', column=None, ids=None):
+    """Split ``df`` into {bucket: sub-frame} with one stable argsort.
+
+    SSNs come from ``column`` when given, otherwise from the index (the first level of a
+    MultiIndex). ``ids`` are bucket ids the caller already computed for the rows.
+    """
+    if ids is None:
+        if column is not None:
+            ssns = df[column].to_numpy()
+        else:
+            ssns = df.index.get_level_values(0).to_numpy()
+        ids = bucket_ids(ssns, num_buckets, scheme)
+    order = np.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    buckets, starts = np.unique(sorted_ids, return_index=True)
+    ends = np.append(starts[1:], len(sorted_ids))
+    return {int(bucket): df.iloc[order[start:end]] for bucket, start, end in zip(buckets, starts, ends)}
@@ -0,0 +1,165 @@
+"""File formats for bucket base and delta files.
+
+* ``parquet`` - compressed parquet in small row groups with SSN statistics, so a point lookup
+  decodes a single row group. Smallest on disk, but every read decompresses and decodes.
+* ``arrow`` - uncompressed Arrow IPC (Feather v2) files opened with ``pa.memory_map``. Reads
+  are zero-copy views of the OS page cache, which every process reading the bucket shares,
+  at the cost of several times the disk space.
+
+``CRUDOperations(storage=...)`` takes one of the names in ``STORAGE_BACKENDS`` or an instance
+of a ``BucketStorage`` subclass. The choice is recorded in the bucket directory's
+layout.json, since the two formats cannot be mixed in one directory.
+"""
+from abc import ABC, abstractmethod
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+STORAGE_BACKENDS = ('parquet', 'arrow')
+# Small row groups keep a point lookup to a few KB of decoding; the SSN min/max statistics of
+# each group tell the reader which one can hold a key
+ROW_GROUP_SIZE = 2048
+
+
+def write_bucket_parquet(df, path, row_group_size=ROW_GROUP_SIZE, bloom_filter=False):
+    """Write a bucket frame, already sorted by SSN, laid out for point lookups.
+
+    Row groups of ``row_group_size`` rows with column statistics and page indexes, the sort
+    order recorded in the metadata, and optionally a parquet bloom filter on SSN.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    ssn_column = table.schema.get_field_index('SSN')
+    pq.write_table(table, path, row_group_size=row_group_size, write_statistics=True, write_page_index=True,
+                   sorting_columns=[pq.SortingColumn(ssn_column)] if ssn_column >= 0 else None,
+                   bloom_filter_options={'SSN': {'ndv': max(len(df), 1), 'fpp': 0.01}} if bloom_filter else None)
+
+
+def _data_columns(schema, columns=None):
+    # The SSN index is stored as an extra __index_level_0__ column next to the SSN column. With
+    # ``columns`` only those are kept, plus SSN and a delta file's _deleted flag
+    names = [name for name in schema.names if not name.startswith('__index_level_')]
+    if columns is None:
+        return names
+    return [name for name in names if name in ('SSN', '_deleted') or name in columns]
+
+
+class BucketStorage(ABC):
+    """Reads and writes the files of one bucket format.
+
+    Frames are indexed by SSN and also hold it as a column. Delta frames carry a ``_deleted``
+    flag as well; rows of a delta file are in write order, so the last row for an SSN wins.
+    """
+    name = None
+    extension = None
+
+    @abstractmethod
+    def write(self, df, path):
+        """Write a base file from a frame sorted by SSN."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def write_delta(self, df, path):
+        raise NotImplementedError
+
+    @abstractmethod
+    def read(self, path):
+        """Read a whole file back into a frame indexed by SSN."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_ssns(self, path):
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_row(self, path, ssn, columns=None):
+        """Return the last row for ``ssn`` as a dict without the index column, or None.
+
+        With ``columns`` only those, SSN and a delta's ``_deleted`` flag are decoded.
+        """
+        raise NotImplementedError
+
+
+class ParquetStorage(BucketStorage):
+    name = 'parquet'
+    extension = '.parquet'
+
+    def __init__(self, bloom_filter=False):
+        # Write a parquet bloom filter on SSN into base files
+        self.bloom_filter = bloom_filter
+
+    def write(self, df, path):
+        write_bucket_parquet(df, path, bloom_filter=self.bloom_filter)
+
+    def write_delta(self, df, path):
+        df.to_parquet(path, index=True)
+
+    def read(self, path):
+        return pd.read_parquet(path)
+
+    def read_ssns(self, path):
+        return pq.read_table(path, columns=['SSN'])['SSN'].to_pylist()
+
+    def read_row(self, path, ssn, columns=None):
+        # Only row groups whose SSN statistics can contain the key are decoded, and of those
+        # only the requested columns
+        with pq.ParquetFile(path) as parquet_file:
+            metadata = parquet_file.metadata
+            columns = _data_columns(parquet_file.schema_arrow, columns)
+            ssn_column = parquet_file.schema_arrow.get_field_index('SSN')
+            for row_group in range(metadata.num_row_groups):
+                statistics = metadata.row_group(row_group).column(ssn_column).statistics
+                if statistics is not None and statistics.has_min_max and not statistics.min <= ssn <= statistics.max:
+                    continue
+                table = parquet_file.read_row_group(row_group, columns=columns)
+                rows = table.filter(pc.equal(table['SSN'], ssn)).to_pylist()
+                if rows:
+                    return rows[-1]
+        return None
+
+
+class ArrowStorage(BucketStorage):
+    name = 'arrow'
+    extension = '.arrow'
+
+    def __init__(self, batch_size=ROW_GROUP_SIZE):
+        self.batch_size = batch_size
+
+    def write(self, df, path):
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=self.batch_size)
+
+    def write_delta(self, df, path):
+        self.write(df, path)
+
+    def _read_table(self, path):
+        # The table's buffers point into the mapping, which stays alive as long as they do
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def read(self, path):
+        return self._read_table(path).to_pandas()
+
+    def read_ssns(self, path):
+        return self._read_table(path)['SSN'].to_pylist()
+
+    def read_row(self, path, ssn, columns=None):
+        # Comparing the mapped SSN column only touches its pages; just the matching row of the
+        # requested columns is converted
+        table = self._read_table(path)
+        table = table.select(_data_columns(table.schema, columns))
+        rows = table.filter(pc.equal(table['SSN'], ssn)).to_pylist()
+        return rows[-1] if rows else None
+
+
+def make_storage(storage='parquet', bloom_filter=False):
+    """Backend for a name in STORAGE_BACKENDS; backend objects are returned as they are."""
+    if not isinstance(storage, str):
+        return storage
+    if storage == 'parquet':
+        return ParquetStorage(bloom_filter=bloom_filter)
+    if storage == 'arrow':
+        return ArrowStorage()
+    raise ValueError(f"Unknown storage {storage!r}, expected one of {STORAGE_BACKENDS}")
@@ -0,0 +1,133 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from bitmap_index import BitmapIndex
+from bloom_filter import BloomFilter, file_version
+from bucket_storage import STORAGE_BACKENDS, make_storage
+from posting_index import PostingIndex, ssns_to_ints, write_postings
+
+EXECUTORS = ('thread', 'process')
+INDEX_COLUMNS = ('State', 'Occupation')
+
+
+def _run_starts(*keys):
+    # Start of every run of equal keys in arrays sorted by them, followed by their length
+    change = np.ones(len(keys[0]), dtype=bool)
+    if len(change):
+        change[1:] = False
+        for key in keys:
+            change[1:] |= key[1:] != key[:-1]
+    return np.append(np.flatnonzero(change), len(change))
+
+
+def _stable_order(keys, rows):
+    # Reorders rows stably by keys[rows]; NumPy radix-sorts 16-bit keys, so narrow them when they fit
+    keys = keys[rows]
+    if len(keys) and 0 <= keys.min() and keys.max() < 1 << 16:
+        keys = keys.astype(np.uint16)
+    return rows[np.argsort(keys, kind='stable')]
+
+
+def build_postings(df, ids, columns=INDEX_COLUMNS):
+    """Posting lists of every bucket and of the whole frame, built from one pass over the frame.
+
+    ``df`` is indexed by SSN and ``ids`` holds the bucket of each of its rows. Returns
+    ({bucket: {column: (values, offsets, ssns)}}, {column: (values, offsets, rows)}) where the
+    entries of ``values[i]`` are ``ssns[offsets[i]:offsets[i + 1]]``: ascending uint32 SSNs as
+    PostingIndex files store them, or for the whole frame row positions into ``df`` in SSN order.
+    """
+    ssns = ssns_to_ints(df.index)
+    ids = np.asarray(ids)
+    # Rows are sorted by SSN once; stable sorts by value and then by bucket keep that order within each group
+    by_ssn = np.argsort(ssns)
+    bucket_postings = {}
+    global_postings = {}
+    for column in columns:
+        codes, uniques = pd.factorize(df[column])
+        uniques = np.asarray(uniques, dtype=object)
+        rows = _stable_order(codes, by_ssn[codes[by_ssn] >= 0])
+        starts = _run_starts(codes[rows])
+        global_postings[column] = (uniques[codes[rows[starts[:-1]]]].tolist(), starts, rows)
+
+        rows = _stable_order(ids, rows)
+        row_ids, row_codes = ids[rows], codes[rows]
+        starts = _run_starts(row_ids, row_codes)
+        group_ids = row_ids[starts[:-1]]
+        group_starts = _run_starts(group_ids)
+        for first, last in zip(group_starts[:-1], group_starts[1:]):
+            offsets = starts[first:last + 1]
+            bucket_postings.setdefault(int(group_ids[first]), {})[column] = (
+                uniques[row_codes[offsets[:-1]]].tolist(), offsets - offsets[0],
+                ssns[rows[offsets[0]:offsets[-1]]])
+    return bucket_postings, global_postings
+
+
+def atomic_write(storage, df, path):
+    """Write to a temp file next to ``path`` and rename it over, so readers never see half a file."""
+    tmp_path = path + '.tmp'
+    storage.write(df, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_bucket(bucket, bucket_df, buckets_dir, bloom_filter=False, storage='parquet', postings=None):
+    """Write one bucket base file plus its bitmap, SSN Bloom filter and State/Occupation posting index files.
+
+    ``postings`` is the bucket's entry from ``build_postings``; without it the posting
+    indexes are built from ``bucket_df``.
+    """
+    storage = make_storage(storage, bloom_filter=bloom_filter)
+    # Indexed by SSN and holding it as a column too, like the frames CRUDOperations writes
+    bucket_df = bucket_df.sort_index().rename_axis('SSN')
+    if 'SSN' not in bucket_df.columns:
+        bucket_df.insert(0, 'SSN', bucket_df.index)
+    bucket_file_path = os.path.join(buckets_dir, f'bucket_{bucket}{storage.extension}')
+    atomic_write(storage, bucket_df, bucket_file_path)
+    BitmapIndex.from_frame(bucket_df).save(os.path.join(buckets_dir, f'bitmap_{bucket}.npz'))
+    # Tied to this exact base file, so CRUDOperations rebuilds it if the base is rewritten without it
+    BloomFilter.from_keys(bucket_df.index, meta={'base': file_version(bucket_file_path), 'sequence': -1}).save(
+        os.path.join(buckets_dir, f'bloom_{bucket}.npz'))
+
+    for index_key in INDEX_COLUMNS:
+        prefix = os.path.join(buckets_dir, f'{index_key.lower()}_index_{bucket}')
+        if postings is not None:
+            write_postings(prefix, *postings.get(index_key, ([], [0], [])))
+        else:
+            PostingIndex.from_frame(bucket_df, index_key).save(prefix)
+    return bucket, len(bucket_df)
+
+
+def write_buckets(bucket_frames, buckets_dir, max_workers=None, executor='thread', progress_every=100,
+                  bloom_filter=False, storage='parquet', postings=None):
+    """Materialize {bucket: DataFrame} on a worker pool, printing progress as buckets finish.
+
+    Threads are usually enough since pyarrow releases the GIL while encoding and writing;
+    ``executor='process'`` also parallelizes the Python index building at the cost of
+    pickling each bucket frame to a worker. ``storage`` is a name from STORAGE_BACKENDS and
+    has to match the ``storage`` the directory is later opened with. ``postings`` is the
+    per-bucket result of ``build_postings``, so workers only write the index files.
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(f"Unknown executor {executor!r}, expected one of {EXECUTORS}")
+    if storage not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage {storage!r}, expected one of {STORAGE_BACKENDS}")
+    os.makedirs(buckets_dir, exist_ok=True)
+    max_workers = max_workers or os.cpu_count()
+    pool_class = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+
+    total = len(bucket_frames)
+    written_rows = 0
+    start = time.time()
+    with pool_class(max_workers=max_workers) as pool:
+        futures = [pool.submit(write_bucket, bucket, bucket_df, buckets_dir, bloom_filter, storage,
+                               None if postings is None else postings.get(bucket, {}))
+                   for bucket, bucket_df in bucket_frames.items()]
+        for done, future in enumerate(as_completed(futures), 1):
+            _, rows = future.result()
+            written_rows += rows
+            if done % progress_every == 0 or done == total:
+                print(f"Wrote {done}/{total} buckets ({written_rows} rows) in {time.time() - start:.1f}s")
+    return written_rows
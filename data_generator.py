@@ -0,0 +1,146 @@
+"""Seeded synthetic SSN/State/Occupation records at any scale.
+
+SSNs are drawn without replacement from the space Faker's ``ssn()`` uses (area 001-899
+except 666, group 01-99, serial 0001-9999, about 889M numbers). Rather than materializing a
+permutation of that space, row ``i`` gets SSN number ``permute(i)``, where ``permute`` is a
+seeded Feistel network over 30 bits that cycle-walks back into the space. It is a bijection,
+so SSNs are unique across the whole stream, and every row can be produced independently,
+which is what lets chunks be generated in any order and in parallel.
+
+State and Occupation are drawn uniformly as integer codes into ``STATES``/``OCCUPATIONS``.
+
+    for chunk in generate_records(100_000_000, seed=1):  # one DataFrame per chunk
+        ...
+    df = generate_frame(1_000_000, seed=1, categorical=False)
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+STATES = [
+    'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'FL', 'GA', 'HI', 'ID',
+    'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN',
+    'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND',
+    'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT',
+    'VA', 'WA', 'WV', 'WI', 'WY'
+]
+
+OCCUPATIONS = [
+    'Accountant', 'Actor', 'Actuary', 'Administrative Assistant',
+    'Aerospace Engineer', 'Agricultural Engineer', 'Air Traffic Controller',
+    'Aircraft Mechanic', 'Airline Pilot', 'Anesthesiologist',
+    'Anthropologist', 'Architect', 'Archivist', 'Art Director',
+    'Astronomer', 'Athletic Trainer', 'Audiologist', 'Author',
+    'Automotive Mechanic', 'Baker', 'Bartender', 'Biochemist',
+    'Biomedical Engineer', 'Brickmason', 'Broadcast Technician'
+]
+
+NUM_AREAS, NUM_GROUPS, NUM_SERIALS = 898, 99, 9999
+SSN_SPACE = NUM_AREAS * NUM_GROUPS * NUM_SERIALS
+
+FEISTEL_HALF_BITS = 15
+FEISTEL_MASK = np.uint64((1 << FEISTEL_HALF_BITS) - 1)
+FEISTEL_ROUNDS = 4
+GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+# ASCII digits of 0..9999 padded to four places; areas and groups use the last three and two
+PADDED_DIGITS = np.array([list(f'{i:04d}'.encode()) for i in range(10000)], dtype=np.uint8)
+
+
+def _feistel(values, keys):
+    left = values >> np.uint64(FEISTEL_HALF_BITS)
+    right = values & FEISTEL_MASK
+    for key in keys:
+        mixed = (right + key) * GOLDEN_GAMMA
+        mixed ^= mixed >> np.uint64(29)
+        left, right = right, left ^ ((mixed >> np.uint64(20)) & FEISTEL_MASK)
+    return (left << np.uint64(FEISTEL_HALF_BITS)) | right
+
+
+def permute_ssn_numbers(rows, seed=0):
+    """Map row numbers in [0, SSN_SPACE) to distinct SSN numbers in the same range."""
+    keys = np.random.default_rng(seed).integers(0, 1 << 63, size=FEISTEL_ROUNDS, dtype=np.uint64)
+    values = _feistel(np.asarray(rows, dtype=np.uint64), keys)
+    # The network permutes [0, 2**30); values outside the SSN space are pushed through again
+    # until they land inside it, which keeps the mapping a permutation of the space
+    outside = np.flatnonzero(values >= SSN_SPACE)
+    while outside.size:
+        values[outside] = _feistel(values[outside], keys)
+        outside = outside[values[outside] >= SSN_SPACE]
+    return values
+
+
+def format_ssns(numbers):
+    """ddd-dd-dddd strings for SSN numbers, as a pandas string array."""
+    numbers = np.asarray(numbers, dtype=np.int64)
+    area, rest = np.divmod(numbers, NUM_GROUPS * NUM_SERIALS)
+    group, serial = np.divmod(rest, NUM_SERIALS)
+    area += 1
+    area[area >= 666] += 1
+    # The bytes of all strings back to back, wrapped as an Arrow string array without a copy
+    chars = np.empty((len(numbers), 11), dtype=np.uint8)
+    chars[:, [3, 6]] = ord('-')
+    chars[:, 0:3] = PADDED_DIGITS[area, 1:]
+    chars[:, 4:6] = PADDED_DIGITS[group + 1, 2:]
+    chars[:, 7:] = PADDED_DIGITS[serial + 1]
+    offsets = np.arange(0, 11 * len(numbers) + 1, 11, dtype=np.int64)
+    strings = pa.Array.from_buffers(pa.large_string(), len(numbers), [None, pa.py_buffer(offsets), pa.py_buffer(chars)])
+    return pd.array(strings.cast(pa.string()), dtype='str')
+
+
+def generate_chunk(start, stop, seed=0, categorical=True):
+    """Rows ``start`` to ``stop`` of the stream for ``seed`` as a DataFrame indexed by row number."""
+    # Keyed by the chunk's first row, so a chunk does not depend on the ones before it
+    rng = np.random.default_rng([seed, start])
+    num_rows = stop - start
+    state_codes = rng.integers(0, len(STATES), size=num_rows, dtype=np.int8)
+    occupation_codes = rng.integers(0, len(OCCUPATIONS), size=num_rows, dtype=np.int8)
+    if categorical:
+        state = pd.Categorical.from_codes(state_codes, STATES)
+        occupation = pd.Categorical.from_codes(occupation_codes, OCCUPATIONS)
+    else:
+        state = np.array(STATES)[state_codes]
+        occupation = np.array(OCCUPATIONS)[occupation_codes]
+    return pd.DataFrame({'SSN': format_ssns(permute_ssn_numbers(np.arange(start, stop), seed)),
+                         'State': state, 'Occupation': occupation}, index=pd.RangeIndex(start, stop))
+
+
+def generate_records(num_records, seed=0, chunk_size=DEFAULT_CHUNK_SIZE, categorical=True, max_workers=None):
+    """Yield ``num_records`` rows as DataFrames of up to ``chunk_size`` rows, in row order.
+
+    Chunks are generated on ``max_workers`` threads, at most that many ahead of the consumer,
+    so a stream of 100M rows never holds more than a few chunks in memory. The same seed
+    always yields the same rows; ``chunk_size`` only changes the State/Occupation draws.
+    """
+    if not 0 <= num_records <= SSN_SPACE:
+        raise ValueError(f"num_records must be between 0 and {SSN_SPACE}, got {num_records}")
+    max_workers = max_workers or min(os.cpu_count(), 8)
+    starts = iter(range(0, num_records, chunk_size))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        for start in starts:
+            pending.append(pool.submit(generate_chunk, start, min(start + chunk_size, num_records), seed,
+                                       categorical))
+            if len(pending) >= max_workers:
+                break
+        while pending:
+            chunk = pending.popleft().result()
+            start = next(starts, None)
+            if start is not None:
+                pending.append(pool.submit(generate_chunk, start, min(start + chunk_size, num_records), seed,
+                                           categorical))
+            yield chunk
+
+
+def generate_frame(num_records, seed=0, **kwargs):
+    """All of ``generate_records`` in one DataFrame with SSN, State and Occupation columns."""
+    chunks = list(generate_records(num_records, seed, **kwargs))
+    if not chunks:
+        return generate_chunk(0, 0, seed, kwargs.get('categorical', True))
+    return pd.concat(chunks)
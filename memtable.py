@@ -0,0 +1,88 @@
+import sys
+import threading
+
+
+def _entry_size(ssn, record):
+    size = sys.getsizeof(ssn)
+    if record is not None:
+        size += sys.getsizeof(record) + sum(sys.getsizeof(value) for value in record.values())
+    return size
+
+
+class Memtable:
+    """In-memory table of writes that have been logged but not written to bucket files.
+
+    Maps SSN -> full record, or None for a delete. Each entry also keeps the bucket it belongs
+    to and the LSN of the oldest WAL entry it absorbed, since recovery has to replay from there
+    (an update on top of a create is only redoable if the create is replayed too), and the
+    record the bucket files held for the SSN before its first write here, so queries can
+    combine the bucket indexes with the memtable without draining it.
+
+    Entries are kept in a plain dict rather than a sorted structure: every read here is a
+    point lookup or a whole bucket, never a key range, so nothing needs them in order until
+    a bucket is drained, and ``bucket_entries`` sorts that bucket's SSNs then.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # ssn -> (bucket, record or None, lsn or None, record in the bucket files or None)
+        self._entries = {}
+        self._buckets = {}
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, ssn):
+        """Return (found, record); a found None record means the SSN was deleted."""
+        with self.lock:
+            entry = self._entries.get(ssn)
+        if entry is None:
+            return False, None
+        return True, entry[1]
+
+    def put(self, bucket, ssn, record, lsn=None, base=None):
+        """Set ``ssn`` to ``record``; ``base`` is what the bucket files hold for it, if anything."""
+        with self.lock:
+            old_entry = self._entries.get(ssn)
+            if old_entry is not None:
+                self.nbytes -= _entry_size(ssn, old_entry[1])
+                self._buckets[old_entry[0]].discard(ssn)
+                if old_entry[2] is not None:
+                    lsn = old_entry[2] if lsn is None else min(lsn, old_entry[2])
+                base = old_entry[3]
+            self._entries[ssn] = (bucket, record, lsn, base)
+            self._buckets.setdefault(bucket, set()).add(ssn)
+            self.nbytes += _entry_size(ssn, record)
+
+    def buckets(self):
+        with self.lock:
+            return sorted(bucket for bucket, ssns in self._buckets.items() if ssns)
+
+    def bucket_entries(self, bucket):
+        """Return {ssn: record or None} for one bucket, in SSN order."""
+        with self.lock:
+            return {ssn: self._entries[ssn][1] for ssn in sorted(self._buckets.get(bucket, ()))}
+
+    def bucket_changes(self, bucket):
+        """Return {ssn: (record in the bucket files or None, record or None)} for one bucket."""
+        with self.lock:
+            return {ssn: (self._entries[ssn][3], self._entries[ssn][1]) for ssn in self._buckets.get(bucket, ())}
+
+    def remove(self, ssns):
+        with self.lock:
+            for ssn in ssns:
+                entry = self._entries.pop(ssn, None)
+                if entry is not None:
+                    self._buckets[entry[0]].discard(ssn)
+                    self.nbytes -= _entry_size(ssn, entry[1])
+
+    def min_lsn(self):
+        with self.lock:
+            return min((entry[2] for entry in self._entries.values() if entry[2] is not None), default=None)
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self.nbytes = 0
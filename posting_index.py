@@ -0,0 +1,273 @@
+import json
+import os
+import re
+import struct
+
+import numpy as np
+
+SSN_PATTERN = re.compile(r'^(\d{3})-?(\d{2})-?(\d{4})$')
+
+# Log record: op, SSN as uint32, length of the UTF-8 index value that follows
+LOG_RECORD = struct.Struct('<BIH')
+OP_REMOVE, OP_ADD = 0, 1
+
+# The base file is rewritten once the log holds more records than this or than the base itself
+COMPACT_MIN_LOG_RECORDS = 1024
+
+# Character positions of the digits in ddd-dd-dddd, and their decimal weights
+SSN_DIGITS = [0, 1, 2, 4, 5, 7, 8, 9, 10]
+SSN_DIGIT_WEIGHTS = 10 ** np.arange(8, -1, -1, dtype=np.int64)
+
+
+def ssn_to_int(ssn):
+    match = SSN_PATTERN.match(str(ssn))
+    if match is None:
+        raise ValueError(f"Cannot index SSN {ssn!r}, expected ddd-dd-dddd")
+    return int(''.join(match.groups()))
+
+
+def ssns_to_ints(ssns):
+    """ssn_to_int over a sequence of SSNs; ones in ddd-dd-dddd form are converted in NumPy."""
+    chars = np.asarray(ssns, dtype=str)
+    if chars.dtype.itemsize != 11 * 4:
+        return np.fromiter((ssn_to_int(ssn) for ssn in chars.tolist()), dtype=np.uint32, count=chars.size)
+    # One uint32 code point per character; shorter strings are padded with zeros
+    codes = chars.view(np.uint32).reshape(-1, 11)
+    digits = codes[:, SSN_DIGITS].astype(np.int64) - ord('0')
+    dashed = (codes[:, 3] == ord('-')) & (codes[:, 6] == ord('-')) & ((digits >= 0) & (digits <= 9)).all(axis=1)
+    values = digits @ SSN_DIGIT_WEIGHTS
+    for i in np.flatnonzero(~dashed):
+        values[i] = ssn_to_int(str(chars[i]))
+    return values.astype(np.uint32)
+
+
+def write_postings(prefix, values, offsets, ssns):
+    """Write ``<prefix>.npz`` from postings grouped by value and drop any ``<prefix>.log``.
+
+    The SSNs of ``values[i]`` are ``ssns[offsets[i]:offsets[i + 1]]``, ascending.
+    """
+    tmp_path = prefix + '.npz.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, values=np.array([str(value) for value in values]), offsets=np.asarray(offsets, dtype=np.int64),
+                 ssns=np.asarray(ssns, dtype=np.uint32))
+    os.replace(tmp_path, prefix + '.npz')
+    # Replaying an old log over the new base is harmless: the last record per (value, SSN) wins
+    if os.path.exists(prefix + '.log'):
+        os.remove(prefix + '.log')
+
+
+def _encode_log(changes):
+    out = bytearray()
+    for op, value, ssn in changes:
+        encoded = str(value).encode()
+        out += LOG_RECORD.pack(op, ssn, len(encoded))
+        out += encoded
+    return out
+
+
+def scan_log(log_path):
+    """(length of the complete records, number of records) of an index log; a torn tail is not counted."""
+    if not os.path.exists(log_path):
+        return 0, 0
+    with open(log_path, 'rb') as f:
+        buf = f.read()
+    pos = records = 0
+    while pos + LOG_RECORD.size <= len(buf):
+        _, _, length = LOG_RECORD.unpack_from(buf, pos)
+        if pos + LOG_RECORD.size + length > len(buf):
+            break
+        pos += LOG_RECORD.size + length
+        records += 1
+    return pos, records
+
+
+def append_log(prefix, changes, log_state=None):
+    """Append (op, value, int SSN) changes to ``<prefix>.log`` without loading the index.
+
+    ``log_state`` is the (length, records) this returned for the log last time; the log is
+    scanned again when it is None or the file has changed size since. A torn tail is cut off
+    before appending. Returns the log's new (length, records).
+    """
+    log_path = prefix + '.log'
+    size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+    if log_state is None or log_state[0] != size:
+        log_state = scan_log(log_path)
+    out = _encode_log(changes)
+    with open(log_path, 'ab') as f:
+        if f.tell() > log_state[0]:
+            f.truncate(log_state[0])
+        f.write(out)
+    return log_state[0] + len(out), log_state[1] + len(changes)
+
+
+def base_size(prefix):
+    """Number of postings in ``<prefix>.npz``."""
+    if not os.path.exists(prefix + '.npz'):
+        return 0
+    with np.load(prefix + '.npz') as data:
+        return len(data['ssns'])
+
+
+def int_to_ssn(value):
+    digits = f'{value:09d}'
+    return f'{digits[:3]}-{digits[3:5]}-{digits[5:]}'
+
+
+class PostingIndex:
+    """Secondary index of one bucket: index value -> set of SSNs held as integers.
+
+    On disk it is ``<prefix>.npz`` (per-value sorted uint32 SSNs concatenated, with offsets)
+    plus an append-only ``<prefix>.log`` of add/remove records, so a write appends a few
+    bytes instead of rewriting every posting of the value.
+    """
+
+    def __init__(self, postings=None):
+        self.postings = postings if postings is not None else {}
+        self.base_size = 0
+        self.log_records = 0
+        # Bytes of complete records in the log; anything past this is a torn tail
+        self.log_length = 0
+        # (op, value, ssn) not yet appended to the log
+        self._changes = []
+        # Set when the base has to be written in full, e.g. after loading a legacy JSON index
+        self._rewrite = False
+
+    @classmethod
+    def from_frame(cls, df, index_key):
+        """Build an index from a bucket DataFrame indexed by SSN."""
+        ssns = ssns_to_ints(df.index)
+        postings = {}
+        for value, positions in df.groupby(index_key, sort=False).indices.items():
+            postings[value] = set(ssns[positions].tolist())
+        index = cls(postings)
+        index._rewrite = True
+        return index
+
+    @classmethod
+    def load(cls, prefix):
+        """Read ``<prefix>.npz`` and replay ``<prefix>.log``; falls back to a legacy ``<prefix>.json``."""
+        index = cls()
+        base_path = prefix + '.npz'
+        if os.path.exists(base_path):
+            with np.load(base_path) as data:
+                values, offsets, ssns = data['values'], data['offsets'], data['ssns']
+            for i, value in enumerate(values.tolist()):
+                index.postings[value] = set(ssns[offsets[i]:offsets[i + 1]].tolist())
+            index.base_size = len(ssns)
+        elif os.path.exists(prefix + '.json'):
+            with open(prefix + '.json', 'r') as f:
+                legacy = json.load(f)
+            index.postings = {value: {ssn_to_int(ssn) for ssn in ssns} for value, ssns in legacy.items()}
+            index._rewrite = True
+        index._replay_log(prefix + '.log')
+        return index
+
+    def _replay_log(self, log_path):
+        if not os.path.exists(log_path):
+            return
+        with open(log_path, 'rb') as f:
+            buf = f.read()
+        pos = 0
+        while pos + LOG_RECORD.size <= len(buf):
+            op, ssn, length = LOG_RECORD.unpack_from(buf, pos)
+            end = pos + LOG_RECORD.size + length
+            if end > len(buf):
+                break
+            value = buf[pos + LOG_RECORD.size:end].decode()
+            if op == OP_ADD:
+                self.postings.setdefault(value, set()).add(ssn)
+            else:
+                self._discard(value, ssn)
+            self.log_records += 1
+            pos = end
+        self.log_length = pos
+
+    def _discard(self, value, ssn):
+        ssns = self.postings.get(value)
+        if ssns is not None:
+            ssns.discard(ssn)
+            if not ssns:
+                del self.postings[value]
+
+    def add(self, value, ssn):
+        """Add ``ssn`` to ``value``'s postings; a no-op if it is already there."""
+        ssn = ssn_to_int(ssn)
+        ssns = self.postings.setdefault(value, set())
+        if ssn not in ssns:
+            ssns.add(ssn)
+            self._changes.append((OP_ADD, value, ssn))
+
+    def remove(self, value, ssn):
+        """Remove ``ssn`` from ``value``'s postings; a no-op if it is not there."""
+        ssn = ssn_to_int(ssn)
+        if ssn in self.postings.get(value, ()):
+            self._discard(value, ssn)
+            self._changes.append((OP_REMOVE, value, ssn))
+
+    def mark(self):
+        """Position to pass to ``undo``, valid until the next ``save``."""
+        return self._changes, len(self._changes)
+
+    def undo(self, mark):
+        """Revert the changes made since ``mark``; False if they have been saved in the meantime."""
+        changes, position = mark
+        if changes is not self._changes:
+            return False
+        for op, value, ssn in reversed(changes[position:]):
+            if op == OP_ADD:
+                self._discard(value, ssn)
+            else:
+                self.postings.setdefault(value, set()).add(ssn)
+        del changes[position:]
+        return True
+
+    def get(self, value):
+        """Integer SSNs posted under ``value``; do not modify the returned set."""
+        return self.postings.get(value, frozenset())
+
+    def contains(self, value, ssn):
+        return ssn_to_int(ssn) in self.postings.get(value, ())
+
+    def ssns(self, value):
+        """Sorted SSN strings posted under ``value``."""
+        return [int_to_ssn(ssn) for ssn in sorted(self.postings.get(value, ()))]
+
+    def keys(self):
+        return self.postings.keys()
+
+    def items(self):
+        return self.postings.items()
+
+    def save(self, prefix):
+        """Append pending changes to the log, or rewrite the base once the log has grown too long."""
+        if not self._changes and not self._rewrite:
+            return
+        if self._rewrite or self.log_records + len(self._changes) > max(COMPACT_MIN_LOG_RECORDS, self.base_size):
+            self._write_base(prefix)
+        else:
+            out = _encode_log(self._changes)
+            with open(prefix + '.log', 'ab') as f:
+                # Cut off a torn record left by a crash so the new records stay aligned
+                if f.tell() > self.log_length:
+                    f.truncate(self.log_length)
+                f.write(out)
+            self.log_length += len(out)
+            self.log_records += len(self._changes)
+        self._changes = []
+
+    def compact(self, prefix):
+        """Fold the log into the base file."""
+        self._write_base(prefix)
+        self._changes = []
+
+    def _write_base(self, prefix):
+        values = [value for value, ssns in self.postings.items() if ssns]
+        arrays = [np.sort(np.fromiter(self.postings[value], dtype=np.uint32)) for value in values]
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(array) for array in arrays])
+        ssns = np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.uint32)
+        write_postings(prefix, values, offsets, ssns)
+        self.base_size = len(ssns)
+        self.log_records = 0
+        self.log_length = 0
+        self._rewrite = False
@@ -0,0 +1,341 @@
+import datetime
+import json
+import os
+import re
+import struct
+import zlib
+
+RECORD_FORMATS = ('json', 'binary')
+CHECKPOINT_FILE = 'checkpoint.json'
+
+# Binary segments start with this magic so readers can tell them from JSON-lines segments
+SEGMENT_MAGIC = b'WALB\x01'
+
+# Record header: payload length, CRC32 of everything after the CRC, op code, flags, timestamp
+RECORD_HEADER = struct.Struct('<IIBBd')
+CRC_OFFSET = 8
+
+FLAG_TIMESTAMP = 0x01
+
+# Op code 0 stores the operation name inside the payload for operations not listed here
+OP_CODES = {
+    'start': 1, 'end': 2, 'insert': 3, 'update': 4, 'delete': 5,
+    'start_transaction': 6, 'end_transaction': 7, 'create': 8,
+}
+OP_NAMES = {code: name for name, code in OP_CODES.items()}
+
+# Field names repeated in nearly every entry are written as a one-byte code
+KEY_CODES = {name: code for code, name in enumerate((
+    '_op', 'data', 'is_rollback', 'key', 'value', 'old_value', 'SSN', 'State', 'Occupation',
+    'old_data', 'new_data', 'lsn'))}
+KEY_NAMES = {code: name for name, code in KEY_CODES.items()}
+
+# Payload value tags
+T_NONE, T_FALSE, T_TRUE, T_INT, T_FLOAT, T_SHORT_STR, T_STR, T_LIST, T_DICT, T_KEY = range(10)
+
+INT64 = struct.Struct('<q')
+FLOAT64 = struct.Struct('<d')
+UINT32 = struct.Struct('<I')
+
+
+def _pack_value(value, out):
+    if value is None:
+        out.append(T_NONE)
+    elif value is True:
+        out.append(T_TRUE)
+    elif value is False:
+        out.append(T_FALSE)
+    elif isinstance(value, int):
+        out.append(T_INT)
+        out += INT64.pack(value)
+    elif isinstance(value, float):
+        out.append(T_FLOAT)
+        out += FLOAT64.pack(value)
+    elif isinstance(value, str):
+        encoded = value.encode()
+        if len(encoded) < 256:
+            out.append(T_SHORT_STR)
+            out.append(len(encoded))
+        else:
+            out.append(T_STR)
+            out += UINT32.pack(len(encoded))
+        out += encoded
+    elif isinstance(value, (list, tuple)):
+        out.append(T_LIST)
+        out += UINT32.pack(len(value))
+        for item in value:
+            _pack_value(item, out)
+    elif isinstance(value, dict):
+        out.append(T_DICT)
+        out += UINT32.pack(len(value))
+        for key, item in value.items():
+            if key in KEY_CODES:
+                out.append(T_KEY)
+                out.append(KEY_CODES[key])
+            else:
+                _pack_value(key, out)
+            _pack_value(item, out)
+    else:
+        raise TypeError(f"Object of type {type(value).__name__} cannot be written to the WAL")
+
+
+def _unpack_value(buf, pos):
+    tag = buf[pos]
+    pos += 1
+    if tag == T_NONE:
+        return None, pos
+    if tag == T_TRUE:
+        return True, pos
+    if tag == T_FALSE:
+        return False, pos
+    if tag == T_INT:
+        return INT64.unpack_from(buf, pos)[0], pos + INT64.size
+    if tag == T_FLOAT:
+        return FLOAT64.unpack_from(buf, pos)[0], pos + FLOAT64.size
+    if tag == T_SHORT_STR:
+        length = buf[pos]
+        pos += 1
+        return buf[pos:pos + length].decode(), pos + length
+    if tag == T_STR:
+        length = UINT32.unpack_from(buf, pos)[0]
+        pos += UINT32.size
+        return buf[pos:pos + length].decode(), pos + length
+    if tag == T_KEY:
+        return KEY_NAMES[buf[pos]], pos + 1
+    if tag == T_LIST:
+        count = UINT32.unpack_from(buf, pos)[0]
+        pos += UINT32.size
+        items = []
+        for _ in range(count):
+            item, pos = _unpack_value(buf, pos)
+            items.append(item)
+        return items, pos
+    if tag == T_DICT:
+        count = UINT32.unpack_from(buf, pos)[0]
+        pos += UINT32.size
+        items = {}
+        for _ in range(count):
+            key, pos = _unpack_value(buf, pos)
+            items[key], pos = _unpack_value(buf, pos)
+        return items, pos
+    raise ValueError(f"Unknown WAL payload tag {tag}")
+
+
+def encode_entry(entry, op_field, record_format='json'):
+    """Encode one WAL entry dict as bytes ready to append to a segment."""
+    if record_format == 'json':
+        return (json.dumps(entry) + '\n').encode()
+
+    payload = {k: v for k, v in entry.items() if k not in (op_field, 'timestamp')}
+    op_code = OP_CODES.get(entry[op_field], 0)
+    if op_code == 0:
+        payload['_op'] = entry[op_field]
+
+    flags = 0
+    timestamp = 0.0
+    if entry.get('timestamp'):
+        flags |= FLAG_TIMESTAMP
+        timestamp = datetime.datetime.fromisoformat(entry['timestamp']).timestamp()
+    payload_bytes = bytearray()
+    _pack_value(payload, payload_bytes)
+
+    header = RECORD_HEADER.pack(len(payload_bytes), 0, op_code, flags, timestamp)
+    crc = zlib.crc32(payload_bytes, zlib.crc32(header[CRC_OFFSET:]))
+    return header[:4] + UINT32.pack(crc) + header[CRC_OFFSET:] + payload_bytes
+
+
+def _decode_record(op_field, op_code, flags, timestamp, payload_bytes):
+    payload, _ = _unpack_value(payload_bytes, 0)
+    entry = {}
+    if flags & FLAG_TIMESTAMP:
+        entry['timestamp'] = datetime.datetime.fromtimestamp(timestamp).isoformat()
+    entry[op_field] = payload.pop('_op') if op_code == 0 else OP_NAMES[op_code]
+    entry.update(payload)
+    return entry
+
+
+def segment_files(wal_dir):
+    """Return [(segment_number, file_name)] for the WAL segments in a directory, oldest first."""
+    segments = []
+    for file_name in os.listdir(wal_dir):
+        match = re.search(r'(\d+)\.wal$', file_name)
+        if match:
+            segments.append((int(match.group(1)), file_name))
+    return sorted(segments)
+
+
+def segment_format(path):
+    """Return 'binary' or 'json' for a segment, or None if it is empty or missing."""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(len(SEGMENT_MAGIC))
+    except FileNotFoundError:
+        return None
+    if not head:
+        return None
+    return 'binary' if head == SEGMENT_MAGIC else 'json'
+
+
+def _scan_records(path, offset=0):
+    # Yields (end_offset, record); JSON records come back parsed, binary ones still encoded
+    with open(path, 'rb') as f:
+        is_binary = f.read(len(SEGMENT_MAGIC)) == SEGMENT_MAGIC
+        if is_binary:
+            offset = max(offset, len(SEGMENT_MAGIC))
+        f.seek(offset)
+
+        if not is_binary:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    print(f"Torn WAL record at {path}:{offset}, ignoring tail")
+                    return
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    print(f"Corrupt WAL record at {path}:{offset}, ignoring tail")
+                    return
+                offset += len(line)
+                yield offset, entry
+            return
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size:
+                print(f"Torn WAL record at {path}:{offset}, ignoring tail")
+                return
+            length, crc, op_code, flags, timestamp = RECORD_HEADER.unpack(header)
+            payload_bytes = f.read(length)
+            if len(payload_bytes) < length:
+                print(f"Torn WAL record at {path}:{offset}, ignoring tail")
+                return
+            if zlib.crc32(payload_bytes, zlib.crc32(header[CRC_OFFSET:])) != crc:
+                print(f"CRC mismatch in WAL record at {path}:{offset}, ignoring tail")
+                return
+            offset += RECORD_HEADER.size + length
+            yield offset, (op_code, flags, timestamp, payload_bytes)
+
+
+def iter_entries(path, op_field, offset=0):
+    """Yield (end_offset, entry) for every complete record in a JSON or binary segment.
+
+    Reading stops at the first torn or corrupt record, which is what a crash in the
+    middle of an append leaves behind at the tail of the newest segment.
+    """
+    for end_offset, record in _scan_records(path, offset):
+        if isinstance(record, tuple):
+            record = _decode_record(op_field, *record)
+        yield end_offset, record
+
+
+def valid_length(path):
+    """Length of the prefix of a segment made of complete records."""
+    end = len(SEGMENT_MAGIC) if segment_format(path) == 'binary' else 0
+    for end, _ in _scan_records(path):
+        pass
+    return end
+
+
+def open_segment(path, record_format='json', buffering=-1):
+    """Open a segment for appending, cutting off any torn tail left by a crash."""
+    if segment_format(path) is not None:
+        end = valid_length(path)
+        if end < os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+            print(f"Truncated torn tail of {path} at offset {end}")
+    wal_file = open(path, 'ab', buffering=buffering)
+    if record_format == 'binary' and wal_file.tell() == 0:
+        wal_file.write(SEGMENT_MAGIC)
+    return wal_file
+
+
+def read_checkpoint(wal_dir):
+    """Return the last checkpoint as {'lsn': ..., 'position': ...}; lsn 0 means none yet."""
+    path = os.path.join(wal_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return {'lsn': 0, 'position': None}
+    with open(path, 'r') as f:
+        checkpoint = json.load(f)
+    if checkpoint.get('position') is not None:
+        checkpoint['position'] = tuple(checkpoint['position'])
+    return checkpoint
+
+
+def write_checkpoint(wal_dir, lsn, position=None):
+    """Atomically record that every entry up to ``lsn`` has been persisted."""
+    path = os.path.join(wal_dir, CHECKPOINT_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'lsn': lsn, 'position': list(position) if position else None}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def fsync_files(paths):
+    """fsync the files in ``paths`` that still exist, then the directories holding them."""
+    for path in sorted(paths):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    # Directories make renames, new files and removals durable
+    for directory in sorted({os.path.dirname(path) or '.' for path in paths}):
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def segment_last_lsn(path, op_field):
+    """LSN of the last entry in a segment, 0 for entries written before LSNs, None if empty."""
+    last = None
+    for _, entry in iter_entries(path, op_field):
+        last = entry.get('lsn', 0)
+    return last
+
+
+def last_lsn(wal_dir, op_field):
+    """Highest LSN handed out so far, from the newest non-empty segment or the checkpoint."""
+    for _, wal_file in reversed(segment_files(wal_dir)):
+        lsn = segment_last_lsn(os.path.join(wal_dir, wal_file), op_field)
+        if lsn is not None:
+            return max(lsn, read_checkpoint(wal_dir)['lsn'])
+    return read_checkpoint(wal_dir)['lsn']
+
+
+def truncate_segments(wal_dir, op_field, checkpoint_lsn, current_index, last_lsn_cache=None):
+    """Delete the segments before ``current_index`` whose entries are all covered by a checkpoint.
+
+    Stops at the first segment still holding an entry after ``checkpoint_lsn``. Closed segments
+    never change, so their last LSN is remembered in ``last_lsn_cache`` between calls. Segments
+    that disappear meanwhile are skipped.
+    """
+    last_lsn_cache = {} if last_lsn_cache is None else last_lsn_cache
+    deleted = []
+    for file_index, wal_file in segment_files(wal_dir):
+        if file_index >= current_index:
+            break
+        path = os.path.join(wal_dir, wal_file)
+        lsn = last_lsn_cache.get(file_index)
+        if file_index not in last_lsn_cache:
+            try:
+                lsn = last_lsn_cache[file_index] = segment_last_lsn(path, op_field)
+            except FileNotFoundError:
+                continue
+        if lsn is not None and lsn > checkpoint_lsn:
+            break
+        last_lsn_cache.pop(file_index, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        deleted.append(wal_file)
+    return deleted